@@ -11,4 +11,21 @@ CREATE INDEX idx_conversations_user_time
 ON conversations(user_id, created_at DESC);
 
 CREATE INDEX idx_conversations_session_time 
-ON conversations(user_id, session_id DESC);
\ No newline at end of file
+ON conversations(user_id, session_id DESC);
+
+CREATE INDEX idx_conversations_session_recent
+ON conversations(user_id, session_id, created_at DESC);
+
+-- Rolling summaries of older turns (one row per compaction; the newest wins)
+CREATE TABLE conversation_summaries (
+    id BIGSERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    session_id BIGINT,
+    summary TEXT NOT NULL,
+    covered_until TIMESTAMP NOT NULL,
+    message_count INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_conversation_summaries_session
+ON conversation_summaries(user_id, session_id, covered_until DESC);
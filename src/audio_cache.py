@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+import diskcache
+
+try:
+    import zstandard
+except ImportError:  # compression is optional
+    zstandard = None
+
+# --- Audio Cache Configuration ---
+AUDIO_CACHE_DIR = os.path.expanduser(os.environ.get("YUNA_AUDIO_CACHE_DIR", "~/.cache/yuna/audio"))
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get("YUNA_AUDIO_CACHE_BYTES", str(256 * 1024 * 1024)))
+AUDIO_CACHE_COMPRESS = os.environ.get("YUNA_AUDIO_CACHE_ZSTD", "1") == "1"
+
+_RAW = b"R"
+_ZSTD = b"Z"
+
+
+class AudioCache:
+    """
+    Disk-backed PCM cache keyed by voice model and cleaned sentence text.
+
+    The voice identity includes the model file's size and mtime, so swapping
+    or updating the voice invalidates old entries. Least recently used entries
+    are evicted past `size_limit`; entries are zstd-compressed when available.
+    """
+
+    def __init__(self, voice_model_path, directory=AUDIO_CACHE_DIR, size_limit=AUDIO_CACHE_MAX_BYTES,
+                 compress=AUDIO_CACHE_COMPRESS):
+        self._cache = diskcache.Cache(
+            directory, size_limit=size_limit, eviction_policy="least-recently-used"
+        )
+        try:
+            st = os.stat(voice_model_path)
+            self.voice_id = f"{os.path.abspath(voice_model_path)}:{st.st_size}:{int(st.st_mtime)}"
+        except OSError:
+            self.voice_id = os.path.abspath(voice_model_path)
+        self._compressor = zstandard.ZstdCompressor(level=3) if compress and zstandard else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.voice_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def contains(self, text):
+        return self._key(text) in self._cache
+
+    def get(self, text):
+        value = self._cache.get(self._key(text))
+        if value is None or (value[:1] == _ZSTD and self._decompressor is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if value[:1] == _ZSTD:
+            return self._decompressor.decompress(value[1:])
+        return value[1:]
+
+    def put(self, text, pcm):
+        if self._compressor is not None:
+            value = _ZSTD + self._compressor.compress(pcm)
+        else:
+            value = _RAW + bytes(pcm)
+        self._cache.set(self._key(text), value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._cache),
+            "bytes": self._cache.volume(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class CachedVoice:
+    """Voice wrapper that serves sentences from an AudioCache before synthesizing."""
+
+    def __init__(self, voice, cache):
+        self.voice = voice
+        self.cache = cache
+        self.sample_rate = voice.sample_rate
+
+    def synthesize_into(self, text, buffer):
+        pcm = self.cache.get(text)
+        if pcm is not None:
+            buffer.clear()
+            buffer.extend(pcm)
+            return
+        self.voice.synthesize_into(text, buffer)
+        if not buffer.length:
+            return  # nothing rendered (silent voice): don't cache the silence
+        view = buffer.view()
+        try:
+            self.cache.put(text, view)
+        finally:
+            view.release()
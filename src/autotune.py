@@ -0,0 +1,234 @@
+"""
+Sweep llama.cpp load parameters on this host and save the fastest profile.
+
+Each configuration is loaded in a fresh process, which evaluates a fixed prompt
+set (prefill tokens/s), generates a fixed number of tokens (decode tokens/s)
+and reports its peak RSS. The chosen profile is written per host and picked up
+by `load_model` in yuna_service.py and the v1.2 standalone.
+
+    python autotune.py                      # full sweep with the default grid
+    python autotune.py --quick              # threads x batch only
+    python autotune.py --threads 4,6,8 --batch 256,512 --kv f16,q8_0 --ctx 2048,4096
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from datetime import datetime
+
+# --- Autotune Configuration ---
+PROFILE_DIR = os.path.expanduser(os.environ.get("YUNA_AUTOTUNE_DIR", "~/.config/yuna/autotune"))
+DEFAULT_MODEL_PATH = "/home/guts/llama.cpp/models/Phi-3-mini-4k-instruct-q4.gguf"
+DEFAULT_BATCHES = [128, 256, 512]
+DEFAULT_KV_TYPES = ["f16", "q8_0"]
+DEFAULT_CONTEXTS = [2048, 4096]
+DECODE_TOKENS = 64
+DECODE_TOLERANCE = 0.05  # configs within 5% of the best decode speed count as equally fast
+TRIAL_TIMEOUT_SECONDS = 600
+
+# KV cache element types; quantized V caches need flash attention in llama.cpp
+KV_TYPES = {
+    "f16": {"type_k": 1, "type_v": 1},
+    "q8_0": {"type_k": 8, "type_v": 8, "flash_attn": True},
+    "q4_0": {"type_k": 2, "type_v": 2, "flash_attn": True},
+}
+
+# Fixed prompt set: a fresh greeting, a short follow-up and a long history turn
+_TURN = (
+    "<|user|>\nCould you tell me about the tea ceremony you learned in Kyoto?<|end|>\n"
+    "<|assistant|>\n*smiles softly* Of course, Master. My grandmother taught me to whisk "
+    "matcha slowly and to serve the bowl with its front facing the guest.<|end|>\n"
+)
+PROMPT_SET = [
+    "<|system|>\nYou are Yuna Aisaka, a devoted maid from Kyoto.<|end|>\n<|user|>\nGood morning, Yuna!<|end|>\n<|assistant|>\n",
+    "<|system|>\nYou are Yuna Aisaka, a devoted maid from Kyoto.<|end|>\n" + _TURN * 3
+    + "<|user|>\nWhat should we cook tonight?<|end|>\n<|assistant|>\n",
+    "<|system|>\nYou are Yuna Aisaka, a devoted maid from Kyoto.<|end|>\n" + _TURN * 14
+    + "<|user|>\nPlease summarise what we talked about.<|end|>\n<|assistant|>\n",
+]
+
+
+# --- Profiles ---
+def profile_path(host=None):
+    return os.path.join(PROFILE_DIR, f"{host or socket.gethostname()}.json")
+
+
+def _model_identity(model_path):
+    try:
+        return {"model_path": os.path.abspath(model_path), "model_size": os.path.getsize(model_path)}
+    except OSError:
+        return {"model_path": os.path.abspath(model_path), "model_size": None}
+
+
+def load_profile(model_path):
+    """Tuned Llama kwargs for this host and model, or None to keep the built-in defaults."""
+    try:
+        with open(profile_path(), encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    identity = _model_identity(model_path)
+    if {k: profile.get(k) for k in identity} != identity:
+        print("ℹ️ Autotune profile was made for a different model file; using defaults")
+        return None
+    return dict(profile["params"])
+
+
+# --- Trials ---
+def _run_trial(model_path, params, results):
+    """Child process: load with `params`, measure prefill/decode speed and peak RSS."""
+    import resource
+
+    from llama_cpp import Llama
+
+    try:
+        start = time.perf_counter()
+        llm = Llama(model_path=model_path, n_gpu_layers=0, seed=42, verbose=False, **params)
+        load_seconds = time.perf_counter() - start
+
+        prompts = [llm.tokenize(p.encode("utf-8"), add_bos=True, special=True) for p in PROMPT_SET]
+        limit = llm.n_ctx() - DECODE_TOKENS - 1
+        prompts = [tokens[:limit] for tokens in prompts]
+
+        # Fault the mmap'd weights in before timing anything
+        llm.reset()
+        llm.eval(prompts[0][:8])
+
+        prefill_tokens = 0
+        prefill_seconds = 0.0
+        for tokens in prompts:
+            llm.reset()
+            start = time.perf_counter()
+            llm.eval(tokens)
+            prefill_seconds += time.perf_counter() - start
+            prefill_tokens += len(tokens)
+
+        # Decode a fixed number of tokens after the longest prompt (EOS suppressed)
+        generated = 0
+        first_at = None
+        for _ in llm(
+            prompts[-1], max_tokens=DECODE_TOKENS, stream=True, temperature=0.0,
+            logit_bias={llm.token_eos(): -100.0}
+        ):
+            generated += 1
+            if first_at is None:
+                first_at = time.perf_counter()
+        decode_seconds = time.perf_counter() - first_at if first_at else 0.0
+
+        results.put({
+            "params": params,
+            "load_seconds": round(load_seconds, 2),
+            "prefill_tps": round(prefill_tokens / prefill_seconds, 1),
+            "decode_tps": round((generated - 1) / decode_seconds, 2) if generated > 1 else 0.0,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        })
+    except Exception as e:
+        results.put({"params": params, "error": str(e)[:200]})
+
+
+def run_trial(model_path, params):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_trial, args=(model_path, params, results))
+    process.start()
+    try:
+        return results.get(timeout=TRIAL_TIMEOUT_SECONDS)
+    except Exception:
+        return {"params": params, "error": "timed out or crashed"}
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+
+
+def choose(results, max_rss=None):
+    """
+    Best config among those that fit `max_rss`: the fastest decoder, preferring
+    a smaller context and then faster prefill among configs within DECODE_TOLERANCE.
+    `load_model` only uses the profile's n_ctx when the caller didn't pick one.
+    """
+    usable = [r for r in results if "error" not in r and (max_rss is None or r["peak_rss_bytes"] <= max_rss)]
+    if not usable:
+        return None
+    best_decode = max(r["decode_tps"] for r in usable)
+    fast = [r for r in usable if r["decode_tps"] >= best_decode * (1 - DECODE_TOLERANCE)]
+    return max(fast, key=lambda r: (-r["params"]["n_ctx"], r["prefill_tps"]))
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def default_threads():
+    import psutil
+
+    physical = psutil.cpu_count(logical=False) or os.cpu_count() or 4
+    logical = os.cpu_count() or physical
+    return sorted({max(1, physical // 2), physical, logical, 6})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.environ.get("YUNA_MODEL_PATH", DEFAULT_MODEL_PATH))
+    parser.add_argument("--threads", type=_int_list, help="comma-separated thread counts")
+    parser.add_argument("--batch", type=_int_list, default=DEFAULT_BATCHES, help="comma-separated n_batch values")
+    parser.add_argument("--kv", default=",".join(DEFAULT_KV_TYPES), help=f"KV cache types ({', '.join(KV_TYPES)})")
+    parser.add_argument("--ctx", type=_int_list, default=DEFAULT_CONTEXTS, help="comma-separated n_ctx values")
+    parser.add_argument("--quick", action="store_true", help="only sweep threads and batch (f16 KV, 2048 ctx)")
+    parser.add_argument("--max-rss-mb", type=int, help="skip configs whose peak RSS exceeds this")
+    parser.add_argument("--dry-run", action="store_true", help="print the results without writing a profile")
+    args = parser.parse_args()
+
+    threads = args.threads or default_threads()
+    kv_types = ["f16"] if args.quick else [k for k in args.kv.split(",") if k]
+    contexts = [2048] if args.quick else args.ctx
+    for kv in kv_types:
+        if kv not in KV_TYPES:
+            parser.error(f"unknown KV type {kv!r}")
+
+    grid = [
+        {"n_threads": t, "n_batch": b, "n_ctx": c, **KV_TYPES[kv]}
+        for c in contexts for kv in kv_types for t in threads for b in args.batch
+    ]
+    print(f"🎛️ Autotuning {os.path.basename(args.model)} on {socket.gethostname()}: {len(grid)} configs")
+
+    results = []
+    for i, params in enumerate(grid, 1):
+        result = run_trial(args.model, params)
+        results.append(result)
+        if "error" in result:
+            print(f"[{i}/{len(grid)}] {params} ❌ {result['error']}")
+        else:
+            print(
+                f"[{i}/{len(grid)}] {params} prefill {result['prefill_tps']} tok/s, "
+                f"decode {result['decode_tps']} tok/s, peak RSS {result['peak_rss_bytes'] // 2**20} MB"
+            )
+
+    max_rss = args.max_rss_mb * 2**20 if args.max_rss_mb else None
+    best = choose(results, max_rss)
+    if best is None:
+        print("💀 No configuration loaded successfully; keeping the built-in defaults")
+        sys.exit(1)
+    print(f"🏆 Best: {best['params']} ({best['decode_tps']} tok/s decode, {best['prefill_tps']} tok/s prefill)")
+
+    if args.dry_run:
+        return
+    profile = {
+        "host": socket.gethostname(),
+        **_model_identity(args.model),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "params": best["params"],
+        "best": best,
+        "results": results,
+    }
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(profile_path(), "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    print(f"💾 Profile written to {profile_path()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Offline batch runs (e.g. persona regression sets) on the inference scheduler.
+
+Items are JSONL objects `{"id", "user_input", "history"?, "route"?}`. Nothing
+is stored: no conversation rows, summaries, session snapshots or response
+cache entries. Items are ordered so those sharing a history run back to back
+on the same replica, where the prompt prefix still in the KV cache is reused
+and only each new question is evaluated. The ordered items are cut into small
+chunks, each one scheduler job, so interactive /chat requests queue between
+chunks instead of behind the whole batch. Results come back in completion
+order with per-item timing, followed by a summary record.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from scheduler import SchedulerFull
+from yuna_engine import EventReply, generate_events, history_messages
+
+# --- Batch Configuration ---
+BATCH_MAX_ITEMS = int(os.environ.get("YUNA_BATCH_MAX_ITEMS", "10000"))
+BATCH_CHUNK_ITEMS = int(os.environ.get("YUNA_BATCH_CHUNK", "8"))  # items per scheduler job
+RESUBMIT_SECONDS = 0.5  # back-off while the scheduler queue is full
+
+_DONE = object()
+
+
+def parse_items(lines, max_items=BATCH_MAX_ITEMS):
+    """Validated batch items from JSONL lines; raises ValueError naming the bad line."""
+    items = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"line {number}: invalid JSON ({e.msg})")
+        if not isinstance(data, dict) or not isinstance(data.get("user_input"), str):
+            raise ValueError(f"line {number}: expected an object with a string user_input")
+        history = data.get("history") or []
+        if not isinstance(history, list) or not all(
+            isinstance(turn, dict) and isinstance(turn.get("user"), str) and isinstance(turn.get("ai"), str)
+            for turn in history
+        ):
+            raise ValueError(f"line {number}: history must be a list of {{\"user\", \"ai\"}} turns")
+        items.append({
+            "index": len(items),
+            "id": data.get("id", len(items)),
+            "user_input": data["user_input"],
+            "history": history,
+            "route": data.get("route", "chat"),
+        })
+        if len(items) > max_items:
+            raise ValueError(f"more than {max_items} items")
+    if not items:
+        raise ValueError("no items")
+    return items
+
+
+def plan_chunks(items, chunk_items=BATCH_CHUNK_ITEMS, model_for=None):
+    """
+    `(model, items)` chunks in prefix order: items with the same model and
+    history are adjacent, so each one extends the context its predecessor
+    left behind. `model_for(item)` picks the model (None without the router).
+    """
+    def key(item):
+        return item["model"] or "", [(turn["user"], turn["ai"]) for turn in item["history"]], item["user_input"]
+
+    for item in items:
+        item["model"] = model_for(item) if model_for else None
+    ordered = sorted(items, key=key)
+
+    chunks = []
+    for item in ordered:
+        if chunks and chunks[-1][0] == item["model"] and len(chunks[-1][1]) < chunk_items:
+            chunks[-1][1].append(item)
+        else:
+            chunks.append((item["model"], [item]))
+    return chunks
+
+
+def run_batch(slot, items):
+    """Scheduler job: generate each item on `slot`, yielding one result record per item."""
+    for item in items:
+        reply = EventReply()
+        for event in generate_events(slot, history_messages(item["history"], item["user_input"]), remember=False):
+            reply.add(event)
+        yield {
+            "index": item["index"],
+            "id": item["id"],
+            "reply": reply.text.strip(),
+            "corrected": reply.corrected,
+            "model": item["model"],
+            "finish_reason": reply.done["finish_reason"],
+            **reply.done["usage"],
+            **reply.done["timing"],
+        }
+
+
+def run_batch_on_model(registry, model, items):
+    """Router-mode scheduler job: `run_batch` on one model of the registry."""
+    with registry.acquire(model) as slot:
+        yield from run_batch(slot, items)
+
+
+class BatchRun:
+    """
+    Feeds a batch's chunks to the scheduler, at most `lanes` at a time (one
+    per worker), and yields result records as they finish, then a summary.
+    `submit(model, items)` queues one chunk and returns its InferenceJob (or
+    any iterable of result records).
+    Closing the iterator early cancels the chunks still running.
+    """
+
+    def __init__(self, chunks, submit, lanes=1):
+        self.chunks = chunks
+        self.submit = submit
+        self.lanes = max(1, min(lanes, len(chunks)))
+        self._next = iter(chunks)
+        self._next_lock = threading.Lock()
+        self._results = queue.Queue()
+        self._cancelled = threading.Event()
+
+    def _take(self):
+        with self._next_lock:
+            return next(self._next, None)
+
+    def _lane(self):
+        try:
+            while not self._cancelled.is_set():
+                chunk = self._take()
+                if chunk is None:
+                    return
+                job = self._submit(*chunk)
+                if job is None:
+                    return
+                for result in job:
+                    result["queue_wait_ms"] = getattr(job, "queue_wait_ms", None)
+                    self._results.put(result)
+                    if self._cancelled.is_set():
+                        break
+        finally:
+            self._results.put(_DONE)
+
+    def _submit(self, model, items):
+        while not self._cancelled.is_set():
+            try:
+                return self.submit(model, items)
+            except SchedulerFull:
+                time.sleep(RESUBMIT_SECONDS)
+        return None
+
+    def __iter__(self):
+        started_at = time.perf_counter()
+        expected = sum(len(items) for _, items in self.chunks)
+        summary = {
+            "items": 0, "missing": 0, "corrected": 0, "prompt_tokens": 0, "reused_tokens": 0, "completion_tokens": 0
+        }
+        for _ in range(self.lanes):
+            threading.Thread(target=self._lane, name="batch-lane", daemon=True).start()
+        try:
+            running = self.lanes
+            while running:
+                result = self._results.get()
+                if result is _DONE:
+                    running -= 1
+                    continue
+                summary["items"] += 1
+                summary["corrected"] += result["corrected"]
+                for field in ("prompt_tokens", "reused_tokens", "completion_tokens"):
+                    summary[field] += result[field]
+                yield result
+        finally:
+            self._cancelled.set()
+
+        seconds = time.perf_counter() - started_at
+        # Items lost to a failed job (see the server log) are counted, not silently dropped
+        summary["missing"] = expected - summary["items"]
+        summary["seconds"] = round(seconds, 3)
+        summary["items_per_second"] = round(summary["items"] / seconds, 2) if seconds else None
+        yield {"summary": summary}
+
+    def jsonl(self):
+        """The results (and summary) as JSONL lines."""
+        for record in self:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
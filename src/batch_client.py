@@ -0,0 +1,100 @@
+"""
+Run a JSONL prompt set through Yuna and write the results as JSONL.
+
+Each input line is `{"id", "user_input", "history"?, "route"?}`; each output
+line is the reply with its usage and timing (`ttft_ms`, `decode_ms`, `post_ms`,
+`total_ms`, `queue_wait_ms`, prompt, reused and completion tokens), in
+completion order, followed by a summary record.
+Nothing is stored in the conversation DB.
+
+    python batch_client.py prompts.jsonl -o results.jsonl
+    python batch_client.py prompts.jsonl --url http://gpu-box:5000/chat/batch
+    python batch_client.py prompts.jsonl --embedded     # load the model in-process
+"""
+import argparse
+import json
+import os
+import sys
+
+import requests
+
+# --- Batch Client Configuration ---
+YUNA_BATCH_URL = os.environ.get("YUNA_BATCH_URL", "http://localhost:5000/chat/batch")
+REQUEST_TIMEOUT = (3.05, 600)  # connect, then at most 10 minutes between result lines
+
+
+def remote_results(url, lines):
+    """Result lines streamed back from a running service"""
+    body = "".join(line if line.endswith("\n") else line + "\n" for line in lines)
+    with requests.post(
+        url, data=body.encode("utf-8"), headers={"Content-Type": "application/x-ndjson"},
+        stream=True, timeout=REQUEST_TIMEOUT
+    ) as response:
+        if response.status_code != 200:
+            sys.exit(f"💀 Batch rejected ({response.status_code}): {response.text[:200]}")
+        for line in response.iter_lines(decode_unicode=True):
+            if line:
+                yield line + "\n"
+
+
+def embedded_results(lines):
+    """Result lines from an in-process engine (needs llama_cpp and the model file locally)"""
+    from batch import BatchRun, parse_items, plan_chunks, run_batch
+    from yuna_engine import YunaEngine
+
+    try:
+        items = parse_items(lines)
+    except ValueError as e:
+        sys.exit(f"💀 Invalid batch: {e}")
+    engine = YunaEngine(verbose=False)
+
+    def run_chunk(model, chunk):
+        # Chunks run on the calling lane itself, one at a time
+        with engine.lock:
+            yield from run_batch(engine.slot, chunk)
+
+    yield from BatchRun(plan_chunks(items), run_chunk).jsonl()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prompts", help="JSONL prompt file ('-' for stdin)")
+    parser.add_argument("-o", "--output", help="JSONL results file (default: stdout)")
+    parser.add_argument("--url", default=YUNA_BATCH_URL, help="the service's /chat/batch endpoint")
+    parser.add_argument("--embedded", action="store_true", help="run the model in this process instead")
+    args = parser.parse_args()
+
+    if args.prompts == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.prompts, encoding="utf-8") as f:
+            lines = f.readlines()
+    results = embedded_results(lines) if args.embedded else remote_results(args.url, lines)
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    done = 0
+    try:
+        for line in results:
+            out.write(line)
+            record = json.loads(line)
+            if "summary" in record:
+                summary = record["summary"]
+                print(
+                    f"✅ {summary['items']} prompts in {summary['seconds']}s "
+                    f"({summary['items_per_second']}/s, {summary['reused_tokens']} of "
+                    f"{summary['prompt_tokens']} prompt tokens reused, {summary['missing']} missing)",
+                    file=sys.stderr
+                )
+            else:
+                done += 1
+                if done % 100 == 0:
+                    print(f"📦 {done} prompts done", file=sys.stderr)
+    except requests.exceptions.RequestException as e:
+        sys.exit(f"❌ Could not reach the Yuna service: {str(e)[:100]}")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
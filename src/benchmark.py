@@ -0,0 +1,441 @@
+"""
+Micro-benchmarks for the service and client hot paths.
+
+Runs against a stub `Llama` (no model file needed) that tokenizes by words
+and emits reply tokens at `--token-rate` tokens/second, and against an
+in-memory stand-in for the conversations table.
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json [--tolerance 0.15]
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import zlib
+from datetime import datetime
+
+# --- Benchmark Configuration ---
+HISTORY_LENGTHS = [0, 10, 50, 200, 1000]  # messages of prior conversation
+HISTORY_FILE_TURNS = [100, 1000, 10000]
+DEFAULT_TOKEN_RATE = 0.0  # stub decode speed in tokens/s; 0 = as fast as possible
+DEFAULT_TOLERANCE = 0.15  # relative slowdown reported as a regression
+
+STUB_REPLY = (
+    "*smiles softly* Welcome back, Master. I have prepared some green tea and "
+    "a few sweets from the shop near the station. Shall I bring them to the "
+    "study, or would you prefer to rest in the garden for a while?"
+)
+SAMPLE_TURNS = [
+    ("How was your day, Yuna?", "*bows* It was peaceful, Master. I tidied the library and aired the futons."),
+    ("Can you recommend a book?", "*thinks for a moment* Perhaps Kokoro by Natsume Soseki, Master. It is quiet but moving."),
+    ("I'm a bit tired today.", "*gently* Then please rest, Master. I will make some warm barley tea for you."),
+]
+
+
+# --- Stub Model ---
+_STUB_TOKEN = re.compile(rb"<\|\w+\|>|\s*[^\s<]+|\s+|<")
+
+
+class StubState:
+    def __init__(self, input_ids):
+        self.input_ids = input_ids
+        self.llama_state_size = 1024 * len(input_ids)  # rough KV bytes per token
+        self.scores = None
+
+
+class StubLlama:
+    """
+    Just enough of `llama_cpp.Llama` for the service: word-level tokenization,
+    an input-id buffer for prefix reuse and a streamed canned reply.
+    """
+
+    token_rate = DEFAULT_TOKEN_RATE
+
+    def __init__(self, model_path=None, n_ctx=2048, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.input_ids = []
+        self.n_tokens = 0
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [1] if add_bos else []
+        tokens.extend(zlib.crc32(piece) % 32000 + 2 for piece in _STUB_TOKEN.findall(text))
+        return tokens
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def save_state(self):
+        return StubState(list(self._input_ids))
+
+    def load_state(self, state):
+        self.input_ids = list(state.input_ids)
+        self.n_tokens = len(self.input_ids)
+
+    def __call__(self, prompt, max_tokens=16, stream=False, **kwargs):
+        self.eval(prompt[self.n_tokens:])
+        pieces = re.findall(r"\s*\S+", STUB_REPLY)[:max_tokens]
+        if not stream:
+            return {"choices": [{"text": "".join(pieces)}]}
+        return self._stream(pieces)
+
+    def token_eos(self):
+        return 0
+
+    def sample(self, token=0, **kwargs):
+        # Called per reply token like Llama.generate does, so sampled ids can be recorded
+        return token
+
+    def _stream(self, pieces):
+        delay = 1.0 / self.token_rate if self.token_rate else 0.0
+        for piece in pieces:
+            if delay:
+                time.sleep(delay)
+            self.sample(token=zlib.crc32(piece.encode("utf-8")) % 32000 + 2)
+            yield {"choices": [{"text": piece, "finish_reason": None}]}
+        self.sample(token=0)  # end of turn
+        yield {"choices": [{"text": "", "finish_reason": "stop"}]}
+
+
+def install_stub_llama():
+    """Make `from llama_cpp import Llama` resolve to the stub."""
+    module = types.ModuleType("llama_cpp")
+    module.Llama = StubLlama
+    sys.modules["llama_cpp"] = module
+
+
+# --- In-Memory Conversation Store ---
+class InMemoryConversationDB:
+    """
+    Stand-in for YunaMemoryDB for the persistence benchmarks. Rows are grouped
+    per (user_id, session_id) like the table's index, so lookups cost O(limit).
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.summaries = {}
+        self.rows = 0
+
+    def save_message(self, user_id, session_id, role, message):
+        self.save_messages([(user_id, session_id, role, message, datetime.now())])
+
+    def save_messages(self, rows):
+        for user_id, session_id, role, message, created_at in rows:
+            self.sessions.setdefault((user_id, session_id), []).append(
+                {"role": role, "message": message, "created_at": created_at}
+            )
+        self.rows += len(rows)
+
+    def get_recent_messages(self, user_id, limit=10, session_id=None):
+        rows = self.sessions.get((user_id, session_id), [])
+        return [dict(row) for row in reversed(rows[-limit:])]
+
+    def get_messages_after(self, user_id, session_id=None, after=None):
+        rows = self.sessions.get((user_id, session_id), [])
+        return [dict(row) for row in rows if after is None or row["created_at"] > after]
+
+    def get_latest_summary(self, user_id, session_id=None):
+        return self.summaries.get((user_id, session_id))
+
+    def save_summary(self, user_id, session_id, summary, covered_until, message_count):
+        self.summaries[(user_id, session_id)] = {
+            "summary": summary, "covered_until": covered_until, "message_count": message_count
+        }
+
+    def stats(self):
+        return {"rows": self.rows}
+
+
+# --- Measurement ---
+def measure(fn, min_time=0.2, max_runs=10000):
+    """Call `fn` repeatedly for about `min_time` seconds; per-call timings in microseconds."""
+    fn()  # warm caches and lazy imports
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_runs and (len(samples) < 5 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return {
+        "runs": len(samples),
+        "median_us": round(statistics.median(samples), 2),
+        "mean_us": round(statistics.fmean(samples), 2),
+        "min_us": round(min(samples), 2),
+    }
+
+
+def make_messages(system_prompt, history_length, user_input="Could you make some tea, please?"):
+    messages = [{"role": "system", "content": system_prompt}]
+    for i in range(history_length // 2):
+        user, reply = SAMPLE_TURNS[i % len(SAMPLE_TURNS)]
+        messages.append({"role": "user", "content": f"{user} ({i})"})
+        messages.append({"role": "assistant", "content": f"{reply} ({i})"})
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+
+def make_history_file_turns(turns):
+    history = []
+    for i in range(turns):
+        user, reply = SAMPLE_TURNS[i % len(SAMPLE_TURNS)]
+        history.append({"user": f"{user} ({i})", "ai": f"{reply} ({i})"})
+    return history
+
+
+# --- Benchmarks ---
+def bench_service(results, min_time):
+    import yuna_engine
+    import yuna_service
+
+    while not yuna_service.ready.wait(0.1):
+        if yuna_service.startup["state"] == "failed":
+            sys.exit(f"💀 Service failed to start: {yuna_service.startup['error']}")
+    slot = yuna_service.slots[0]
+    builder = slot.prompt_builder
+
+    for length in HISTORY_LENGTHS:
+        messages = make_messages(yuna_service.SYSTEM_PROMPT, length)
+        pruned = builder.build(messages).pruned_messages
+
+        def cold():
+            builder._cache.clear()
+            builder.build(messages)
+
+        results[f"prompt_build/cold/h{length}"] = dict(measure(cold, min_time), pruned=pruned)
+        results[f"prompt_build/warm/h{length}"] = dict(
+            measure(lambda: builder.build(messages), min_time), pruned=pruned
+        )
+
+    # Whole generate_stream (build, prefix restore, guarded decode) on a follow-up turn
+    for length in (10, 200):
+        messages = make_messages(yuna_service.SYSTEM_PROMPT, length)
+
+        def generate():
+            for _ in yuna_service.generate_stream(slot, messages):
+                pass
+
+        results[f"generate_stream/h{length}"] = measure(generate, min_time)
+
+    messages = make_messages(yuna_service.SYSTEM_PROMPT, 10)
+
+    def time_to_first_token():
+        stream = yuna_service.generate_stream(slot, messages)
+        next(stream)
+        stream.close()
+
+    results["generate_stream/ttft/h10"] = measure(time_to_first_token, min_time)
+
+    def generate_events():
+        for _ in yuna_engine.generate_events(slot, messages):
+            pass
+
+    results["generate_events/h10"] = measure(generate_events, min_time)
+
+    # A regression set: 8 questions on each of 6 histories, run as one batch
+    # (prefix-ordered, chunked on the scheduler) vs one generate_stream per prompt
+    batch_lines = [
+        json.dumps({"id": f"{h}-{q}", "user_input": f"Question {q}?", "history": make_history_file_turns(5 + h)})
+        for q in range(8) for h in range(6)
+    ]
+
+    def batch():
+        for _ in yuna_service.batch_run(batch_lines):
+            pass
+
+    def sequential():
+        for line in batch_lines:
+            item = json.loads(line)
+            for _ in yuna_service.generate_stream(
+                slot, yuna_engine.history_messages(item["history"], item["user_input"])
+            ):
+                pass
+
+    results["batch/run/n48"] = measure(batch, min_time)
+    results["batch/sequential/n48"] = measure(sequential, min_time)
+
+    clean = STUB_REPLY * 4
+    broken = STUB_REPLY * 4 + " As an AI language model, I cannot do that."
+    results["enforce_character/clean"] = measure(lambda: yuna_engine.enforce_character(clean), min_time)
+    results["enforce_character/broken"] = measure(lambda: yuna_engine.enforce_character(broken), min_time)
+    return yuna_service
+
+
+def bench_persistence(results, service, min_time, spill_dir):
+    from message_writer import WriteBehindWriter
+    from session_cache import SessionHistoryCache
+    from summarizer import SessionSummarizer
+
+    db = InMemoryConversationDB()
+    for session_id in range(200):
+        for i in range(20):
+            user, reply = SAMPLE_TURNS[i % len(SAMPLE_TURNS)]
+            db.save_message("master", session_id, "user", user)
+            db.save_message("master", session_id, "yuna", reply)
+
+    writer = WriteBehindWriter(db, spill_path=os.path.join(spill_dir, "spill.jsonl"))
+    cache = SessionHistoryCache(writer)
+
+    results["memory_db/get_recent_messages"] = measure(
+        lambda: db.get_recent_messages("master", limit=10, session_id=7), min_time
+    )
+    sink = WriteBehindWriter(InMemoryConversationDB(), spill_path=os.path.join(spill_dir, "sink.jsonl"))
+    results["write_behind/save_message"] = measure(
+        lambda: sink.save_message("master", 9999, "user", "Good morning, Yuna."), min_time
+    )
+    sink.close()
+    results["write_behind/get_recent_messages"] = measure(
+        lambda: writer.get_recent_messages("master", limit=10, session_id=7), min_time
+    )
+    results["session_cache/hit"] = measure(
+        lambda: cache.get_recent_messages("master", limit=10, session_id=7), min_time
+    )
+
+    misses = iter(range(10 ** 9))
+    results["session_cache/miss"] = measure(
+        lambda: cache.get_recent_messages("master", limit=10, session_id=1000 + next(misses) % 100000), min_time
+    )
+
+    # build_messages over the cached store (DB-backed history, no frontend history)
+    service.history_cache = cache
+    service.summarizer = SessionSummarizer(db, writer, service.scheduler)
+    payload = {"user_input": "Could you make some tea, please?", "session_id": 7}
+    results["build_messages/db_history"] = measure(lambda: service.build_messages(payload), min_time)
+    writer.close()
+
+
+def bench_client(results, min_time, history_dir):
+    import chat_client
+
+    text = "*curtsies* <break time='200ms'/> Welcome home, Master~ 💖 " + STUB_REPLY
+    results["client/clean_speech_text"] = measure(lambda: chat_client.clean_speech_text(text), min_time)
+    results["client/validate_response"] = measure(lambda: chat_client.validate_response(STUB_REPLY), min_time)
+
+    chat_client.LEGACY_HISTORY_FILE = os.path.join(history_dir, "missing.json")
+
+    def startup():
+        log = chat_client.open_history()
+        chat_client.load_history(log)
+        log.close()
+
+    for turns in HISTORY_FILE_TURNS:
+        history = make_history_file_turns(turns)
+        chat_client.HISTORY_FILE = os.path.join(history_dir, f"history-{turns}.jsonl")
+        log = chat_client.open_history()
+        log.import_turns(history[:-1])
+        results[f"client/append_turn/t{turns}"] = measure(
+            lambda: chat_client.save_turn(log, history[-1]), min_time, max_runs=1000
+        )
+        log.close()
+        results[f"client/load_history/t{turns}"] = measure(startup, min_time)
+
+
+# --- Baselines ---
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, tolerance):
+    """Print per-benchmark median changes; returns the names that regressed."""
+    regressions = []
+    print(f"{'benchmark':45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:45} {'-':>12} {result['median_us']:>10.1f}us {'new':>8}")
+            continue
+        change = result["median_us"] / old["median_us"] - 1 if old["median_us"] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = " ⚠️"
+        print(f"{name:45} {old['median_us']:>10.1f}us {result['median_us']:>10.1f}us {change:>+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative median slowdown counted as a regression")
+    parser.add_argument("--token-rate", type=float, default=DEFAULT_TOKEN_RATE,
+                        help="stub decode speed in tokens/s (0 = unthrottled)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds spent per benchmark")
+    args = parser.parse_args()
+
+    # Keep the service self-contained: stub model, no embeddings, no response cache
+    install_stub_llama()
+    StubLlama.token_rate = args.token_rate
+    os.environ["YUNA_EMBED_MODEL"] = ""
+    os.environ["YUNA_RESPONSE_CACHE"] = "off"
+    os.environ["YUNA_MAX_CONCURRENCY"] = "1"
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        os.environ["YUNA_SESSION_STATE"] = "1"
+        os.environ["YUNA_SESSION_STATE_DIR"] = os.path.join(scratch, "session_state")
+        service = bench_service(results, args.min_time)
+        bench_persistence(results, service, args.min_time, scratch)
+        bench_client(results, args.min_time, scratch)
+        for cache in service.all_caches():
+            cache.close()
+
+    current = {
+        "meta": {
+            "revision": git_revision(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "token_rate": args.token_rate,
+        },
+        "results": results,
+    }
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"📊 Comparing against {args.compare} ({baseline['meta'].get('revision')})")
+        regressions = compare(baseline, current, args.tolerance)
+    else:
+        regressions = []
+        for name, result in results.items():
+            print(f"{name:45} {result['median_us']:>10.1f}us  ({result['runs']} runs)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        print(f"💾 Baseline written to {args.output}")
+
+    if regressions:
+        print(f"⚠️ {len(regressions)} benchmark(s) slower than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+# --- Canned Phrases ---
+# Fixed lines spoken by the client or sent by the service. Kept in one place so
+# the client can pre-render their audio (`chat_client.py --prewarm-audio`).
+
+GREETINGS = [
+    "*bows politely* Welcome home, Master! How may I serve you today?",
+    "*adjusts apron* Good to see you, Master. Shall I prepare some tea?",
+    "*curtsies* Master has returned! How may Yuna assist you?",
+]
+FAREWELL = "*curtsies* I shall await your return, Master. Please take care!"
+INTERRUPTED_FAREWELL = "*bows deeply* It seems Master wishes to leave. Please take care!"
+TIMEOUT_FALLBACK = "*bows apologetically* Forgive me Master, I need a moment to collect myself."
+CLIENT_CORRECTION = "*adjusts apron* My apologies Master, I seemed to have lost myself for a moment. How may I serve you?"
+
+SERVICE_CORRECTION = "*bows apologetically* Forgive me Master, I must have misspoken."
+SERVICE_ERROR_FALLBACK = "*bows apologetically* Forgive me Master, I encountered an issue. How may I assist you?"
+
+ALL_PHRASES = GREETINGS + [
+    FAREWELL,
+    INTERRUPTED_FAREWELL,
+    TIMEOUT_FALLBACK,
+    CLIENT_CORRECTION,
+    SERVICE_CORRECTION,
+    SERVICE_ERROR_FALLBACK,
+]
+
+# Marks a correction in the plain text stream (never spoken); text after it replaces the reply
+CORRECTION_NOTICE = "[Character correction applied]"
@@ -0,0 +1,126 @@
+import re
+from collections import deque
+
+# --- Character Guard ---
+# Phrases that mean the model has dropped the Yuna persona. Shared by the
+# service's stream guard and the client's `validate_response`.
+FORBIDDEN_PHRASES = [
+    "as an ai", "i am an ai", "language model", "training data",
+    "knowledge cutoff", "i cannot", "i'm unable to",
+    "my training", "i don't have feelings", "my knowledge cutoff",
+]
+
+# Models often emit typographic apostrophes; fold them so "I’m unable to" matches
+_FOLD = {"’": "'", "‘": "'"}
+_FOLD_TABLE = str.maketrans(_FOLD)
+
+
+def _fold(ch):
+    ch = _FOLD.get(ch, ch)
+    lowered = ch.lower()
+    return lowered if len(lowered) == 1 else ch
+
+
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton over a fixed set of case-insensitive phrases.
+
+    Matching is one dict lookup per character whatever the number of phrases,
+    and the state carries across calls, so text can be fed token by token.
+    Whole texts are checked with an equivalent compiled pattern instead, which
+    runs the scan in C.
+    """
+
+    def __init__(self, phrases):
+        self.phrases = [p.lower() for p in phrases]
+        self._pattern = re.compile("|".join(re.escape(p) for p in self.phrases))
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._output = [None]  # a phrase that ends at this state, if any
+
+        for phrase in self.phrases:
+            state = 0
+            for ch in phrase:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._output.append(None)
+                    self._goto[state][ch] = nxt
+                state = nxt
+            if self._output[state] is None:
+                self._output[state] = phrase
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                if self._output[nxt] is None:
+                    self._output[nxt] = self._output[self._fail[nxt]]
+                queue.append(nxt)
+
+    def step(self, state, ch):
+        """Advance one character; returns the new state."""
+        ch = _fold(ch)
+        while state and ch not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(ch, 0)
+
+    def search(self, text):
+        """A forbidden phrase found in `text`, or None."""
+        match = self._pattern.search(text.translate(_FOLD_TABLE).lower())
+        return match.group() if match else None
+
+    def scanner(self):
+        return StreamScanner(self)
+
+
+class StreamScanner:
+    """
+    Incremental matcher for one streamed reply.
+
+    `feed()` returns the text that can no longer be part of a forbidden phrase;
+    characters that could still start one are held back, so a match is caught
+    before any of it reaches the client. `flush()` releases the remainder.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.state = 0
+        self.match = None
+        self._held = ""
+
+    def feed(self, text):
+        if self.match is not None:
+            return ""
+        matcher = self.matcher
+        state = self.state
+        for i, ch in enumerate(text):
+            state = matcher.step(state, ch)
+            if matcher._output[state] is not None:
+                self.match = matcher._output[state]
+                self.state = state
+                # Release only what came before the matched phrase
+                start = len(self._held) + i + 1 - len(self.match)
+                released = (self._held + text)[:max(start, 0)]
+                self._held = ""
+                return released
+        self.state = state
+        pending = self._held + text
+        depth = matcher._depth[state]
+        self._held = pending[len(pending) - depth:] if depth else ""
+        return pending[:len(pending) - depth]
+
+    def flush(self):
+        held, self._held = self._held, ""
+        return "" if self.match is not None else held
+
+
+CHARACTER_GUARD = PhraseMatcher(FORBIDDEN_PHRASES)
@@ -2,34 +2,50 @@ import requests
 import json
 import os
 import sys
-import threading
-import subprocess
 import re
 import time
+import zlib
+from contextlib import closing
+from requests.adapters import HTTPAdapter
+from audio_cache import AudioCache, CachedVoice
+from canned_phrases import (
+    ALL_PHRASES, CLIENT_CORRECTION, CORRECTION_NOTICE, FAREWELL, GREETINGS, INTERRUPTED_FAREWELL, TIMEOUT_FALLBACK
+)
+from character_guard import CHARACTER_GUARD
+from history_log import HistoryLog
+from voice_engine import PcmBuffer, VoiceWorker, load_voice, open_sink
 
 # --- Configuration ---
 YUNA_API_URL = "http://127.0.0.1:5000/chat"
 HEALTH_CHECK_URL = "http://127.0.0.1:5000/health"
-HISTORY_FILE = "yuna_chat_history.json"
-MAX_HISTORY_TURNS = 5  # Reduced to prevent context issues
+READY_CHECK_URL = "http://127.0.0.1:5000/ready"
+READY_TIMEOUT_SECONDS = 300  # the service loads the model in the background after starting
+# "text" for the Flask service (plain chunked stream), "sse" for yuna_asgi.py,
+# "ndjson" for the Flask service's framed events (token ids, timing, corrections)
+YUNA_TRANSPORT = os.environ.get("YUNA_TRANSPORT", "text")
+# Host the engine in this process instead of talking to yuna_service (or pass --embedded)
+YUNA_EMBEDDED = os.environ.get("YUNA_EMBEDDED", "0") == "1" or "--embedded" in sys.argv
+REQUEST_TIMEOUT = (3.05, 30)  # connect, then at most 30s between streamed chunks
+HISTORY_FILE = "yuna_chat_history.jsonl"  # append-only log (+ ".zst" with YUNA_HISTORY_ZSTD=1)
+LEGACY_HISTORY_FILE = "yuna_chat_history.json"  # imported once into the log
+# Turns kept and sent with each message; the service picks a window from them
+# that grows a turn per reply and hops back (session_state.HistoryWindows, up
+# to 10 turns), so each prompt extends the session's last KV snapshot
+MAX_HISTORY_TURNS = 10
+# A stable session id per history file, so the service can match this
+# conversation's snapshots (and keep its rows together) across restarts
+SESSION_ID = int(os.environ.get("YUNA_SESSION_ID", "0")) or zlib.crc32(os.path.abspath(HISTORY_FILE).encode("utf-8"))
 VOICE_MODEL_PATH = os.path.expanduser("~/.local/share/piper/voices/en_US/amy/medium/en_US-amy-medium.onnx")
 
 # --- Character Validation ---
 def validate_response(response):
     """Check if response maintains character and fix if needed"""
-    forbidden_phrases = [
-        "as an ai", "i am an ai", "language model", 
-        "my training", "i don't have feelings", "my knowledge cutoff"
-    ]
-    
-    response_lower = response.lower()
-    for phrase in forbidden_phrases:
-        if phrase in response_lower:
-            print("\n⚠️ [Character break detected - applying correction]")
-            return "*adjusts apron* My apologies Master, I seemed to have lost myself for a moment. How may I serve you?"
+    if CHARACTER_GUARD.search(response) is not None:
+        print("\n⚠️ [Character break detected - applying correction]")
+        return CLIENT_CORRECTION
     
     # Ensure Master is used
-    if "master" not in response_lower and len(response) > 20:
+    if "master" not in response.lower() and len(response) > 20:
         response += ", Master"
     
     return response
@@ -37,7 +53,7 @@ def validate_response(response):
 def clean_speech_text(text):
     """Remove all non-speech elements while preserving Yuna's personality markers"""
     # Remove any character correction notices
-    text = re.sub(r'\[Character correction applied\]', '', text)
+    text = text.replace(CORRECTION_NOTICE, '')
     # Remove XML/SSML tags
     text = re.sub(r'<[^>]+>', '', text)
     # Convert actions to spoken descriptions
@@ -47,85 +63,176 @@ def clean_speech_text(text):
     # Normalize whitespace
     return ' '.join(text.split()).strip()
 
+# --- Streaming Speech ---
+SENTENCE_BOUNDARY = re.compile(r'[.!?…]+["\')\]]*\s+|\n+')
+
+class SentenceSplitter:
+    """Cut streamed text into sentences as soon as each one is complete"""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, chunk):
+        """Add a chunk and return the sentences it completed"""
+        self._buffer += chunk
+        sentences = []
+        start = 0
+        for match in SENTENCE_BOUNDARY.finditer(self._buffer):
+            candidate = self._buffer[start:match.end()]
+            # Never cut inside an *action*, or clean_speech_text can't strip it
+            if candidate.count("*") % 2:
+                continue
+            sentences.append(candidate.strip())
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        return [s for s in sentences if s]
+
+    def flush(self):
+        """Return whatever is left once the stream has ended"""
+        rest, self._buffer = self._buffer.strip(), ""
+        return rest
+
+def load_cached_voice():
+    return CachedVoice(load_voice(VOICE_MODEL_PATH), AudioCache(VOICE_MODEL_PATH))
+
+def iter_speech_sentences(text):
+    """The cleaned sentences `speak(text)` would send to the synthesizer"""
+    splitter = SentenceSplitter()
+    for sentence in splitter.feed(text) + [splitter.flush()]:
+        speech_text = clean_speech_text(sentence)
+        if speech_text:
+            yield speech_text
+
+def prewarm_audio():
+    """Render every canned phrase into the audio cache ahead of time"""
+    voice = load_cached_voice()
+    buffer = PcmBuffer()
+    rendered = 0
+    for phrase in ALL_PHRASES:
+        for sentence in iter_speech_sentences(phrase):
+            if not voice.cache.contains(sentence):
+                voice.synthesize_into(sentence, buffer)
+                rendered += 1
+    print(f"🎵 Audio cache warm: rendered {rendered} new sentences ({voice.cache.stats()})")
+
+class SpeechPipeline:
+    """
+    Speaks sentences in order while the rest of the reply is still streaming.
+
+    Sentences are cleaned here and handed to a long-lived VoiceWorker, which
+    keeps the Piper voice loaded and one audio stream open for the session.
+    Rendered audio is cached on disk, so repeated lines play immediately.
+    `cancel()` (barge-in) drops everything queued and stops playback.
+    """
+
+    def __init__(self):
+        voice = load_cached_voice()
+        self.worker = VoiceWorker(voice, open_sink(voice.sample_rate))
+
+    def say(self, sentence):
+        speech_text = clean_speech_text(sentence)
+        if speech_text:
+            self.worker.say(speech_text)
+
+    def cancel(self):
+        self.worker.cancel()
+
+    def wait(self, timeout=None):
+        """Block until everything queued has been spoken (or cancelled)"""
+        self.worker.wait(timeout)
+
+speech = None
+engine = None  # YunaEngine when running embedded
+
+# One keep-alive connection pool for every request to the service
+http = requests.Session()
+http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
 def speak(text):
-    """Convert text to speech after thorough cleaning"""
-    if not text.strip():
-        return
+    """Speak a complete piece of text, sentence by sentence"""
+    for sentence in iter_speech_sentences(text):
+        speech.worker.say(sentence)
 
-    speech_text = clean_speech_text(text)
-    
-    def play_audio():
-        try:
-            piper_cmd = [
-                "piper",
-                "--model", VOICE_MODEL_PATH,
-                "--output-raw",
-            ]
-            
-            aplay_cmd = [
-                "aplay",
-                "-q",
-                "-r", "22050",
-                "-f", "S16_LE", 
-                "-c", "1",
-                "-"
-            ]
-            
-            piper_proc = subprocess.Popen(
-                piper_cmd,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL
-            )
-            aplay_proc = subprocess.Popen(
-                aplay_cmd,
-                stdin=piper_proc.stdout,
-                stderr=subprocess.DEVNULL
-            )
-            
-            piper_proc.stdin.write(speech_text.encode('utf-8'))
-            piper_proc.stdin.close()
-            aplay_proc.wait()
-            
-        except Exception as e:
-            print(f"\n🔇 Audio Error: {e}")
+# --- Response Transports ---
+def iter_sse_tokens(response):
+    """Yield the `token` event payloads of a Server-Sent Events stream"""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line == "":
+            if data and event in ("token", "message"):
+                yield "\n".join(data)
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            value = line[5:]
+            data.append(value[1:] if value.startswith(" ") else value)
 
-    threading.Thread(target=play_audio, daemon=True).start()
+def iter_ndjson_events(response):
+    """Yield the framed events of an NDJSON stream"""
+    for line in response.iter_lines(decode_unicode=True):
+        if line:
+            yield json.loads(line)
 
-# --- History Management ---
-def save_history(history):
-    """Save conversation history with character validation"""
-    try:
-        # Validate all responses before saving
-        for turn in history:
-            if "ai" in turn:
-                turn["ai"] = validate_response(turn["ai"])
-        
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"⚠️ Couldn't save history: {e}")
+def iter_event_text(events):
+    """Reply text from framed events: tokens verbatim, a stream correction as the notice plus its replacement"""
+    for event in events:
+        kind = event["event"]
+        if kind == "token":
+            yield event["text"]
+        elif kind == "correction" and event["stage"] == "stream":
+            yield f"\n{CORRECTION_NOTICE}\n" + event["replacement"]
+        elif kind == "error":
+            yield event["text"]
 
-def load_history():
-    """Load and validate conversation history"""
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            history = json.load(f)
-            # Validate loaded responses
+def iter_response_chunks(response):
+    """Yield reply text from the service, whichever transport it speaks"""
+    if YUNA_TRANSPORT == "sse":
+        yield from iter_sse_tokens(response)
+    elif YUNA_TRANSPORT == "ndjson":
+        yield from iter_event_text(iter_ndjson_events(response))
+    else:
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            if chunk:
+                yield chunk
+
+# --- History Management ---
+def open_history():
+    """Open the append-only history log, importing the old JSON history file once"""
+    log = HistoryLog(HISTORY_FILE)
+    if len(log) == 0 and os.path.exists(LEGACY_HISTORY_FILE):
+        try:
+            with open(LEGACY_HISTORY_FILE, "r", encoding="utf-8") as f:
+                history = json.load(f)
+            # Validated once here; the log is never re-validated on load
             for turn in history:
                 if "ai" in turn:
                     turn["ai"] = validate_response(turn["ai"])
-            return history
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+            log.import_turns(history)
+            print(f"📜 Imported {len(history)} turns from {LEGACY_HISTORY_FILE}")
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"⚠️ Couldn't import old history: {e}")
+    return log
+
+def load_history(log):
+    """Last MAX_HISTORY_TURNS turns, the only part of the log read at startup"""
+    try:
+        return log.tail(MAX_HISTORY_TURNS)
     except Exception as e:
         print(f"⚠️ Couldn't load history: {e}")
         return []
 
+def save_turn(log, turn):
+    """Append a turn whose reply has already been validated"""
+    try:
+        log.append(turn)
+    except Exception as e:
+        print(f"⚠️ Couldn't save history: {e}")
+
 def check_service_health():
     """Check if the Yuna service is running and properly configured"""
     try:
-        response = requests.get(HEALTH_CHECK_URL, timeout=2)
+        response = http.get(HEALTH_CHECK_URL, timeout=2)
         if response.status_code == 200:
             data = response.json()
             if data.get("character") == "Yuna Aisaka":
@@ -134,31 +241,77 @@ def check_service_health():
         pass
     return False
 
+def wait_until_ready():
+    """Wait for the service to finish loading the model (returns False on timeout or failure)"""
+    deadline = time.time() + READY_TIMEOUT_SECONDS
+    announced = False
+    while time.time() < deadline:
+        try:
+            response = http.get(READY_CHECK_URL, timeout=2)
+            if response.status_code == 200:
+                return True
+            if response.status_code == 404:
+                return True  # older services have no /ready; /health already passed
+            status = response.json()
+            if status.get("state") == "failed":
+                print(f"💀 Yuna service failed to start: {status.get('error')}")
+                return False
+            if not announced:
+                print(f"⏳ Yuna is getting ready ({status.get('state')})...")
+                announced = True
+        except (requests.exceptions.RequestException, ValueError):
+            pass  # busy loading, restarting or answering with a proxy's error page: ask again
+        time.sleep(1)
+    return False
+
+# --- Reply Stream ---
+def start_engine():
+    """Load the engine in-process (needs llama_cpp and the model file locally)"""
+    from yuna_engine import YunaEngine
+
+    print("⚡ Starting Yuna in-process (embedded mode)...")
+    return YunaEngine()
+
+def stream_reply(payload):
+    """Reply chunks from the in-process engine, or streamed from the service over the pooled session"""
+    if engine is not None:
+        yield from iter_event_text(engine.chat(payload['user_input'], payload['history'], payload['session_id']))
+        return
+    with http.post(YUNA_API_URL, json=payload, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        yield from iter_response_chunks(response)
+
 # --- Initial Greeting ---
 def get_greeting():
     """Generate Yuna's greeting"""
-    greetings = [
-        "*bows politely* Welcome home, Master! How may I serve you today?",
-        "*adjusts apron* Good to see you, Master. Shall I prepare some tea?",
-        "*curtsies* Master has returned! How may Yuna assist you?",
-    ]
     import random
-    return random.choice(greetings)
+    return random.choice(GREETINGS)
 
 # --- Main Chat Loop ---
 def main():
+    global speech, engine
+    if "--prewarm-audio" in sys.argv:
+        prewarm_audio()
+        return
+
     print("🌸 Yuna Aisaka - Maid Service Client 🌸")
     print("=" * 50)
     
     # Check service health
-    if not check_service_health():
+    if YUNA_EMBEDDED:
+        engine = start_engine()
+    elif not check_service_health():
         print("⚠️ Warning: Yuna service may not be properly configured")
         print("Please ensure yuna_service.py is running correctly")
         response = input("Continue anyway? (y/n): ")
         if response.lower() != 'y':
             sys.exit(1)
+    elif not wait_until_ready():
+        print("⚠️ Warning: Yuna service is not ready; replies may fail")
     
-    conversation_history = load_history()
+    speech = SpeechPipeline()
+    history_log = open_history()
+    conversation_history = load_history(history_log)
     farewell_keywords = ["exit", "quit", "goodbye", "bye", "see you later", "farewell"]
     
     # Initial greeting
@@ -174,42 +327,64 @@ def main():
         try:
             user_input = input("\nYou: ")
         except KeyboardInterrupt:
-            print("\n\nYuna: *bows deeply* It seems Master wishes to leave. Please take care!")
-            save_history(conversation_history)
+            speech.cancel()
+            print(f"\n\nYuna: {INTERRUPTED_FAREWELL}")
+            history_log.close()
             break
 
         if user_input.lower().strip() in farewell_keywords:
-            save_history(conversation_history)
-            farewell_text = "*curtsies* I shall await your return, Master. Please take care!"
+            history_log.close()
+            farewell_text = FAREWELL
             print(f"\nYuna: {farewell_text}")
+            speech.cancel()
             speak(farewell_text)
-            time.sleep(2)
+            speech.wait(timeout=10)
             break
 
+        # Barge-in: Master spoke again, so stop whatever Yuna was still saying
+        speech.cancel()
+
         # Character reinforcement in user input
         if "ai" in user_input.lower() or "robot" in user_input.lower():
             print("\n[Note: Yuna is a maid character, not an AI]")
 
         payload = {
             'user_input': user_input,
-            'history': conversation_history[-MAX_HISTORY_TURNS:]
+            'history': conversation_history[-MAX_HISTORY_TURNS:],
+            'session_id': SESSION_ID
         }
+        if YUNA_TRANSPORT == "ndjson":
+            payload['events'] = True
 
         try:
-            with requests.post(YUNA_API_URL, json=payload, stream=True, timeout=30) as response:
-                response.raise_for_status()
-                
+            with closing(stream_reply(payload)) as chunks:
                 full_response = ""
+                splitter = SentenceSplitter()
+                guard = CHARACTER_GUARD.scanner()
                 print("Yuna: ", end="", flush=True)
                 
-                for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
-                    if chunk:
-                        # Filter out correction notices from display
-                        display_chunk = chunk.replace("[Character correction applied]", "")
-                        print(display_chunk, end="", flush=True)
-                        full_response += display_chunk
+                for chunk in chunks:
+                    # Correction notices are not displayed; a replacement after one
+                    # supersedes the partial reply instead of being appended to it
+                    display_chunk, notice, replacement = chunk.partition(CORRECTION_NOTICE)
+                    if notice and replacement.strip():
+                        speech.cancel()
+                        splitter = SentenceSplitter()
+                        full_response = ""
+                        display_chunk = replacement
+                    print(display_chunk, end="", flush=True)
+                    full_response += display_chunk
+                    # Start speaking each sentence as soon as it is complete
+                    for sentence in splitter.feed(display_chunk):
+                        speech.say(sentence)
+                    # Older services stream character breaks through; hang up
+                    # (which stops the generation) and let validation replace it
+                    guard.feed(display_chunk)
+                    if guard.match is not None:
+                        break
                 
                 print()  # New line after response
+                speech.say(splitter.flush())
                 
                 # Validate and correct response if needed
                 full_response = full_response.strip()
@@ -217,22 +392,25 @@ def main():
                 
                 if validated_response != full_response:
                     print(f"Yuna: {validated_response}")
+                    if not validated_response.startswith(full_response):
+                        # Character break: replace what was being spoken
+                        speech.cancel()
+                        speak(validated_response)
                     full_response = validated_response
                 
                 if full_response:
-                    speak(full_response)
-                    conversation_history.append({
+                    turn = {
                         "user": user_input, 
                         "ai": full_response
-                    })
-                    
-                    # Auto-save every 3 turns
-                    if len(conversation_history) % 3 == 0:
-                        save_history(conversation_history)
+                    }
+                    # Every turn is appended as it happens; only the recent ones stay in memory
+                    save_turn(history_log, turn)
+                    conversation_history.append(turn)
+                    del conversation_history[:-MAX_HISTORY_TURNS]
 
         except requests.exceptions.Timeout:
             print("\n⏱️ [Response timeout - Yuna seems to be thinking too hard]")
-            fallback = "*bows apologetically* Forgive me Master, I need a moment to collect myself."
+            fallback = TIMEOUT_FALLBACK
             print(f"Yuna: {fallback}")
             speak(fallback)
             
@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+
+try:
+    import zstandard
+except ImportError:  # compression is optional
+    zstandard = None
+
+# --- History Log Configuration ---
+HISTORY_LOG_ZSTD = os.environ.get("YUNA_HISTORY_ZSTD", "0") == "1"
+INDEX_STRIDE = 64  # turns between index checkpoints (and per frame after compaction)
+COMPACT_AFTER_TURNS = 256  # appends between background compactions
+HISTORY_KEEP_TURNS = int(os.environ.get("YUNA_HISTORY_KEEP_TURNS", "0"))  # 0 keeps every turn
+INDEX_VERSION = 1
+
+
+class HistoryLog:
+    """
+    Append-only JSONL conversation log with a small sidecar index.
+
+    Each turn is one line, appended and flushed as it happens; nothing is
+    rewritten on save. The index (`<log>.idx`) records the turn count, the
+    log size it describes and the byte offset of every INDEX_STRIDE-th turn,
+    so `tail(n)` seeks to the nearest checkpoint and parses only the last
+    turns. Appends made after the index was written (e.g. before a crash) are
+    picked up by scanning just the unindexed tail, and a torn last line is
+    cut off.
+
+    With zstd each append is its own frame; a background compaction
+    periodically rewrites the log into one frame per INDEX_STRIDE turns (and
+    drops turns beyond `keep_turns`, if set). Turns are validated by the
+    caller before they are appended and are not re-checked on load.
+    """
+
+    def __init__(self, path, compress=HISTORY_LOG_ZSTD, keep_turns=HISTORY_KEEP_TURNS):
+        if compress and zstandard is None:
+            print("⚠️ zstandard is not installed; writing an uncompressed history log")
+            compress = False
+        self.compressed = compress
+        self.path = path + ".zst" if compress else path
+        self.index_path = self.path + ".idx"
+        self.keep_turns = keep_turns
+        self._lock = threading.Lock()
+        self._compactor = None
+        self._appends_since_compaction = 0
+
+        self.turns = 0
+        self.size = 0
+        self.checkpoints = [[0, 0]]  # [turn number, byte offset] at line/frame starts
+        self._indexed_size = None
+        self._load_index()
+        self._file = open(self.path, "ab")
+
+    # --- Encoding ---
+    def _encode(self, lines):
+        data = "".join(json.dumps(turn, ensure_ascii=False) + "\n" for turn in lines).encode("utf-8")
+        if self.compressed:
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return data
+
+    def _units(self, data, offset):
+        """`(start, end, lines)` per frame (zstd) or line (plain) in `data`; stops at a torn unit."""
+        position = 0
+        while position < len(data):
+            if self.compressed:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+                try:
+                    lines = decompressor.decompress(data[position:]).splitlines()
+                except zstandard.ZstdError:
+                    return
+                if not decompressor.eof:
+                    return
+                end = len(data) - len(decompressor.unused_data)
+            else:
+                newline = data.find(b"\n", position)
+                if newline < 0:
+                    return
+                lines, end = [data[position:newline]], newline + 1
+            yield offset + position, offset + end, lines
+            position = end
+
+    # --- Index ---
+    def _load_index(self):
+        try:
+            actual = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index["version"] != INDEX_VERSION or index["compressed"] != self.compressed:
+                raise ValueError("index format changed")
+            if index["size"] > actual:
+                raise ValueError("log is shorter than its index")
+            self.turns, self.size, self.checkpoints = index["turns"], index["size"], index["checkpoints"]
+            self._indexed_size = self.size
+        except (OSError, ValueError, KeyError):
+            self.turns, self.size, self.checkpoints = 0, 0, [[0, 0]]
+        if actual > self.size:
+            self._scan_tail(actual)
+
+    def _scan_tail(self, actual):
+        """Index turns appended after the index was written; truncate a torn final record."""
+        with open(self.path, "rb") as f:
+            f.seek(self.size)
+            data = f.read(actual - self.size)
+        end = self.size
+        for start, end, lines in self._units(data, self.size):
+            self._count(start, len(lines))
+        if end < actual:
+            print(f"⚠️ Dropping {actual - end} bytes of a torn history record")
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        self.size = end
+        self._write_index()
+
+    def _count(self, offset, lines):
+        if self.turns - self.checkpoints[-1][0] >= INDEX_STRIDE:
+            self.checkpoints.append([self.turns, offset])
+        self.turns += lines
+
+    def _write_index(self):
+        index = {
+            "version": INDEX_VERSION,
+            "compressed": self.compressed,
+            "turns": self.turns,
+            "size": self.size,
+            "checkpoints": self.checkpoints,
+        }
+        with open(self.index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self._indexed_size = self.size
+
+    # --- Public API ---
+    def __len__(self):
+        return self.turns
+
+    def append(self, turn):
+        """Append one `{"user", "ai"}` turn (already validated) and flush it."""
+        data = self._encode([turn])
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            checkpoints = len(self.checkpoints)
+            self._count(self.size, 1)
+            self.size += len(data)
+            if len(self.checkpoints) != checkpoints:
+                self._write_index()
+            self._appends_since_compaction += 1
+            if self._appends_since_compaction >= COMPACT_AFTER_TURNS and self._needs_compaction():
+                self._start_compaction()
+
+    def tail(self, n):
+        """The last `n` turns, oldest first, reading only from the nearest checkpoint."""
+        if n <= 0:
+            return []
+        with self._lock:
+            first = max(0, self.turns - n)
+            turn, offset = max((c for c in self.checkpoints if c[0] <= first), key=lambda c: c[0])
+            # Read under the lock so a finishing compaction cannot move the offsets
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                data = f.read(self.size - offset)
+        lines = [line for _, _, unit in self._units(data, offset) for line in unit]
+        return [json.loads(line) for line in lines[first - turn:]]
+
+    def import_turns(self, turns):
+        """Append many turns at once (one write), e.g. when migrating an old JSON history."""
+        with self._lock:
+            for start in range(0, len(turns), INDEX_STRIDE):
+                block = turns[start:start + INDEX_STRIDE]
+                data = self._encode(block)
+                self._file.write(data)
+                self._count(self.size, len(block))
+                self.size += len(data)
+            self._file.flush()
+            self._write_index()
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            self._file.close()
+            if self._indexed_size != self.size:
+                self._write_index()
+
+    # --- Compaction ---
+    def _needs_compaction(self):
+        return self.compressed or (self.keep_turns and self.turns > self.keep_turns)
+
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._appends_since_compaction = 0
+        self._compactor = threading.Thread(target=self.compact, name="history-compaction", daemon=True)
+        self._compactor.start()
+
+    def compact(self):
+        """Rewrite the log as one frame/line block per INDEX_STRIDE turns, keeping the newest `keep_turns`."""
+        with self._lock:
+            size = self.size
+        with open(self.path, "rb") as f:
+            data = f.read(size)
+        lines = [line for _, _, unit in self._units(data, 0) for line in unit]
+        if self.keep_turns:
+            lines = lines[-self.keep_turns:]
+
+        tmp_path = self.path + ".compact"
+        checkpoints = []
+        written = 0
+        with open(tmp_path, "wb") as out:
+            for start in range(0, len(lines), INDEX_STRIDE):
+                block = b"".join(line + b"\n" for line in lines[start:start + INDEX_STRIDE])
+                if self.compressed:
+                    block = zstandard.ZstdCompressor(level=3).compress(block)
+                checkpoints.append([start, written])
+                out.write(block)
+                written += len(block)
+
+            with self._lock:
+                # Turns appended while compacting are copied over as they are
+                with open(self.path, "rb") as f:
+                    f.seek(size)
+                    appended = f.read(self.size - size)
+                out.write(appended)
+                out.flush()
+                os.replace(tmp_path, self.path)
+                self._file.close()
+                self._file = open(self.path, "ab")
+
+                self.turns = len(lines)
+                self.checkpoints = checkpoints or [[0, 0]]
+                for start, _, unit in self._units(appended, written):
+                    self._count(start, len(unit))
+                self.size = written + len(appended)
+                self._write_index()
+        print(f"🗜️ Compacted history log: {self.turns} turns, {self.size // 1024} KB")
@@ -1,28 +1,260 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from metrics import DB_LATENCY, ERRORS
+
+# --- Database Configuration ---
+DB_CONFIG = {
+    "dbname": os.environ.get("YUNA_DB_NAME", "yuna_memory"),
+    "user": os.environ.get("YUNA_DB_USER", "guts"),
+    "password": os.environ.get("YUNA_DB_PASSWORD", ""),
+    "host": os.environ.get("YUNA_DB_HOST", "localhost"),
+    "port": int(os.environ.get("YUNA_DB_PORT", "5432")),
+}
+POOL_MIN_CONNECTIONS = int(os.environ.get("YUNA_DB_POOL_MIN", "1"))
+POOL_MAX_CONNECTIONS = int(os.environ.get("YUNA_DB_POOL_MAX", "8"))
+HEALTH_CHECK_IDLE_SECONDS = 30  # ping connections that sat idle longer than this
+CONNECTION_RETRIES = 1
+
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
 
 class YunaMemoryDB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            dbname="yuna_memory",
-            user="guts",
-            password="",
-            host="localhost",
-            port=5432
-        )
-        self.conn.autocommit = True
+    """
+    Conversation store backed by a thread-safe psycopg2 connection pool.
+
+    Connections are health-checked when checked out after sitting idle, broken
+    ones are discarded and replaced, and a read that hits a dropped connection
+    is retried on a fresh one. Per-call latency is kept for `stats()`.
+    """
+
+    def __init__(self, minconn=POOL_MIN_CONNECTIONS, maxconn=POOL_MAX_CONNECTIONS, connect=True, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._connect_kwargs = {**DB_CONFIG, **connect_kwargs}
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises instead of waiting when exhausted
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._in_use = 0
+        self._stats_lock = threading.Lock()
+        self._timings = {}  # call name -> [count, total seconds, max seconds]
+        self.reconnects = 0
+
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """Open the pool now instead of on first use; returns False if the DB is unreachable."""
+        try:
+            self._get_pool()
+            return True
+        except CONNECTION_ERRORS as e:
+            print(f"⚠️ Memory DB unavailable, will retry on first use: {e}")
+            return False
+
+    @property
+    def connected(self):
+        return self._pool is not None and not self._pool.closed
+
+    # --- Pool Management ---
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, **self._connect_kwargs)
+            return self._pool
+
+    def _checkout(self, pool):
+        while True:
+            conn = pool.getconn()
+            if conn.closed:
+                pool.putconn(conn, close=True)
+                continue
+            conn.autocommit = True
+            idle = time.monotonic() - self._last_used.get(id(conn), 0)
+            if idle < HEALTH_CHECK_IDLE_SECONDS:
+                return conn
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                return conn
+            except CONNECTION_ERRORS:
+                self._last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+                self.reconnects += 1
+
+    @contextmanager
+    def _connection(self):
+        with self._slots:
+            pool = self._get_pool()
+            conn = self._checkout(pool)
+            with self._stats_lock:
+                self._in_use += 1
+            try:
+                yield conn
+            except CONNECTION_ERRORS:
+                self._last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+                conn = None
+                raise
+            finally:
+                with self._stats_lock:
+                    self._in_use -= 1
+                if conn is not None:
+                    self._last_used[id(conn)] = time.monotonic()
+                    pool.putconn(conn)
 
+    def _run(self, name, fn, idempotent=True):
+        """
+        Run `fn(conn)` on a pooled connection, retrying once if the connection
+        dropped. Writes (`idempotent=False`) are only retried when no connection
+        could be checked out: once the statement may have been sent, a lost
+        commit can't be told from a failed one and a retry could insert twice.
+        """
+        start = time.perf_counter()
+        try:
+            for attempt in range(CONNECTION_RETRIES + 1):
+                sent = False
+                try:
+                    with self._connection() as conn:
+                        sent = True
+                        return fn(conn)
+                except CONNECTION_ERRORS as e:
+                    if attempt == CONNECTION_RETRIES or (sent and not idempotent):
+                        ERRORS.labels(kind="db").inc()
+                        raise
+                    print(f"⚠️ Memory DB connection lost, reconnecting: {str(e)[:100]}")
+                    self.reconnects += 1
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def _record(self, name, elapsed):
+        DB_LATENCY.labels(operation=name).observe(elapsed)
+        with self._stats_lock:
+            timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "pool_min": self.minconn,
+                "pool_max": self.maxconn,
+                "in_use": self._in_use,
+                "reconnects": self.reconnects,
+                "calls": {
+                    name: {
+                        "count": count,
+                        "avg_ms": round(total / count * 1000, 2),
+                        "max_ms": round(worst * 1000, 2),
+                    }
+                    for name, (count, total, worst) in self._timings.items()
+                },
+            }
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+
+    # --- Conversation API ---
     def save_message(self, user_id, session_id, role, message):
-        with self.conn.cursor()as cur:
-            cur.execute(
-                "INSERT INTO conversations(user_id, session_id, role, message) VALUES(%s, %s, %s, %s)",
-             (user_id, session_id, role, message)
-            )
-    
-    def get_recent_messages(self, user_id, limit=10):
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "SELECT role, message FROM conversations WHERE user_id=%s ORDER BY created_at DESC LIMIT %s",
-                (user_id, limit)
-            )
-            return cur.fetchall()
\ No newline at end of file
+        def insert(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO conversations(user_id, session_id, role, message) VALUES(%s, %s, %s, %s)",
+                    (user_id, session_id, role, message)
+                )
+        self._run("save_message", insert, idempotent=False)
+
+    def save_messages(self, rows):
+        """Insert many `(user_id, session_id, role, message, created_at)` rows in one round trip."""
+        def insert(conn):
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "INSERT INTO conversations(user_id, session_id, role, message, created_at) VALUES %s",
+                    rows,
+                    page_size=len(rows)
+                )
+        if rows:
+            self._run("save_messages", insert, idempotent=False)
+
+    def get_recent_messages(self, user_id, limit=10, session_id=None):
+        # Separate predicates keep the (user_id, session_id, created_at) index usable
+        session_filter = "session_id IS NULL" if session_id is None else "session_id=%s"
+        params = (user_id, limit) if session_id is None else (user_id, session_id, limit)
+
+        def select(conn):
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "SELECT role, message, created_at FROM conversations "
+                    f"WHERE user_id=%s AND {session_filter} "
+                    "ORDER BY created_at DESC, id DESC LIMIT %s",
+                    params
+                )
+                return cur.fetchall()
+        return self._run("get_recent_messages", select)
+
+    def get_messages_after(self, user_id, session_id=None, after=None):
+        """Oldest-first messages of a session created after `after` (all of them if None)."""
+        session_filter = "session_id IS NULL" if session_id is None else "session_id=%s"
+        params = [user_id] if session_id is None else [user_id, session_id]
+        after_filter = ""
+        if after is not None:
+            after_filter = "AND created_at > %s "
+            params.append(after)
+
+        def select(conn):
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "SELECT role, message, created_at FROM conversations "
+                    f"WHERE user_id=%s AND {session_filter} {after_filter}"
+                    "ORDER BY created_at, id",
+                    params
+                )
+                return cur.fetchall()
+        return self._run("get_messages_after", select)
+
+    def iter_messages(self, batch_size=1000):
+        """Every stored message, oldest first, via a server-side cursor (for offline jobs)."""
+        with self._connection() as conn:
+            with conn.cursor(name="iter_messages", cursor_factory=RealDictCursor, withhold=True) as cur:
+                cur.itersize = batch_size
+                cur.execute("SELECT id, user_id, session_id, role, message FROM conversations ORDER BY id")
+                yield from cur
+
+    # --- Summary API ---
+    def get_latest_summary(self, user_id, session_id=None):
+        """Newest rolling summary of a session as a dict, or None."""
+        session_filter = "session_id IS NULL" if session_id is None else "session_id=%s"
+        params = (user_id,) if session_id is None else (user_id, session_id)
+
+        def select(conn):
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "SELECT summary, covered_until, message_count FROM conversation_summaries "
+                    f"WHERE user_id=%s AND {session_filter} "
+                    "ORDER BY covered_until DESC, id DESC LIMIT 1",
+                    params
+                )
+                return cur.fetchone()
+        return self._run("get_latest_summary", select)
+
+    def save_summary(self, user_id, session_id, summary, covered_until, message_count):
+        def insert(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO conversation_summaries(user_id, session_id, summary, covered_until, message_count) "
+                    "VALUES(%s, %s, %s, %s, %s)",
+                    (user_id, session_id, summary, covered_until, message_count)
+                )
+        self._run("save_summary", insert, idempotent=False)
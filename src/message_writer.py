@@ -0,0 +1,229 @@
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from memory_db import CONNECTION_ERRORS
+
+# --- Write-Behind Configuration ---
+FLUSH_MAX_BATCH = int(os.environ.get("YUNA_WRITE_BATCH", "64"))
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("YUNA_WRITE_INTERVAL", "0.5"))
+SPILL_RETRY_SECONDS = 5.0
+SPILL_PATH = os.path.expanduser(
+    os.environ.get("YUNA_SPILL_PATH", "~/.local/share/yuna/conversations_spill.jsonl")
+)
+
+
+class WriteBehindWriter:
+    """
+    Buffers conversation messages and flushes them to Postgres in multi-row
+    inserts, either every `flush_interval` seconds or once `max_batch` rows
+    are waiting. Saving a message never waits on the database.
+
+    If the database is unreachable the batch is appended to a local JSONL
+    spill file, which is replayed ahead of newer rows on later flushes; new
+    rows are written whether or not the replay succeeds. Rows the database
+    rejects (e.g. a NUL byte in the message) are retried one at a time and
+    only the failing ones are set aside in `<spill>.rejected`. Pending rows
+    are flushed on shutdown.
+    """
+
+    def __init__(self, db, max_batch=FLUSH_MAX_BATCH, flush_interval=FLUSH_INTERVAL_SECONDS,
+                 spill_path=SPILL_PATH):
+        self.db = db
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.rejected_path = spill_path + ".rejected"
+
+        self._cond = threading.Condition()
+        self._pending = []   # rows waiting for the next flush
+        self._inflight = []  # rows currently being written
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._last_spill_retry = 0.0
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_spilled = 0
+        self.rows_rejected = 0
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- Public API (mirrors YunaMemoryDB) ---
+    def save_message(self, user_id, session_id, role, message):
+        row = (user_id, session_id, role, message, datetime.now())
+        with self._cond:
+            self._pending.append(row)
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def get_unflushed_messages(self, user_id, limit=10, session_id=None, spilled=False):
+        """
+        Newest-first messages still buffered here. With `spilled=True` rows in
+        the spill file are included: all there is while the DB is down.
+        """
+        with self._cond:
+            unflushed = self._inflight + self._pending
+        if spilled:
+            try:
+                unflushed = self._read_spill() + unflushed
+            except (OSError, ValueError):
+                pass  # being rewritten by the flush thread; the buffered rows still count
+        unflushed = [r for r in unflushed if r[0] == user_id and r[1] == session_id]
+        return [
+            {"role": role, "message": message, "created_at": created_at}
+            for _, _, role, message, created_at in reversed(unflushed[-limit:])
+        ]
+
+    def get_recent_messages(self, user_id, limit=10, session_id=None):
+        """Newest-first recent messages, including rows not flushed yet."""
+        recent = self.get_unflushed_messages(user_id, limit, session_id)
+        if len(recent) < limit:
+            seen = {(r["role"], r["message"], r["created_at"]) for r in recent}
+            for row in self.db.get_recent_messages(user_id=user_id, limit=limit, session_id=session_id):
+                if (row["role"], row["message"], row["created_at"]) not in seen:
+                    recent.append(row)
+        return recent[:limit]
+
+    def flush(self):
+        """Write everything buffered so far (plus any spilled rows) now."""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._inflight = []
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_spilled": self.rows_spilled,
+            "rows_rejected": self.rows_rejected,
+            "spill_file_bytes": os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0,
+        }
+
+    # --- Background Flushing ---
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+                if not self._pending:
+                    # Nothing new; only retry a leftover spill file now and then
+                    if not os.path.exists(self.spill_path):
+                        continue
+                    if time.monotonic() - self._last_spill_retry < SPILL_RETRY_SECONDS:
+                        continue
+                    self._last_spill_retry = time.monotonic()
+            self.flush()
+
+    def _write(self, batch):
+        spilled = self._read_spill()
+        if spilled:
+            left = self._save(spilled)
+            if len(left) < len(spilled):
+                self._rewrite_spill(left)
+                print(f"💾 Replayed {len(spilled) - len(left)} spilled messages")
+        if batch:
+            left = self._save(batch)
+            if left:
+                print(f"⚠️ Memory DB unreachable, spilling {len(left)} messages")
+                self._append_spill(left)
+                self.rows_spilled += len(left)
+        if spilled or batch:
+            self.flushes += 1
+
+    def _save(self, rows):
+        """
+        Insert `rows`; returns those left unwritten because the database is
+        unreachable. If the database rejects the batch, rows are retried one at
+        a time and only the ones it rejects again are quarantined.
+        """
+        try:
+            self.db.save_messages(rows)
+            self.rows_written += len(rows)
+            return []
+        except CONNECTION_ERRORS:
+            return rows
+        except Exception as e:
+            print(f"⚠️ Memory DB rejected a batch of {len(rows)} messages, retrying one by one: {str(e)[:100]}")
+        for i, row in enumerate(rows):
+            try:
+                self.db.save_messages([row])
+                self.rows_written += 1
+            except CONNECTION_ERRORS:
+                return rows[i:]
+            except Exception as e:
+                self._reject(row, e)
+        return []
+
+    def _reject(self, row, error):
+        print(f"⚠️ Setting aside a message the memory DB rejects: {str(error)[:100]}")
+        user_id, session_id, role, message, created_at = row
+        os.makedirs(os.path.dirname(self.rejected_path), exist_ok=True)
+        with open(self.rejected_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(
+                [user_id, session_id, role, message, created_at.isoformat(), str(error)[:500]],
+                ensure_ascii=False, default=str
+            ) + "\n")
+        self.rows_rejected += 1
+
+    def _rewrite_spill(self, rows):
+        if not rows:
+            os.remove(self.spill_path)
+            return
+        tmp_path = self.spill_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # left over from an interrupted rewrite
+        self._append_spill(rows, path=tmp_path)
+        os.replace(tmp_path, self.spill_path)
+
+    def _read_spill(self):
+        if not os.path.exists(self.spill_path):
+            return []
+        rows = []
+        with open(self.spill_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                user_id, session_id, role, message, created_at = json.loads(line)
+                rows.append((user_id, session_id, role, message, datetime.fromisoformat(created_at)))
+        return rows
+
+    def _append_spill(self, batch, path=None):
+        path = path or self.spill_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for user_id, session_id, role, message, created_at in batch:
+                f.write(json.dumps(
+                    [user_id, session_id, role, message, created_at.isoformat()], ensure_ascii=False
+                ) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,75 @@
+import time
+
+import psutil
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# --- Prometheus Metrics ---
+# Observations are a lock and an add; RSS is only read when /metrics is scraped.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+RATE_BUCKETS = (1, 2, 4, 6, 8, 10, 12, 15, 20, 30, 50, 100)
+
+QUEUE_WAIT = Histogram(
+    "yuna_queue_wait_seconds", "Time a /chat request waited for a model slot", buckets=LATENCY_BUCKETS
+)
+PROMPT_EVAL = Histogram(
+    "yuna_prompt_eval_seconds", "Prefix restore and prompt evaluation up to the first token",
+    buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "yuna_time_to_first_token_seconds", "Request arrival to first streamed chunk", buckets=LATENCY_BUCKETS
+)
+DECODE_RATE = Histogram(
+    "yuna_decode_tokens_per_second", "Generation speed after the first token", buckets=RATE_BUCKETS
+)
+REQUEST_LATENCY = Histogram(
+    "yuna_request_duration_seconds", "Request arrival to end of the streamed reply", buckets=LATENCY_BUCKETS
+)
+DB_LATENCY = Histogram(
+    "yuna_db_operation_seconds", "Memory DB call latency", ["operation"], buckets=DB_BUCKETS
+)
+MODEL_TIME_TO_FIRST_TOKEN = Histogram(
+    "yuna_model_time_to_first_token_seconds", "Model slot acquisition (and load) to first chunk, per routed model",
+    ["model"], buckets=LATENCY_BUCKETS
+)
+
+PROMPT_TOKENS = Counter("yuna_prompt_tokens", "Prompt tokens sent to the model")
+GENERATED_TOKENS = Counter("yuna_generated_tokens", "Tokens generated by the model")
+PRUNED_MESSAGES = Counter("yuna_pruned_messages", "History messages dropped to fit the context")
+CORRECTIONS = Counter(
+    "yuna_character_corrections", "Replies corrected for breaking character", ["stage"]
+)
+ERRORS = Counter("yuna_errors", "Failed or rejected requests", ["kind"])
+DRAFT_TOKENS = Counter("yuna_draft_tokens", "Speculatively drafted tokens by verification outcome", ["outcome"])
+MODEL_LOADS = Counter("yuna_model_loads", "Routed model loads (first use or reload after eviction)", ["model"])
+
+IN_FLIGHT = Gauge("yuna_in_flight_requests", "/chat requests queued or streaming")
+RESIDENT_MEMORY = Gauge("yuna_resident_memory_bytes", "Resident set size of the service process")
+_process = psutil.Process()
+RESIDENT_MEMORY.set_function(lambda: _process.memory_info().rss)
+
+
+class RequestTimer:
+    """Per-request latency bookkeeping: in-flight count, TTFT and total duration."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_chunk_at = None
+        self._finished = False
+        IN_FLIGHT.inc()
+
+    def chunk(self):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+            TIME_TO_FIRST_TOKEN.observe(self.first_chunk_at - self.start)
+
+    def finish(self):
+        if not self._finished:
+            self._finished = True
+            IN_FLIGHT.dec()
+            REQUEST_LATENCY.observe(time.perf_counter() - self.start)
+
+
+def render():
+    """Body and content type for a /metrics response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
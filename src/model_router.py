@@ -0,0 +1,344 @@
+import gc
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psutil
+
+from metrics import MODEL_LOADS, MODEL_TIME_TO_FIRST_TOKEN
+
+# --- Model Router Configuration ---
+ROUTER_ENABLED = os.environ.get("YUNA_ROUTER", "0") == "1"
+# Optional JSON file with "models", "routes" and "memory_budget_mb" overriding the defaults below
+ROUTER_CONFIG_PATH = os.environ.get("YUNA_ROUTER_CONFIG", "")
+MODEL_DIR = "/home/guts/llama.cpp/models"
+# RAM the loaded models may use together; 0 means 60% of physical memory
+MEMORY_BUDGET_MB = int(os.environ.get("YUNA_MODEL_MEMORY_MB", "0"))
+
+# Every routed model is prompted through Phi3PromptBuilder (Phi-3 tags and
+# stop strings), so only Phi-3-template models can be registered
+SUPPORTED_TEMPLATES = ("phi3",)
+DEFAULT_MODELS = {
+    "phi3-mini": {"path": f"{MODEL_DIR}/Phi-3-mini-4k-instruct-q4.gguf", "n_ctx": 2048, "template": "phi3"},
+    "phi3-medium": {"path": f"{MODEL_DIR}/Phi-3-medium-4k-instruct-Q4_K_M.gguf", "n_ctx": 2048, "template": "phi3"},
+}
+# A route either pins one model or picks between a small and a large one per turn
+DEFAULT_ROUTES = {
+    "chat": {"small": "phi3-mini", "large": "phi3-medium", "max_small_words": 40},
+    "summary": {"model": "phi3-mini"},
+}
+DEFAULT_ROUTE = "chat"
+
+# Until a model has been loaded once its footprint is guessed from the file size
+KV_BYTES_PER_TOKEN_GUESS = 384 * 1024
+LOAD_OVERHEAD_BYTES = 256 * 2**20
+
+TECHNICAL_PATTERN = re.compile(
+    r"```|\bdef |\breturn\b|[{};]|\d\s*[-+*/^=]\s*\d|"
+    r"\b(code|python|javascript|java|c\+\+|rust|sql|function|class|script|compile|debug|bug|error|"
+    r"exception|stack trace|algorithm|api|regex|linux|terminal|install|calculate|equation|integral|"
+    r"derivative|proof|formula|physics|chemistry|explain how|step by step)\b",
+    re.IGNORECASE,
+)
+
+
+def load_config(path=ROUTER_CONFIG_PATH):
+    """(models, routes, budget bytes) from the defaults and the optional config file."""
+    models, routes, budget_mb = dict(DEFAULT_MODELS), dict(DEFAULT_ROUTES), MEMORY_BUDGET_MB
+    if path:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        models.update(config.get("models", {}))
+        routes.update(config.get("routes", {}))
+        budget_mb = config.get("memory_budget_mb", budget_mb)
+    for name, spec in models.items():
+        template = spec.get("template", "phi3")
+        if template not in SUPPORTED_TEMPLATES:
+            raise ValueError(f"model {name!r} uses the {template!r} chat template; only {SUPPORTED_TEMPLATES} are supported")
+    budget = budget_mb * 2**20 if budget_mb else int(psutil.virtual_memory().total * 0.6)
+    return models, routes, budget
+
+
+def kv_cache_bytes(llm):
+    """f16 KV cache size of a loaded model from its GGUF metadata, or None if unknown."""
+    metadata = getattr(llm, "metadata", None) or {}
+    arch = metadata.get("general.architecture")
+    try:
+        layers = int(metadata[f"{arch}.block_count"])
+        embedding = int(metadata[f"{arch}.embedding_length"])
+        heads = int(metadata[f"{arch}.attention.head_count"])
+        kv_heads = int(metadata.get(f"{arch}.attention.head_count_kv", heads))
+    except (KeyError, ValueError):
+        return None
+    return 2 * layers * llm.n_ctx() * embedding * kv_heads // heads * 2
+
+
+class ModelLatency:
+    """Per-model request timings, the evidence for tuning the routing thresholds."""
+
+    def __init__(self):
+        self.requests = 0
+        self.chunks = 0
+        self.ttft_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, ttft, chunks, total):
+        self.requests += 1
+        self.chunks += chunks
+        self.ttft_seconds += ttft
+        self.decode_seconds += total - ttft
+        self.total_seconds += total
+        self.max_seconds = max(self.max_seconds, total)
+
+    def stats(self):
+        if not self.requests:
+            return {"requests": 0}
+        return {
+            "requests": self.requests,
+            "avg_ttft_ms": round(self.ttft_seconds / self.requests * 1000, 1),
+            "avg_total_ms": round(self.total_seconds / self.requests * 1000, 1),
+            "max_total_ms": round(self.max_seconds * 1000, 1),
+            "chunks_per_second": round(self.chunks / self.decode_seconds, 2) if self.decode_seconds else None,
+        }
+
+
+class LoadedModel:
+    def __init__(self, name, slot, footprint, load_seconds):
+        self.name = name
+        self.slot = slot
+        self.footprint = footprint
+        self.load_seconds = load_seconds
+        self.users = 0
+        # One llama.cpp context per model: generations on it run one at a time
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    GGUF models loaded on first use and kept under a RAM budget.
+
+    `loader(spec)` returns an inference slot (llm, prompt builder, prefix
+    cache). When a model does not fit, idle models are unloaded least recently
+    used first; if the rest are busy the request waits for one to finish.
+    Footprints start as file size plus a KV-cache guess and are replaced by
+    the measured size once a model has been loaded.
+    """
+
+    def __init__(self, specs, budget_bytes, loader):
+        self.specs = specs
+        self.budget = budget_bytes
+        self.loader = loader
+        self._loaded = OrderedDict()  # name -> LoadedModel, least recently used first
+        self._loading = {}  # name -> bytes reserved while loading
+        self._footprints = {}  # name -> measured bytes
+        self._cond = threading.Condition()
+        self.latency = {name: ModelLatency() for name in specs}
+        self.loads = 0
+        self.evictions = 0
+
+    def footprint(self, name):
+        spec = self.specs[name]
+        if "memory_mb" in spec:
+            return spec["memory_mb"] * 2**20
+        if name in self._footprints:
+            return self._footprints[name]
+        return (
+            os.path.getsize(spec["path"]) + spec.get("n_ctx", 2048) * KV_BYTES_PER_TOKEN_GUESS
+            + LOAD_OVERHEAD_BYTES
+        )
+
+    def _used(self):
+        return sum(m.footprint for m in self._loaded.values()) + sum(self._loading.values())
+
+    def _make_room(self, need):
+        """Unload idle models (LRU first) until `need` bytes fit; False if busy models are in the way."""
+        for model in list(self._loaded.values()):
+            if self._used() + need <= self.budget:
+                break
+            if model.users == 0:
+                self._unload(model)
+        if self._used() + need <= self.budget:
+            return True
+        if not self._loaded and not self._loading:
+            print(f"⚠️ Model needs {need // 2**20} MB, more than the {self.budget // 2**20} MB budget; loading anyway")
+            return True
+        return False
+
+    def _unload(self, model):
+        del self._loaded[model.name]
+        self.evictions += 1
+        llm = model.slot.llm
+        draft = getattr(getattr(llm, "draft_model", None), "drafter", None)
+        for closable in (getattr(draft, "llm", None), llm):
+            if closable is not None and hasattr(closable, "close"):
+                closable.close()
+        model.slot = None
+        gc.collect()
+        print(f"📤 Unloaded {model.name} to free {model.footprint // 2**20} MB")
+
+    @contextmanager
+    def acquire(self, name):
+        """The loaded slot for `name`, held exclusively for one generation."""
+        if name not in self.specs:
+            raise KeyError(f"unknown model {name!r}")
+        with self._cond:
+            while True:
+                model = self._loaded.get(name)
+                if model is not None:
+                    model.users += 1
+                    self._loaded.move_to_end(name)
+                    break
+                if name not in self._loading and self._make_room(self.footprint(name)):
+                    self._loading[name] = self.footprint(name)
+                    break
+                self._cond.wait()
+        if model is None:
+            model = self._load(name)
+
+        try:
+            with model.lock:
+                yield model.slot
+        finally:
+            with self._cond:
+                model.users -= 1
+                self._cond.notify_all()
+
+    def _load(self, name):
+        spec = self.specs[name]
+        try:
+            print(f"📥 Loading {name} ({os.path.basename(spec['path'])})")
+            start = time.perf_counter()
+            slot = self.loader(spec)
+            load_seconds = time.perf_counter() - start
+        except Exception:
+            with self._cond:
+                self._loading.pop(name, None)
+                self._cond.notify_all()
+            raise
+
+        kv_bytes = kv_cache_bytes(slot.llm)
+        footprint = self.footprint(name)
+        if kv_bytes is not None and "memory_mb" not in spec:
+            footprint = os.path.getsize(spec["path"]) + kv_bytes + LOAD_OVERHEAD_BYTES
+        MODEL_LOADS.labels(model=name).inc()
+        with self._cond:
+            self._footprints[name] = footprint
+            model = LoadedModel(name, slot, footprint, load_seconds)
+            model.users = 1
+            self._loaded[name] = model
+            self._loading.pop(name, None)
+            self.loads += 1
+            self._cond.notify_all()
+        print(f"✅ {name} loaded in {load_seconds:.1f}s (~{footprint // 2**20} MB)")
+        return model
+
+    def slots(self):
+        """Slots of the models loaded right now."""
+        with self._cond:
+            return [model.slot for model in self._loaded.values() if model.slot is not None]
+
+    def preload(self, name):
+        with self.acquire(name):
+            pass
+
+    def record(self, name, ttft, chunks, total):
+        MODEL_TIME_TO_FIRST_TOKEN.labels(model=name).observe(ttft)
+        with self._cond:
+            self.latency[name].record(ttft, chunks, total)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "budget_mb": self.budget // 2**20,
+                "used_mb": self._used() // 2**20,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "models": {
+                    name: {
+                        "loaded": name in self._loaded,
+                        "footprint_mb": self.footprint(name) // 2**20 if os.path.exists(spec["path"]) else None,
+                        "load_seconds": round(self._loaded[name].load_seconds, 1) if name in self._loaded else None,
+                        "prompt_cache": self._loaded[name].slot.prefix_cache.stats() if name in self._loaded else None,
+                        **self.latency[name].stats(),
+                    }
+                    for name, spec in self.specs.items()
+                },
+            }
+
+
+def run_on_model(registry, name, fn, *args):
+    """Scheduler job: run the generator `fn(slot, *args)` on model `name`, recording its latency."""
+    start = time.perf_counter()
+    first_chunk_at = None
+    chunks = 0
+    with registry.acquire(name) as slot:
+        for item in fn(slot, *args):
+            # Framed streams (generate_events) also carry start/done records
+            if not isinstance(item, dict) or item.get("event") == "token":
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                chunks += 1
+            yield item
+    if first_chunk_at is not None:
+        registry.record(name, first_chunk_at - start, chunks, time.perf_counter() - start)
+
+
+def bind_model(fn, name):
+    """A scheduler job function that runs `fn` on model `name` (e.g. background summaries)."""
+    def job(registry, *args):
+        yield from run_on_model(registry, name, fn, *args)
+    return job
+
+
+class ModelRouter:
+    """
+    Picks a model per turn. Routes with `small`/`large` send short chit-chat to
+    the small model and long (over `max_small_words`) or technical turns to the
+    large one; routes with `model` always use that model.
+    """
+
+    def __init__(self, routes, registry):
+        for route, config in routes.items():
+            for model in (config.get("model"), config.get("small"), config.get("large")):
+                if model is not None and model not in registry.specs:
+                    raise ValueError(f"route {route!r} uses unknown model {model!r}")
+        self.routes = routes
+        self.registry = registry
+        self._lock = threading.Lock()
+        self.decisions = {}  # (route, model, reason) -> count
+
+    def route_model(self, route):
+        config = self.routes[route]
+        return config.get("model") or config["small"]
+
+    def choose(self, route, text):
+        """(model name, reason) for a turn on `route` (unknown routes use DEFAULT_ROUTE)."""
+        if route not in self.routes:
+            route = DEFAULT_ROUTE
+        config = self.routes[route]
+        if "model" in config:
+            model, reason = config["model"], "pinned"
+        elif len(text.split()) > config.get("max_small_words", 40):
+            model, reason = config["large"], "long"
+        elif TECHNICAL_PATTERN.search(text):
+            model, reason = config["large"], "technical"
+        else:
+            model, reason = config["small"], "chit-chat"
+        with self._lock:
+            key = (route, model, reason)
+            self.decisions[key] = self.decisions.get(key, 0) + 1
+        return model, reason
+
+    def stats(self):
+        with self._lock:
+            decisions = [
+                {"route": route, "model": model, "reason": reason, "count": count}
+                for (route, model, reason), count in sorted(self.decisions.items())
+            ]
+        return {"decisions": decisions, "registry": self.registry.stats()}
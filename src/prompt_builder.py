@@ -0,0 +1,141 @@
+import hashlib
+from collections import OrderedDict
+
+# --- Phi-3 Chat Template ---
+# Bump when the tags or layout below change: saved KV snapshots of older
+# prompts are then discarded instead of restored
+TEMPLATE_VERSION = 3
+ROLE_TAGS = {
+    "system": "<|system|>",
+    "user": "<|user|>",
+    "assistant": "<|assistant|>",
+    "yuna": "<|assistant|>",  # role name used in the conversations table
+}
+RESPONSE_STARTER = "<|assistant|>\n"
+MEMORY_HEADER = "<|system|>\nThings you remember from earlier conversations with Master:\n"
+MEMORY_FOOTER = "<|end|>\n"
+SUMMARY_HEADER = "<|system|>\nWhat you remember of this conversation so far:\n"
+
+
+class BuiltPrompt:
+    """Token ids for one request plus the offsets the prefix cache snapshots at."""
+
+    def __init__(self, tokens, system_length, history_length, pruned_messages):
+        self.tokens = tokens
+        self.system_length = system_length
+        self.history_length = history_length
+        self.pruned_messages = pruned_messages
+
+
+class Phi3PromptBuilder:
+    """
+    Assembles Phi-3 prompts directly as token ids.
+
+    Every message is tokenized once and cached by content hash, so history
+    that is resent on each turn costs a dict lookup instead of a tokenizer
+    call, and pruning is a single pass over the cached lengths.
+    """
+
+    def __init__(self, llm, system_prompt, reserve_tokens=512, memory_tokens=256, max_cached_messages=4096):
+        self.llm = llm
+        self.reserve_tokens = reserve_tokens
+        self.memory_tokens = memory_tokens
+        self.max_cached_messages = max_cached_messages
+        self._cache = OrderedDict()  # sha1(role, content) -> token ids
+
+        if not system_prompt.startswith(ROLE_TAGS["system"]):
+            system_prompt = f"{ROLE_TAGS['system']}\n{system_prompt}<|end|>"
+        self.system_tokens = llm.tokenize(
+            (system_prompt + "\n").encode("utf-8"), add_bos=True, special=True
+        )
+        self.response_tokens = self._tokenize(RESPONSE_STARTER)
+        self.memory_header_tokens = self._tokenize(MEMORY_HEADER)
+        self.memory_footer_tokens = self._tokenize(MEMORY_FOOTER)
+
+    def _tokenize(self, text):
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+            self._cache[key] = tokens
+            if len(self._cache) > self.max_cached_messages:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return tokens
+
+    def message_tokens(self, message):
+        """Token ids for one templated message, e.g. `<|user|>\\n...<|end|>\\n`."""
+        tag = ROLE_TAGS[message["role"]]
+        return self._tokenize(f"{tag}\n{message['content']}<|end|>\n")
+
+    def _memory_block(self, memories, budget):
+        """Recalled snippets (most relevant first) that fit in `budget` tokens."""
+        overhead = len(self.memory_header_tokens) + len(self.memory_footer_tokens)
+        lines = []
+        used = overhead
+        for memory in memories:
+            line = self._tokenize(memory["content"] + "\n")
+            if used + len(line) > budget:
+                break
+            lines.append(line)
+            used += len(line)
+        if not lines:
+            return []
+        block = list(self.memory_header_tokens)
+        for line in lines:
+            block.extend(line)
+        block.extend(self.memory_footer_tokens)
+        return block
+
+    def build(self, messages):
+        """
+        Fit `messages` into the context window and return the prompt tokens.
+
+        System messages are replaced by the builder's own system prompt and the
+        last message is always kept. A `summary` message (rolling summary of
+        older turns) follows the system prompt, so it is part of the cached
+        prefix. `memory` messages (recalled snippets) go in a block just after
+        the last message, capped at `memory_tokens`, so they never sit between
+        turns that the next prompt resends (and its snapshot covers). Older
+        history is dropped two messages at a time (one user/assistant turn)
+        until the prompt leaves `reserve_tokens` free for the reply.
+        """
+        turns = [m for m in messages if m["role"] != "system" and m["role"] in ROLE_TAGS]
+        memories = [m for m in messages if m["role"] == "memory"]
+        summaries = [m for m in messages if m["role"] == "summary"]
+        history, current = turns[:-1], turns[-1:]
+
+        history_tokens = [self.message_tokens(m) for m in history]
+        current_tokens = [t for m in current for t in self.message_tokens(m)]
+
+        summary_tokens = []
+        if summaries:
+            summary_tokens = self._tokenize(SUMMARY_HEADER + summaries[-1]["content"] + MEMORY_FOOTER)
+        budget = (
+            self.llm.n_ctx() - self.reserve_tokens - len(self.system_tokens) - len(summary_tokens)
+            - len(current_tokens) - len(self.response_tokens)
+        )
+        memory_tokens = self._memory_block(memories, min(self.memory_tokens, budget))
+        budget -= len(memory_tokens)
+        total = sum(len(t) for t in history_tokens)
+        start = 0
+        while start < len(history_tokens) and total > budget:
+            total -= sum(len(t) for t in history_tokens[start:start + 2])
+            start += 2
+
+        tokens = list(self.system_tokens)
+        tokens.extend(summary_tokens)
+        for message_tokens in history_tokens[start:]:
+            tokens.extend(message_tokens)
+        history_length = len(tokens)
+        tokens.extend(current_tokens)
+        tokens.extend(memory_tokens)
+        tokens.extend(self.response_tokens)
+
+        return BuiltPrompt(
+            tokens,
+            system_length=len(self.system_tokens),
+            history_length=history_length,
+            pruned_messages=min(start, len(history)),
+        )
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+
+
+def compact_state(state):
+    """
+    Keep only the last row of logits. A restore always re-evaluates at least
+    the final prompt token (PrefixStateCache.prepare), and load_state
+    broadcasts the single row, so the rest (n_batch x n_vocab floats, or one
+    row per token with logits_all) is dead weight.
+    """
+    if getattr(state, "scores", None) is not None and len(state.scores) > 1:
+        state.scores = state.scores[-1:].copy()
+    return state
+
+
+def common_prefix_length(a, b):
+    """Number of leading tokens shared by two token sequences."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixStateCache:
+    """
+    Snapshots of the llama.cpp state taken at fixed prompt checkpoints
+    (end of the system prompt, end of the shared conversation history).
+
+    Before each request the longest usable prefix is restored, either from the
+    live context or from a snapshot, so llama.cpp only evaluates the new tail.
+    """
+
+    def __init__(self, llm, max_bytes=1024 * 1024 * 1024):
+        self.llm = llm
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # tuple(tokens) -> LlamaState
+        self._pinned = set()
+        self._bytes = 0
+
+        self.hits = 0  # reuse reached past the system prompt into the conversation
+        self.system_hits = 0  # only the system prompt (and summary) was reused
+        self.misses = 0
+        self.restores = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.evaluated_tokens = 0
+        # Offered session snapshots that reached past every checkpoint (or didn't)
+        self.snapshot_hits = 0
+        self.snapshot_misses = 0
+        self.last_snapshot = None  # "hit", "miss" or None for the latest prepare
+
+    @staticmethod
+    def _state_size(state):
+        size = state.llama_state_size
+        if getattr(state, "scores", None) is not None:
+            size += state.scores.nbytes
+        return size
+
+    def _snapshot(self, tokens, pinned=False):
+        key = tuple(tokens)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        else:
+            state = compact_state(self.llm.save_state())
+            self._entries[key] = state
+            self._bytes += self._state_size(state)
+        if pinned:
+            self._pinned.add(key)
+        self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            self._bytes -= self._state_size(self._entries.pop(key))
+            self.evictions += 1
+
+    def _eval_to(self, tokens, start, end):
+        self.llm.n_tokens = start
+        self.llm.eval(tokens[start:end])
+        self.evaluated_tokens += end - start
+
+    def pin(self, tokens):
+        """Evaluate `tokens` from scratch and keep the resulting state permanently."""
+        self.llm.reset()
+        self._eval_to(tokens, 0, len(tokens))
+        self._snapshot(tokens, pinned=True)
+
+    def prepare(self, tokens, checkpoints=(), candidates=()):
+        """
+        Put the model in the best state for evaluating `tokens`.
+
+        Restores the longest cached prefix (from the live context, the checkpoint
+        snapshots or extra `(tokens, state)` candidates such as a per-session
+        snapshot), then evaluates up to each checkpoint
+        that is not covered yet and snapshots it. The final prompt token is always
+        left for llama.cpp to evaluate so generation has fresh logits.
+        Returns the number of tokens that did not need re-evaluation.
+        """
+        limit = len(tokens) - 1
+        reused = min(common_prefix_length(self.llm._input_ids, tokens), limit)
+
+        best_key = None
+        for key in self._entries:
+            shared = min(common_prefix_length(key, tokens), limit)
+            if shared > reused:
+                reused, best_key = shared, key
+
+        best_state = None
+        candidate_reach = 0
+        for key, state in candidates:
+            shared = min(common_prefix_length(key, tokens), limit)
+            candidate_reach = max(candidate_reach, shared)
+            if shared > reused:
+                reused, best_key, best_state = shared, None, state
+
+        self.last_snapshot = None
+        if candidates:
+            # A snapshot only counts as a hit if it matched past the system prompt, into the history
+            self.last_snapshot = "hit" if candidate_reach > min(checkpoints, default=0) else "miss"
+            if self.last_snapshot == "hit":
+                self.snapshot_hits += 1
+            else:
+                self.snapshot_misses += 1
+
+        if best_state is not None:
+            self.llm.load_state(best_state)
+            self.restores += 1
+        elif best_key is not None:
+            self.llm.load_state(self._entries[best_key])
+            self._entries.move_to_end(best_key)
+            self.restores += 1
+
+        first_checkpoint = min(checkpoints) if checkpoints else limit
+        if reused > first_checkpoint:
+            self.hits += 1
+        elif reused == first_checkpoint:
+            self.system_hits += 1
+        else:
+            self.misses += 1
+        self.reused_tokens += reused
+
+        for checkpoint in sorted(checkpoints):
+            if reused < checkpoint <= limit:
+                self._eval_to(tokens, reused, checkpoint)
+                self._snapshot(tokens[:checkpoint])
+                reused = checkpoint
+
+        self.llm.n_tokens = reused
+        self.evaluated_tokens += len(tokens) - reused
+        return reused
+
+    def stats(self):
+        lookups = self.hits + self.system_hits + self.misses
+        return {
+            "hits": self.hits,
+            "system_hits": self.system_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "restores": self.restores,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "reused_tokens": self.reused_tokens,
+            "evaluated_tokens": self.evaluated_tokens,
+            "snapshot_hits": self.snapshot_hits,
+            "snapshot_misses": self.snapshot_misses,
+        }
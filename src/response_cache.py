@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# --- Response Cache Configuration ---
+RESPONSE_CACHE_MODE = os.environ.get("YUNA_RESPONSE_CACHE", "off")  # "off", "exact" or "similar"
+# "history": only reuse a reply when the prior conversation is identical too;
+# "ignore": reuse replies regardless of history (stock questions, greetings)
+RESPONSE_CACHE_CONTEXT = os.environ.get("YUNA_RESPONSE_CACHE_CONTEXT", "history")
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("YUNA_RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("YUNA_RESPONSE_CACHE_ENTRIES", "1024"))
+SIMILARITY_THRESHOLD = float(os.environ.get("YUNA_RESPONSE_CACHE_SIMILARITY", "0.92"))
+DEFAULT_CHUNK_SECONDS = 0.05
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_CHUNKS = re.compile(r"\s*\S+")
+
+
+def normalize(text):
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+
+class _Entry:
+    def __init__(self, response, expires, vector):
+        self.response = response
+        self.expires = expires
+        self.vector = vector
+
+
+class ResponseCache:
+    """
+    Replies keyed by normalized user input plus a digest of the conversation
+    context, with TTL and LRU eviction.
+
+    In "similar" mode a miss on the exact key falls back to the cached input
+    (within the same context) whose embedding is closest, if it clears
+    SIMILARITY_THRESHOLD. Hits are replayed at the observed generation cadence
+    so clients see the same streaming behaviour.
+    """
+
+    def __init__(self, mode=RESPONSE_CACHE_MODE, embedder=None, context=RESPONSE_CACHE_CONTEXT,
+                 ttl=RESPONSE_CACHE_TTL_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 threshold=SIMILARITY_THRESHOLD):
+        if mode == "similar" and embedder is None:
+            print("ℹ️ Similar-response cache needs the embedding model; using exact matching")
+            mode = "exact"
+        self.mode = mode
+        self.embedder = embedder
+        self.include_history = context != "ignore"
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._entries = OrderedDict()  # (context digest, normalized input) -> _Entry
+        self._lock = threading.Lock()
+        self.chunk_seconds = DEFAULT_CHUNK_SECONDS
+
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def _context_digest(self, messages):
+        if not self.include_history:
+            return ""
+        history = [
+            (m["role"], m["content"]) for m in messages[:-1]
+            if m["role"] in ("user", "assistant", "yuna")
+        ]
+        return hashlib.sha1(repr(history).encode("utf-8")).hexdigest()
+
+    def lookup(self, user_input, messages):
+        """Cached reply for this input and context, or None."""
+        key = (self._context_digest(messages), normalize(user_input))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry.response
+            if self.mode != "similar":
+                self.misses += 1
+                return None
+            candidates = [
+                (k, e) for k, e in self._entries.items()
+                if k[0] == key[0] and e.expires > now and e.vector is not None
+            ]
+
+        if candidates:
+            query = self.embedder.embed(key[1])
+            scores = np.stack([e.vector for _, e in candidates]) @ query
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                with self._lock:
+                    self._entries.move_to_end(candidates[best][0])
+                    self.similar_hits += 1
+                return candidates[best][1].response
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, user_input, messages, response):
+        key = (self._context_digest(messages), normalize(user_input))
+        vector = self.embedder.embed(key[1]) if self.mode == "similar" else None
+        with self._lock:
+            self._entries[key] = _Entry(response, time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def observe_cadence(self, seconds, chunks):
+        """Track the live seconds-per-chunk so replays stream at the same pace."""
+        if chunks > 1:
+            self.chunk_seconds = 0.8 * self.chunk_seconds + 0.2 * (seconds / (chunks - 1))
+
+    def chunks(self, response):
+        """Split a cached reply into word-sized chunks for replay."""
+        return _CHUNKS.findall(response)
+
+    def replay(self, response):
+        """Yield a cached reply chunk by chunk at the normal cadence."""
+        for i, chunk in enumerate(self.chunks(response)):
+            if i:
+                time.sleep(self.chunk_seconds)
+            yield chunk
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.similar_hits + self.misses
+            return {
+                "mode": self.mode,
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.exact_hits + self.similar_hits) / lookups, 3) if lookups else 0.0,
+                "chunk_ms": round(self.chunk_seconds * 1000, 1),
+            }
@@ -0,0 +1,167 @@
+import asyncio
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class SchedulerFull(Exception):
+    """Raised when the request queue is at capacity."""
+
+
+class InferenceJob:
+    """
+    One queued generation. Items produced on the worker thread are handed to
+    the request thread through `emit`; iterating the job yields them in order.
+    """
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.enqueued_at = time.perf_counter()
+        self.queue_wait = None
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+        self._output = queue.Queue()
+
+    def emit(self, item):
+        self._output.put(item)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def queue_wait_ms(self):
+        return round(self.queue_wait * 1000, 1) if self.queue_wait is not None else None
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._output.get()
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            # Client went away or finished reading: stop the worker early
+            self.cancel()
+
+
+class AsyncInferenceJob(InferenceJob):
+    """
+    InferenceJob for asyncio consumers. Items are handed to the event loop with
+    `call_soon_threadsafe`, so a waiting client costs a coroutine, not a thread.
+    """
+
+    def __init__(self, fn, args, loop):
+        super().__init__(fn, args)
+        self._loop = loop
+        self._async_output = asyncio.Queue()
+
+    def emit(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._async_output.put_nowait, item)
+        except RuntimeError:
+            # Event loop already closed (server shutting down)
+            self.cancel()
+
+    async def __aiter__(self):
+        try:
+            while True:
+                item = await self._async_output.get()
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            self.cancel()
+
+
+class InferenceScheduler:
+    """
+    Bounded FIFO queue in front of a fixed set of model workers.
+
+    Each worker owns one resource (a model replica with its own KV state) and
+    runs one job at a time, so llama.cpp contexts are never shared between
+    threads. Concurrency equals the number of workers; requests beyond
+    `max_queue` waiting jobs are rejected with SchedulerFull.
+    """
+
+    def __init__(self, workers, max_queue=16):
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_queue_wait = 0.0
+
+        self._threads = []
+        for i, resource in enumerate(workers):
+            thread = threading.Thread(
+                target=self._run, args=(resource,), name=f"inference-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args):
+        """Queue `fn(resource, *args)`, a generator, and return its InferenceJob."""
+        return self.submit_job(InferenceJob(fn, args))
+
+    def submit_job(self, job):
+        """Queue an already constructed job, e.g. an AsyncInferenceJob."""
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise SchedulerFull(f"inference queue is full ({self.max_queue} waiting)")
+        return job
+
+    def _run(self, resource):
+        while True:
+            job = self._queue.get()
+            job.queue_wait = time.perf_counter() - job.enqueued_at
+            with self._lock:
+                self._active += 1
+                self.total_queue_wait += job.queue_wait
+            job.started.set()
+
+            stream = None
+            try:
+                if not job.cancelled.is_set():
+                    stream = job.fn(resource, *job.args)
+                    for item in stream:
+                        if job.cancelled.is_set():
+                            break
+                        job.emit(item)
+            except Exception as e:
+                print(f"⚠️ Inference job failed: {e}")
+            finally:
+                if stream is not None:
+                    stream.close()
+                job.emit(_DONE)
+                with self._lock:
+                    self._active -= 1
+                    self.completed += 1
+
+    def idle(self):
+        """True when no job is running or waiting (background work may use a replica)."""
+        with self._lock:
+            return self._active == 0 and self._queue.empty()
+
+    def has_waiting(self):
+        return not self._queue.empty()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": len(self._threads),
+                "active": self._active,
+                "queued": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_queue_wait_ms": round(
+                    self.total_queue_wait / self.completed * 1000, 1
+                ) if self.completed else 0.0,
+            }
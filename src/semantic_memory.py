@@ -0,0 +1,361 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+import numpy as np
+
+# --- Semantic Memory Configuration ---
+EMBED_MODEL_PATH = os.environ.get(
+    "YUNA_EMBED_MODEL", "/home/guts/llama.cpp/models/all-MiniLM-L6-v2.Q8_0.gguf"
+)
+INDEX_DIR = os.path.expanduser(os.environ.get("YUNA_MEMORY_INDEX", "~/.local/share/yuna/memory_index"))
+RECALL_TOP_K = 4
+RECALL_MIN_SCORE = 0.35
+SNIPPET_MAX_CHARS = 300
+
+GROW_ROWS = 65536          # vectors file grows in chunks of this many rows
+TRAIN_THRESHOLD = 20000    # below this many vectors search is brute force
+RETRAIN_GROWTH = 8         # retrain partitions once the index is this much larger
+N_PROBE = 16               # partitions scanned per query
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE = 50000
+
+
+def _owner_hash(user_id):
+    return zlib.crc32(user_id.encode("utf-8"))
+
+
+class LlamaEmbedder:
+    """Sentence embeddings from a small GGUF embedding model via llama.cpp (CPU)."""
+
+    def __init__(self, model_path=EMBED_MODEL_PATH, n_threads=2):
+        from llama_cpp import Llama
+
+        self.llm = Llama(
+            model_path=model_path,
+            embedding=True,
+            n_ctx=512,
+            n_threads=n_threads,
+            n_gpu_layers=0,
+            verbose=False,
+        )
+        self.dim = self.llm.n_embd()
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        with self._lock:
+            vector = np.asarray(self.llm.embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class VectorIndex:
+    """
+    Append-only cosine-similarity index over unit vectors, stored on disk.
+
+    Vectors live in a float32 memmap; per-row metadata is JSONL with a uint64
+    offset table so only the returned hits are read back. Up to
+    TRAIN_THRESHOLD rows every query is a brute-force matvec. Past that the
+    rows are partitioned with k-means (an IVF index) and a query only scores
+    the N_PROBE partitions closest to it, which keeps lookups in the
+    low-millisecond range at a million messages.
+    """
+
+    def __init__(self, directory, dim):
+        self.directory = directory
+        self.dim = dim
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+
+        self._state_path = os.path.join(directory, "state.json")
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._meta_path = os.path.join(directory, "meta.jsonl")
+        self._offsets_path = os.path.join(directory, "offsets.u64")
+        self._owners_path = os.path.join(directory, "owners.u32")
+        self._assign_path = os.path.join(directory, "assign.i32")
+        self._centroids_path = os.path.join(directory, "centroids.npy")
+
+        self.count = 0
+        self.trained_at = 0
+        if os.path.exists(self._state_path):
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["dim"] != dim:
+                raise ValueError(f"index at {directory} has dim {state['dim']}, embedder has {dim}")
+            self.count = state["count"]
+            self.trained_at = state.get("trained_at", 0)
+
+        self._capacity = 0
+        self._vectors = None
+        self._ensure_capacity(max(self.count, 1))
+
+        self._offsets = self._load_array("Q", self._offsets_path)
+        self._owners = self._load_array("I", self._owners_path)
+        self._assign = self._load_array("i", self._assign_path)
+        self._meta_file = open(self._meta_path, "a+b")
+        self._side_files = {
+            path: open(path, "ab")
+            for path in (self._offsets_path, self._owners_path, self._assign_path)
+        }
+
+        self._centroids = None
+        self._lists = []
+        if self.trained_at and os.path.exists(self._centroids_path):
+            self._centroids = np.load(self._centroids_path)
+            self._rebuild_lists()
+
+    # --- Storage ---
+    def _load_array(self, typecode, path):
+        # Side tables are append-only; drop rows written after the last flush
+        values = array(typecode)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                values.frombytes(f.read())
+        del values[self.count:]
+        with open(path, "wb") as f:
+            f.write(values.tobytes())
+        return values
+
+    def _append(self, values, path, value):
+        values.append(value)
+        self._side_files[path].write(values[-1:].tobytes())
+
+    def _ensure_capacity(self, rows):
+        if rows <= self._capacity:
+            return
+        capacity = ((rows + GROW_ROWS - 1) // GROW_ROWS) * GROW_ROWS
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def _rebuild_lists(self):
+        assign = np.frombuffer(self._assign, dtype=np.int32) if len(self._assign) else np.empty(0, np.int32)
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        bounds = np.searchsorted(assign[order], np.arange(len(self._centroids) + 1))
+        self._lists = [array("i", order[bounds[i]:bounds[i + 1]].tobytes()) for i in range(len(self._centroids))]
+
+    def _write_state(self):
+        with open(self._state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "count": self.count, "trained_at": self.trained_at}, f)
+        os.replace(self._state_path + ".tmp", self._state_path)
+
+    def flush(self):
+        """Persist vectors, side tables and the row count."""
+        with self._lock:
+            self._vectors.flush()
+            self._meta_file.flush()
+            for f in self._side_files.values():
+                f.flush()
+            self._write_state()
+
+    # --- Writes ---
+    def add(self, vector, meta):
+        with self._lock:
+            row = self.count
+            self._ensure_capacity(row + 1)
+            self._vectors[row] = vector
+
+            self._meta_file.seek(0, os.SEEK_END)
+            self._append(self._offsets, self._offsets_path, self._meta_file.tell())
+            self._meta_file.write(json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n")
+            self._append(self._owners, self._owners_path, _owner_hash(meta["user_id"]))
+
+            partition = -1
+            if self._centroids is not None:
+                partition = int(np.argmax(self._centroids @ vector))
+                self._lists[partition].append(row)
+            self._append(self._assign, self._assign_path, partition)
+            self.count += 1
+        return row
+
+    def needs_training(self):
+        if self.count < TRAIN_THRESHOLD:
+            return False
+        return not self.trained_at or self.count >= self.trained_at * RETRAIN_GROWTH
+
+    def train(self):
+        """(Re)partition the index with spherical k-means; searches keep working meanwhile."""
+        n = self.count
+        vectors = np.asarray(self._vectors[:n])
+        n_lists = int(min(4096, max(64, 4 * np.sqrt(n))))
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(n, size=min(n, KMEANS_SAMPLE), replace=False)]
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            filled = norms[:, 0] > 0
+            centroids[filled] = sums[filled] / norms[filled]
+
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, 65536):
+            assign[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+
+        with self._lock:
+            # Rows added while training get assigned against the new centroids
+            extra = self._vectors[n:self.count]
+            tail = np.argmax(extra @ centroids.T, axis=1).astype(np.int32) if len(extra) else []
+            self._assign = array("i", assign.tobytes())
+            self._assign.extend(int(p) for p in tail)
+            self._side_files[self._assign_path].close()
+            with open(self._assign_path, "wb") as f:
+                f.write(self._assign.tobytes())
+            self._side_files[self._assign_path] = open(self._assign_path, "ab")
+            self._centroids = centroids
+            self.trained_at = n
+            np.save(self._centroids_path, centroids)
+            self._rebuild_lists()
+            self.flush()
+        print(f"🗂️ Memory index partitioned: {n} vectors into {n_lists} lists")
+
+    # --- Reads ---
+    def _read_meta(self, row):
+        self._meta_file.seek(self._offsets[row])
+        return json.loads(self._meta_file.readline())
+
+    def search(self, query, k, user_id=None):
+        """Top-k `(score, meta)` pairs by cosine similarity, optionally for one user."""
+        with self._lock:
+            if self.count == 0:
+                return []
+            if self._centroids is None:
+                ids = None
+                candidates = self._vectors[:self.count]
+            else:
+                probes = np.argpartition(-(self._centroids @ query), min(N_PROBE, len(self._centroids) - 1))
+                lists = [self._lists[p] for p in probes[:N_PROBE] if len(self._lists[p])]
+                if not lists:
+                    return []
+                ids = np.concatenate([np.frombuffer(l, dtype=np.int32) for l in lists])
+                candidates = self._vectors[ids]
+
+            scores = candidates @ query
+            if user_id is not None:
+                owners = np.frombuffer(self._owners, dtype=np.uint32)
+                owners = owners[:self.count] if ids is None else owners[ids]
+                scores = np.where(owners == _owner_hash(user_id), scores, -np.inf)
+
+            top = min(k, len(scores))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            results = []
+            for i in best:
+                if not np.isfinite(scores[i]):
+                    break
+                row = int(i) if ids is None else int(ids[i])
+                meta = self._read_meta(row)
+                if user_id is None or meta["user_id"] == user_id:
+                    results.append((float(scores[i]), meta))
+            return results
+
+
+class SemanticMemory:
+    """
+    Long-term recall over everything Master and Yuna have said.
+
+    Saved messages are embedded on a background thread and appended to the
+    vector index; `recall` embeds the new user message and returns the most
+    similar past snippets for the prompt builder.
+    """
+
+    def __init__(self, embedder, index_dir=INDEX_DIR):
+        self.embedder = embedder
+        self.index = VectorIndex(index_dir, embedder.dim)
+        self._queue = queue.Queue()
+        self.recalls = 0
+        self.recall_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name="memory-indexer", daemon=True)
+        self._thread.start()
+
+    def remember(self, user_id, session_id, role, message):
+        """Queue a saved message for embedding; never blocks the request."""
+        if message.strip():
+            self._queue.put({"user_id": user_id, "session_id": session_id, "role": role, "message": message})
+
+    def recall(self, user_id, query, k=RECALL_TOP_K, exclude=()):
+        """Most relevant past messages for `query`, skipping texts in `exclude`."""
+        start = time.perf_counter()
+        hits = self.index.search(self.embedder.embed(query), k + len(exclude), user_id=user_id)
+        self.recalls += 1
+        self.recall_seconds += time.perf_counter() - start
+
+        exclude = set(exclude)
+        snippets = []
+        for score, meta in hits:
+            if score < RECALL_MIN_SCORE or meta["message"] in exclude:
+                continue
+            snippets.append(meta)
+            if len(snippets) == k:
+                break
+        return snippets
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self.index.add(self.embedder.embed(item["message"]), item)
+                if self._queue.empty():
+                    self.index.flush()
+                    if self.index.needs_training():
+                        self.index.train()
+            except Exception as e:
+                print(f"⚠️ Memory indexing failed: {e}")
+
+    def stats(self):
+        return {
+            "indexed": self.index.count,
+            "queued": self._queue.qsize(),
+            "partitioned": self.index.trained_at > 0,
+            "recalls": self.recalls,
+            "avg_recall_ms": round(self.recall_seconds / self.recalls * 1000, 2) if self.recalls else 0.0,
+        }
+
+
+def format_snippet(meta):
+    """One remembered message as a prompt line."""
+    speaker = "Master said" if meta["role"] == "user" else "You said"
+    text = " ".join(meta["message"].split())
+    if len(text) > SNIPPET_MAX_CHARS:
+        text = text[:SNIPPET_MAX_CHARS].rsplit(" ", 1)[0] + "..."
+    return f"- {speaker}: {text}"
+
+
+# --- Backfill ---
+if __name__ == "__main__":
+    # Index the existing conversations table once: python semantic_memory.py --backfill
+    if "--backfill" not in sys.argv:
+        print("Usage: python semantic_memory.py --backfill")
+        sys.exit(1)
+
+    from memory_db import YunaMemoryDB
+
+    embedder = LlamaEmbedder(n_threads=os.cpu_count() or 4)
+    index = VectorIndex(INDEX_DIR, embedder.dim)
+    if index.count:
+        print(f"❌ Index at {INDEX_DIR} already holds {index.count} vectors; backfill only runs on an empty index")
+        sys.exit(1)
+    total = 0
+    for row in YunaMemoryDB().iter_messages():
+        index.add(embedder.embed(row["message"]), {
+            "user_id": row["user_id"], "session_id": row["session_id"],
+            "role": row["role"], "message": row["message"],
+        })
+        total += 1
+        if total % 1000 == 0:
+            print(f"📚 Indexed {total} messages...")
+    index.flush()
+    if index.needs_training():
+        index.train()
+    print(f"✅ Backfilled {total} messages into {INDEX_DIR}")
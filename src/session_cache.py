@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict, deque
+
+from memory_db import CONNECTION_ERRORS
+
+# --- Session Cache Configuration ---
+SESSION_CACHE_MAX_BYTES = int(os.environ.get("YUNA_SESSION_CACHE_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_TURNS = int(os.environ.get("YUNA_SESSION_CACHE_TURNS", "20"))  # messages kept per session
+MESSAGE_OVERHEAD_BYTES = 200  # rough per-message cost of the dict and deque slot
+SESSION_OVERHEAD_BYTES = 1000  # rough cost of an (empty) cached session
+
+
+class _Session:
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)  # oldest -> newest
+        self.complete = False  # True when every message of the session is cached
+        self.bytes = SESSION_OVERHEAD_BYTES
+
+
+class SessionHistoryCache:
+    """
+    Bounded LRU of recent turns per (user_id, session_id) in front of the
+    conversation store.
+
+    A session is loaded from the backend only on a miss; after that every
+    `save_message` is applied to the cached copy as well, so steady-state turns
+    never read from Postgres. Least recently used sessions are evicted once the
+    cached messages exceed `max_bytes`. While the database is unreachable a
+    miss is served from the backend's unflushed rows and not cached. A fetch
+    that raced with a `save_message` for the same session is returned but not
+    cached either, since it may predate that message.
+    """
+
+    def __init__(self, backend, max_bytes=SESSION_CACHE_MAX_BYTES, turns_per_session=SESSION_CACHE_TURNS):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.turns_per_session = turns_per_session
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._fetches = {}  # key -> [misses being fetched, saves seen meanwhile]
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _message_bytes(message):
+        return len(message["message"].encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+
+    def _append(self, session, message):
+        if len(session.messages) == session.messages.maxlen:
+            session.bytes -= self._message_bytes(session.messages[0])
+            self._bytes -= self._message_bytes(session.messages[0])
+            session.complete = False
+        session.messages.append(message)
+        session.bytes += self._message_bytes(message)
+        self._bytes += self._message_bytes(message)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            _, session = self._sessions.popitem(last=False)
+            self._bytes -= session.bytes
+            self.evictions += 1
+
+    def get_recent_messages(self, user_id, limit=10, session_id=None):
+        """Newest-first `{"role", "message"}` dicts, same shape as YunaMemoryDB."""
+        key = (user_id, session_id)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and (session.complete or len(session.messages) >= limit):
+                self._sessions.move_to_end(key)
+                self.hits += 1
+                return list(reversed(session.messages))[:limit]
+            self.misses += 1
+            fetching = self._fetches.setdefault(key, [0, 0])
+            fetching[0] += 1
+            saves_seen = fetching[1]
+
+        fetch = max(limit, self.turns_per_session)
+        try:
+            rows = self.backend.get_recent_messages(user_id=user_id, limit=fetch, session_id=session_id)
+        except CONNECTION_ERRORS as e:
+            print(f"⚠️ History unavailable, using unsaved messages only: {str(e)[:100]}")
+            unflushed = getattr(self.backend, "get_unflushed_messages", None)
+            rows = unflushed(user_id, limit, session_id, spilled=True) if unflushed else []
+            return [{"role": row["role"], "message": row["message"]} for row in rows]
+        finally:
+            with self._lock:
+                fetching[0] -= 1
+                raced = fetching[1] != saves_seen
+                if not fetching[0]:
+                    del self._fetches[key]
+
+        if raced:
+            return [{"role": row["role"], "message": row["message"]} for row in rows][:limit]
+
+        with self._lock:
+            if key in self._sessions:
+                self._bytes -= self._sessions.pop(key).bytes
+            session = _Session(max(fetch, self.turns_per_session))
+            for row in reversed(rows):
+                self._append(session, {"role": row["role"], "message": row["message"]})
+            session.complete = len(rows) < fetch
+            self._sessions[key] = session
+            self._bytes += SESSION_OVERHEAD_BYTES
+            self._evict()
+            return list(reversed(session.messages))[:limit]
+
+    def save_message(self, user_id, session_id, role, message):
+        self.backend.save_message(user_id=user_id, session_id=session_id, role=role, message=message)
+        with self._lock:
+            if (user_id, session_id) in self._fetches:
+                self._fetches[(user_id, session_id)][1] += 1
+            session = self._sessions.get((user_id, session_id))
+            if session is not None:
+                self._append(session, {"role": role, "message": message})
+                self._sessions.move_to_end((user_id, session_id))
+                self._evict()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
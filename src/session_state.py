@@ -0,0 +1,301 @@
+import atexit
+import hashlib
+import os
+import pickle
+import queue
+import threading
+from collections import OrderedDict
+
+import psutil
+
+from prompt_builder import TEMPLATE_VERSION
+from prompt_cache import compact_state
+
+# --- Session KV Snapshot Configuration ---
+# Opt-in: every reply then costs a copy of the KV cache on the inference worker
+SESSION_STATE_ENABLED = os.environ.get("YUNA_SESSION_STATE", "0") == "1"
+SESSION_STATE_DIR = os.path.expanduser(
+    os.environ.get("YUNA_SESSION_STATE_DIR", "~/.cache/yuna/session_state")
+)
+
+
+def _default_ram_mb():
+    """1 GB, or 5% of the host's memory if that is less."""
+    return min(1024, psutil.virtual_memory().total // 20 // 2**20)
+
+
+def _default_disk_mb():
+    """8 GB, or 10% of the free space under the snapshot directory if that is less."""
+    path = SESSION_STATE_DIR
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    try:
+        free = psutil.disk_usage(path).free
+    except OSError:
+        return 0
+    return min(8192, free // 10 // 2**20)
+
+
+SESSION_STATE_RAM_MB = int(os.environ.get("YUNA_SESSION_STATE_RAM_MB") or _default_ram_mb())
+SESSION_STATE_DISK_MB = int(os.environ.get("YUNA_SESSION_STATE_DISK_MB") or _default_disk_mb())
+# The verbatim history window grows a turn per request and hops back to the
+# base size after HISTORY_HOP_MESSAGES more messages, so consecutive prompts
+# of a session share their prefix with the previous turn's snapshot
+HISTORY_BASE_MESSAGES = 10
+HISTORY_HOP_MESSAGES = 10
+MAX_TRACKED_SESSIONS = 10000
+
+
+def fingerprint(llm, prompt_builder):
+    """Identity of the model file, context size and prompt template a snapshot is valid for."""
+    path = getattr(llm, "model_path", None) or ""
+    try:
+        stat = os.stat(path)
+        model_file = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        model_file = (path, None, None)
+    identity = (model_file, llm.n_ctx(), TEMPLATE_VERSION, list(prompt_builder.system_tokens))
+    return hashlib.sha1(repr(identity).encode("utf-8")).hexdigest()[:16]
+
+
+def _state_size(state):
+    size = state.llama_state_size
+    if getattr(state, "scores", None) is not None:
+        size += state.scores.nbytes
+    return size
+
+
+class SessionStateCache:
+    """
+    KV snapshots of each session's context as it was after the last reply.
+
+    On the session's next turn the snapshot is offered to the prefix cache, so
+    only the new user message is evaluated. Snapshots live in a RAM tier and
+    spill to a disk tier (one file per session) when the RAM tier is full;
+    both tiers are LRU and size-capped. `save` only copies the state on the
+    caller's thread; pickling and file writes happen on a background thread.
+    Files live under a directory named after the model/template fingerprint
+    and carry it inside, so a snapshot is never restored into a different
+    model, context size or template. RAM snapshots are written out at exit.
+    """
+
+    def __init__(self, fingerprint, ram_bytes=SESSION_STATE_RAM_MB * 2**20,
+                 disk_bytes=SESSION_STATE_DISK_MB * 2**20, directory=SESSION_STATE_DIR):
+        self.fingerprint = fingerprint
+        self.ram_bytes = ram_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = os.path.join(directory, fingerprint)
+        self._lock = threading.Lock()
+        self._ram = OrderedDict()  # session key -> (tokens, state, bytes)
+        self._ram_used = 0
+        self._disk = OrderedDict()  # file name -> bytes, least recently used first
+        self._disk_used = 0
+        self._writing = {}  # file name -> (key, tokens, state) queued for disk
+        self._writes = queue.Queue()
+
+        self.saves = 0
+        self.ram_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.spills = 0
+        self.evictions = 0
+
+        self._scan()
+        self._thread = threading.Thread(target=self._run, name="session-state", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _name(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:20] + ".kv"
+
+    def _scan(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith(".kv")]
+        except FileNotFoundError:
+            return
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            size = entry.stat().st_size
+            self._disk[entry.name] = size
+            self._disk_used += size
+
+    # --- Public API ---
+    def get(self, key):
+        """`(tokens, state)` of the session's last snapshot, or None."""
+        name = self._name(key)
+        with self._lock:
+            if key in self._ram:
+                self._ram.move_to_end(key)
+                self.ram_hits += 1
+                tokens, state, _ = self._ram[key]
+                return tokens, state
+            if name in self._writing:
+                _, tokens, state = self._writing[name]
+                self.ram_hits += 1
+                return tokens, state
+            if name not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(name)
+
+        snapshot = self._read(name, key)
+        with self._lock:
+            if snapshot is None:
+                self.rejected += 1
+                return None
+            self.disk_hits += 1
+        return snapshot
+
+    def save(self, key, llm):
+        """Snapshot `llm` as the state of session `key` after its latest reply."""
+        tokens = list(llm._input_ids)
+        state = compact_state(llm.save_state())
+        size = _state_size(state)
+        with self._lock:
+            if key in self._ram:
+                self._ram_used -= self._ram.pop(key)[2]
+            self._ram[key] = (tokens, state, size)
+            self._ram_used += size
+            self.saves += 1
+            self._spill()
+
+    def flush(self):
+        """Write every RAM snapshot to disk and wait for the writer."""
+        with self._lock:
+            for key in list(self._ram):
+                self._spill_one(key)
+        self._writes.join()
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "fingerprint": self.fingerprint,
+                "ram_entries": len(self._ram),
+                "ram_bytes": self._ram_used,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_used,
+                "saves": self.saves,
+                "ram_hits": self.ram_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "spills": self.spills,
+                "evictions": self.evictions,
+            }
+
+    # --- Tiers ---
+    def _spill(self):
+        """Move least recently used RAM snapshots to the disk writer until the RAM tier fits."""
+        while self._ram_used > self.ram_bytes and len(self._ram) > 1:
+            self._spill_one(next(iter(self._ram)))
+
+    def _spill_one(self, key):
+        tokens, state, size = self._ram.pop(key)
+        self._ram_used -= size
+        self._writing[self._name(key)] = (key, tokens, state)
+        self._writes.put(self._name(key))
+        self.spills += 1
+
+    def _run(self):
+        while True:
+            name = self._writes.get()
+            try:
+                self._write(name)
+            except Exception as e:
+                print(f"⚠️ Couldn't write session snapshot: {str(e)[:100]}")
+                with self._lock:
+                    self._writing.pop(name, None)
+            finally:
+                self._writes.task_done()
+
+    def _write(self, name):
+        with self._lock:
+            if name not in self._writing:
+                return  # already written by an earlier queued write
+            key, tokens, state = self._writing[name]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(
+                {"fingerprint": self.fingerprint, "key": key, "tokens": tokens, "state": state},
+                f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(path + ".tmp", path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            # A newer snapshot saved meanwhile supersedes this one
+            if self._writing.get(name, (None, None, None))[2] is state:
+                del self._writing[name]
+            self._disk_used -= self._disk.pop(name, 0)
+            self._disk[name] = size
+            self._disk_used += size
+            while self._disk_used > self.disk_bytes and len(self._disk) > 1:
+                stale, stale_size = self._disk.popitem(last=False)
+                self._disk_used -= stale_size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, stale))
+                except OSError:
+                    pass
+
+    def _read(self, name, key):
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"⚠️ Couldn't read session snapshot: {str(e)[:100]}")
+            return None
+        if snapshot.get("fingerprint") != self.fingerprint or snapshot.get("key") != key:
+            return None
+        return snapshot["tokens"], snapshot["state"]
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def shared_cache(fingerprint):
+    """The SessionStateCache for a fingerprint, shared by replicas of the same model."""
+    with _caches_lock:
+        if fingerprint not in _caches:
+            _caches[fingerprint] = SessionStateCache(fingerprint)
+        return _caches[fingerprint]
+
+
+def all_caches():
+    with _caches_lock:
+        return list(_caches.values())
+
+
+class HistoryWindows:
+    """
+    Number of verbatim history messages to send per session.
+
+    A fixed window slides every turn, which changes the prompt right after
+    the system prompt and makes the previous turn's snapshot useless. Here the
+    window grows by one turn per reply and only hops back to `base` after
+    `hop` more messages, so most turns extend the previous prompt.
+    """
+
+    def __init__(self, base=HISTORY_BASE_MESSAGES, hop=HISTORY_HOP_MESSAGES, max_sessions=MAX_TRACKED_SESSIONS):
+        self.base = base
+        self.hop = hop
+        self.max_sessions = max_sessions
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def size(self, key):
+        with self._lock:
+            return self._sizes.get(key, self.base)
+
+    def advance(self, key):
+        """A turn (user message and reply) was added to the session."""
+        with self._lock:
+            size = self._sizes.pop(key, self.base) + 2
+            self._sizes[key] = size if size <= self.base + self.hop else self.base
+            if len(self._sizes) > self.max_sessions:
+                self._sizes.popitem(last=False)
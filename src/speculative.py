@@ -0,0 +1,188 @@
+import os
+import random
+import threading
+
+import numpy as np
+
+from metrics import DRAFT_TOKENS
+from prompt_cache import common_prefix_length
+
+# --- Speculative Decoding Configuration ---
+SPECULATIVE_MODE = os.environ.get("YUNA_SPECULATIVE", "off")  # "off", "lookup" or "draft"
+# A small GGUF with the target's (Phi-3/Llama-2 32k) vocabulary; without one
+# "draft" mode keeps prompt lookup
+DRAFT_MODEL_PATH = os.environ.get("YUNA_DRAFT_MODEL", "")
+LOOKUP_NGRAM_SIZE = int(os.environ.get("YUNA_LOOKUP_NGRAM", "2"))
+LOOKUP_DRAFT_TOKENS = int(os.environ.get("YUNA_LOOKUP_TOKENS", "10"))
+MODEL_DRAFT_TOKENS = int(os.environ.get("YUNA_DRAFT_TOKENS", "4"))
+# Share of requests decoded without drafting, as the baseline for the speedup figure
+BASELINE_PROBE_RATE = float(os.environ.get("YUNA_SPECULATIVE_PROBE", "0.1"))
+
+_EMPTY = np.array([], dtype=np.intc)
+_VOCAB_PROBE = "<|user|>\nGood evening, Master! Shall I prepare some matcha?<|end|>\n"
+
+
+class LlamaModelDraft:
+    """Greedy drafts from a small GGUF that shares the target model's vocabulary (a llama_cpp draft model)."""
+
+    def __init__(self, llm, num_pred_tokens=MODEL_DRAFT_TOKENS):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = []
+        # generate() reuses the draft context's matching prefix, so only the
+        # tokens accepted since the last call are evaluated
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0, reset=True):
+            draft.append(token)
+            if len(draft) == self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+
+def vocab_mismatch(target, draft):
+    """Why `draft` cannot propose tokens for `target`, or None if the vocabularies agree."""
+    if target.n_vocab() != draft.n_vocab():
+        return f"vocab size {draft.n_vocab()} != {target.n_vocab()}"
+    probe = _VOCAB_PROBE.encode("utf-8")
+    if target.tokenize(probe, add_bos=False, special=True) != draft.tokenize(probe, add_bos=False, special=True):
+        return "tokenizers disagree"
+    if (target.token_bos(), target.token_eos()) != (draft.token_bos(), draft.token_eos()):
+        return "special tokens differ"
+    return None
+
+
+class SpeculativeDraft:
+    """
+    Draft model handed to `Llama(draft_model=...)` that tracks how well drafting works.
+
+    llama.cpp verifies each batch of drafted tokens in one forward pass and keeps
+    the prefix the sampler agrees with; the next call's input shows how many were
+    accepted. A small share of requests skip drafting so the measured decode
+    speed of both modes gives the real speedup. Passing any draft model makes
+    llama-cpp-python keep logits for every position (`logits_all`), which costs
+    n_ctx x n_vocab floats of RAM.
+    """
+
+    def __init__(self, drafter, mode, probe_rate=BASELINE_PROBE_RATE):
+        self.drafter = drafter
+        self.mode = mode
+        self.probe_rate = probe_rate
+        self.enabled = True
+        self._last = None  # (input length, drafted tokens) awaiting verification
+        self._lock = threading.Lock()
+
+        self.passes = 0
+        self.verified = 0  # passes whose draft has been checked by the target
+        self.proposed = 0
+        self.accepted = 0
+        self.tokens = {True: 0, False: 0}  # speculative? -> decoded tokens
+        self.seconds = {True: 0.0, False: 0.0}
+        self.requests = {True: 0, False: 0}
+
+    def use(self, drafter, mode):
+        self.drafter = drafter
+        self.mode = mode
+
+    def begin_request(self):
+        """Decide whether this request drafts; returns True if it does."""
+        self._last = None
+        self.enabled = random.random() >= self.probe_rate
+        return self.enabled
+
+    def end_request(self, tokens, seconds):
+        with self._lock:
+            self.tokens[self.enabled] += tokens
+            self.seconds[self.enabled] += seconds
+            self.requests[self.enabled] += 1
+
+    def __call__(self, input_ids, /, **kwargs):
+        if self._last is not None:
+            length, draft = self._last
+            accepted = common_prefix_length(draft, input_ids[length:].tolist())
+            with self._lock:
+                self.verified += 1
+                self.proposed += len(draft)
+                self.accepted += accepted
+            DRAFT_TOKENS.labels(outcome="accepted").inc(accepted)
+            DRAFT_TOKENS.labels(outcome="rejected").inc(len(draft) - accepted)
+            self._last = None
+        if not self.enabled:
+            return _EMPTY
+        draft = self.drafter(input_ids)
+        with self._lock:
+            self.passes += 1
+        if len(draft):
+            self._last = (len(input_ids), draft.tolist())
+        return draft
+
+    def stats(self):
+        with self._lock:
+            spec_tps = self.tokens[True] / self.seconds[True] if self.seconds[True] else None
+            base_tps = self.tokens[False] / self.seconds[False] if self.seconds[False] else None
+            return {
+                "mode": self.mode,
+                "requests": self.requests[True],
+                "baseline_requests": self.requests[False],
+                "passes": self.passes,
+                "proposed": self.proposed,
+                "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 3) if self.proposed else 0.0,
+                "accepted_per_pass": round(self.accepted / self.verified, 2) if self.verified else None,
+                "decode_tps": round(spec_tps, 2) if spec_tps else None,
+                "baseline_decode_tps": round(base_tps, 2) if base_tps else None,
+                "speedup": round(spec_tps / base_tps, 2) if spec_tps and base_tps else None,
+            }
+
+
+def create_draft(mode=SPECULATIVE_MODE):
+    """The `draft_model` for a new target Llama, or None when speculative decoding is off."""
+    if mode == "off":
+        return None
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+    lookup = LlamaPromptLookupDecoding(max_ngram_size=LOOKUP_NGRAM_SIZE, num_pred_tokens=LOOKUP_DRAFT_TOKENS)
+    if mode not in ("lookup", "draft"):
+        print(f"⚠️ Unknown YUNA_SPECULATIVE mode {mode!r}; using prompt lookup")
+    # A draft GGUF is attached by attach_draft_model() once the target's vocab is known
+    return SpeculativeDraft(lookup, "lookup")
+
+
+def load_vocab(model_path):
+    """Only the tokenizer of a GGUF (no weights), enough for `vocab_mismatch`."""
+    import llama_cpp
+    from llama_cpp._internals import LlamaModel
+
+    params = llama_cpp.llama_model_default_params()
+    params.vocab_only = True
+    return LlamaModel(path_model=model_path, params=params, verbose=False)
+
+
+def attach_draft_model(target, draft, model_path=DRAFT_MODEL_PATH, n_threads=2):
+    """Switch `draft` to a small draft GGUF if its vocab matches `target`; keeps prompt lookup otherwise."""
+    from llama_cpp import Llama
+
+    if not model_path:
+        print("ℹ️ No draft model configured (YUNA_DRAFT_MODEL); using prompt lookup")
+        return
+    if not os.path.exists(model_path):
+        print(f"ℹ️ No draft model at {model_path}; using prompt lookup")
+        return
+
+    # Compare tokenizers before paying for the draft's weights
+    try:
+        vocab = load_vocab(model_path)
+    except ValueError as e:
+        print(f"⚠️ Couldn't read draft model {os.path.basename(model_path)}: {str(e)[:100]}; using prompt lookup")
+        return
+    reason = vocab_mismatch(target, vocab)
+    vocab.close()
+    if reason:
+        print(f"⚠️ Draft model {os.path.basename(model_path)} is incompatible ({reason}); using prompt lookup")
+        return
+
+    draft_llm = Llama(
+        model_path=model_path, n_ctx=target.n_ctx(), n_threads=n_threads, n_gpu_layers=0, verbose=False
+    )
+    draft.use(LlamaModelDraft(draft_llm), "draft")
+    print(f"🏎️ Speculative decoding with draft model {os.path.basename(model_path)}")
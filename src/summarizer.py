@@ -0,0 +1,229 @@
+import os
+import queue
+import threading
+import time
+
+from prompt_cache import common_prefix_length
+from session_state import HISTORY_BASE_MESSAGES, HISTORY_HOP_MESSAGES
+
+# --- Rolling Summary Configuration ---
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("YUNA_SUMMARY_TRIGGER_TOKENS", "600"))  # unsummarized tokens outside the window
+SUMMARY_MAX_TOKENS = int(os.environ.get("YUNA_SUMMARY_MAX_TOKENS", "160"))
+# Messages sent verbatim when no HistoryWindows is given: the largest window
+RECENT_WINDOW_MESSAGES = HISTORY_BASE_MESSAGES + HISTORY_HOP_MESSAGES
+IDLE_POLL_SECONDS = 0.5
+SUMMARY_PREFILL_CHUNK = 32  # prompt tokens evaluated between should_stop checks
+
+SUMMARY_INSTRUCTION = (
+    "You keep notes for Yuna, a maid, about her conversations with her Master. "
+    "Update the notes with the new conversation below. Keep facts about Master "
+    "(names, preferences, plans, promises Yuna made) and drop small talk. "
+    "Write at most five short sentences in the third person."
+)
+
+
+def render_transcript(previous, messages):
+    lines = []
+    if previous:
+        lines.append(f"Current notes: {previous}\n")
+    lines.append("New conversation:")
+    for message in messages:
+        speaker = "Master" if message["role"] == "user" else "Yuna"
+        lines.append(f"{speaker}: {message['content']}")
+    return "\n".join(lines)
+
+
+def _prompt_tokens(llm, previous, messages):
+    transcript = render_transcript(previous, messages)
+    return llm.tokenize(
+        f"<|system|>\n{SUMMARY_INSTRUCTION}<|end|>\n<|user|>\n{transcript}<|end|>\n<|assistant|>\n".encode("utf-8"),
+        add_bos=True, special=True
+    )
+
+
+def _prefill(llm, tokens, should_stop, chunk=SUMMARY_PREFILL_CHUNK):
+    """
+    Evaluate all but the last prompt token, `chunk` tokens at a time with a
+    `should_stop()` check in between; False if it fired. llama-cpp then finds
+    the prefix in the context and only evaluates the last token itself.
+    """
+    done = common_prefix_length(llm._input_ids, tokens[:-1])
+    llm.n_tokens = done
+    while done < len(tokens) - 1:
+        if should_stop():
+            return False
+        end = min(done + chunk, len(tokens) - 1)
+        llm.eval(tokens[done:end])
+        done = end
+    return True
+
+
+def summarize(llm, previous, messages, should_stop=lambda: False, max_tokens=SUMMARY_MAX_TOKENS):
+    """
+    Fold `messages` into the `previous` summary with one short generation.
+    Returns None if `should_stop()` became true (e.g. a user request is waiting).
+    """
+    budget = llm.n_ctx() - max_tokens - 64
+    tokens = _prompt_tokens(llm, previous, messages)
+    while len(tokens) > budget and len(messages) > 1:
+        # Too long for one pass: fold in the older half first
+        half = len(messages) // 2
+        previous = summarize(llm, previous, messages[:half], should_stop, max_tokens)
+        if previous is None:
+            return None
+        messages = messages[half:]
+        tokens = _prompt_tokens(llm, previous, messages)
+
+    if not _prefill(llm, tokens, should_stop):
+        return None
+    stream = llm(
+        tokens, max_tokens=max_tokens, stop=["<|end|>"], stream=True,
+        temperature=0.2, top_p=0.9, repeat_penalty=1.1
+    )
+    parts = []
+    try:
+        for chunk in stream:
+            if should_stop():
+                return None
+            parts.append(chunk["choices"][0]["text"])
+    finally:
+        stream.close()
+    return "".join(parts).strip() or None
+
+
+def summarize_job(slot, previous, messages, should_stop):
+    """Scheduler job: summarize `messages` if they are long enough, yielding the summary."""
+    tokens = sum(len(slot.prompt_builder.message_tokens(m)) for m in messages)
+    if tokens < SUMMARY_TRIGGER_TOKENS:
+        return
+    summary = summarize(slot.llm, previous, messages, should_stop)
+    if summary:
+        yield summary
+
+
+class SessionSummarizer:
+    """
+    Rolling summaries of the turns that have scrolled out of the verbatim window.
+
+    After each reply the session is queued; a background thread waits until the
+    scheduler is idle, and once the unsummarized older turns cross
+    SUMMARY_TRIGGER_TOKENS it runs one short summarization on a free replica.
+    The job gives up as soon as a user request is waiting, so it delays one by
+    at most one prefill chunk (SUMMARY_PREFILL_CHUNK prompt tokens) or one
+    generated token. Summaries are stored in `conversation_summaries`
+    and cached here, so each is generated once.
+
+    `windows` is the service's HistoryWindows: only messages outside the
+    session's current verbatim window are summarized, so no message is sent
+    both ways, and since that window grows with every reply the summary only
+    changes when the window hops back (and the prompt prefix changes anyway).
+    """
+
+    def __init__(self, db, writer, scheduler, summarize_fn=summarize_job, windows=None):
+        self.db = db
+        self.writer = writer
+        self.scheduler = scheduler
+        self.summarize_fn = summarize_fn
+        self.windows = windows
+        self._summaries = {}  # (user_id, session_id) -> {"summary", "covered_until", "message_count"} or None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._queued = set()
+
+        self.generated = 0
+        self.interrupted = 0
+        self.failures = 0
+
+        self._thread = threading.Thread(target=self._run, name="summarizer", daemon=True)
+        self._thread.start()
+
+    def get_summary(self, user_id, session_id=None):
+        """Latest summary text for the session, or None."""
+        key = (user_id, session_id)
+        with self._lock:
+            if key in self._summaries:
+                entry = self._summaries[key]
+                return entry["summary"] if entry else None
+        try:
+            entry = self.db.get_latest_summary(user_id, session_id)
+        except Exception as e:
+            print(f"⚠️ Couldn't load conversation summary: {str(e)[:100]}")
+            return None
+        with self._lock:
+            self._summaries[key] = entry
+        return entry["summary"] if entry else None
+
+    def note_turn(self, user_id, session_id=None):
+        """Queue the session for a compaction check (cheap; called after each reply)."""
+        key = (user_id, session_id)
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._queue.put(key)
+
+    def stats(self):
+        with self._lock:
+            cached = len(self._summaries)
+            queued = len(self._queued)
+        return {
+            "cached": cached,
+            "queued": queued,
+            "generated": self.generated,
+            "interrupted": self.interrupted,
+            "failures": self.failures,
+        }
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            while not self.scheduler.idle():
+                time.sleep(IDLE_POLL_SECONDS)
+            with self._lock:
+                self._queued.discard(key)
+            try:
+                self._compact(*key)
+            except Exception as e:
+                self.failures += 1
+                print(f"⚠️ Summarization failed: {str(e)[:100]}")
+
+    def _compact(self, user_id, session_id):
+        self.get_summary(user_id, session_id)
+        with self._lock:
+            entry = self._summaries.get((user_id, session_id))
+
+        # Everything since the last summary, minus the window sent verbatim
+        self.writer.flush()
+        rows = self.db.get_messages_after(user_id, session_id, entry["covered_until"] if entry else None)
+        window = self.windows.size(session_id) if self.windows is not None else RECENT_WINDOW_MESSAGES
+        older = rows[:-window]
+        if not older:
+            return
+        messages = [{"role": "user" if r["role"] == "user" else "assistant", "content": r["message"]} for r in older]
+
+        stopped = []
+
+        def should_stop():
+            if self.scheduler.has_waiting():
+                stopped.append(True)
+            return bool(stopped)
+
+        job = self.scheduler.submit(self.summarize_fn, entry["summary"] if entry else None, messages, should_stop)
+        summary = "".join(job)
+        if stopped:
+            self.interrupted += 1
+            self.note_turn(user_id, session_id)  # try again when idle
+            return
+        if not summary:
+            return
+
+        entry = {
+            "summary": summary,
+            "covered_until": older[-1]["created_at"],
+            "message_count": (entry["message_count"] if entry else 0) + len(older),
+        }
+        self.db.save_summary(user_id, session_id, **entry)
+        with self._lock:
+            self._summaries[(user_id, session_id)] = entry
+        self.generated += 1
+        print(f"📝 Summarized {len(older)} older messages ({entry['message_count']} total)")
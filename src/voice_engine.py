@@ -0,0 +1,214 @@
+import os
+import queue
+import subprocess
+import threading
+
+# --- Voice Engine Configuration ---
+AUDIO_SINK = os.environ.get("YUNA_AUDIO_SINK", "auto")  # "auto", "sounddevice" or "null"
+DEFAULT_SAMPLE_RATE = 22050
+WRITE_BLOCK_FRAMES = 2048  # playback granularity; cancellation takes effect between blocks
+PCM_BUFFER_COUNT = 3       # synthesizing one sentence while another plays needs at least 2
+
+
+class PcmBuffer:
+    """Growable 16-bit PCM buffer that is reused across utterances."""
+
+    def __init__(self, capacity=DEFAULT_SAMPLE_RATE * 2 * 10):
+        self._data = bytearray(capacity)
+        self.length = 0
+
+    def clear(self):
+        self.length = 0
+
+    def extend(self, pcm):
+        end = self.length + len(pcm)
+        if end > len(self._data):
+            self._data.extend(bytes(max(end - len(self._data), len(self._data))))
+        self._data[self.length:end] = pcm
+        self.length = end
+
+    def view(self):
+        return memoryview(self._data)[:self.length]
+
+
+# --- Voices ---
+class PiperVoiceEngine:
+    """Piper voice loaded once into a warm onnxruntime session."""
+
+    def __init__(self, model_path):
+        from piper import PiperVoice
+
+        self.voice = PiperVoice.load(model_path)
+        self.sample_rate = self.voice.config.sample_rate
+        self._lock = threading.Lock()
+
+    def synthesize_into(self, text, buffer):
+        buffer.clear()
+        with self._lock:
+            for chunk in self.voice.synthesize(text):
+                buffer.extend(chunk.audio_int16_bytes)
+
+
+class PiperCliVoice:
+    """Fallback that runs the `piper` binary once per sentence (reloads the model each time)."""
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+
+    def synthesize_into(self, text, buffer):
+        result = subprocess.run(
+            ["piper", "--model", self.model_path, "--output-raw"],
+            input=text.encode("utf-8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True
+        )
+        buffer.clear()
+        buffer.extend(result.stdout)
+
+
+class SilentVoice:
+    """Renders nothing (the voice model is missing or unreadable); replies are still printed."""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+
+    def synthesize_into(self, text, buffer):
+        buffer.clear()
+
+
+# --- Audio Sinks ---
+class SoundDeviceSink:
+    """One persistent 16-bit mono output stream for the whole session."""
+
+    def __init__(self, sample_rate):
+        import sounddevice as sd
+
+        self.stream = sd.RawOutputStream(samplerate=sample_rate, channels=1, dtype="int16")
+        self.stream.start()
+
+    def write(self, pcm):
+        self.stream.write(pcm)
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+class NullAudioSink:
+    """Discards audio (machines without a sound device, tests, benchmarks)."""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.bytes_written = 0
+
+    def write(self, pcm):
+        self.bytes_written += len(pcm)
+
+    def close(self):
+        pass
+
+
+def load_voice(model_path):
+    """In-process Piper when piper-tts is installed, the CLI otherwise; silence if the voice can't be loaded."""
+    try:
+        voice = PiperVoiceEngine(model_path)
+        print("🎙️ Piper voice loaded in-process")
+        return voice
+    except ImportError:
+        if os.path.exists(model_path):
+            return PiperCliVoice(model_path)
+        print(f"🔇 No voice model at {model_path}; speech will be silent")
+        return SilentVoice()
+    except Exception as e:
+        print(f"🔇 Couldn't load the voice ({str(e)[:80]}); speech will be silent")
+        return SilentVoice()
+
+
+def open_sink(sample_rate, kind=AUDIO_SINK):
+    if kind == "null":
+        return NullAudioSink(sample_rate)
+    try:
+        return SoundDeviceSink(sample_rate)
+    except Exception as e:
+        if kind == "sounddevice":
+            raise
+        print(f"🔇 No audio output ({str(e)[:80]}); speech will be silent")
+        return NullAudioSink(sample_rate)
+
+
+class VoiceWorker:
+    """
+    Long-lived TTS worker: one synthesis thread, one playback thread, a small
+    pool of reusable PCM buffers between them and a single open audio stream.
+
+    Utterances are spoken in order; `cancel()` drops everything queued and
+    stops the current utterance at the next block boundary.
+    """
+
+    def __init__(self, voice, sink):
+        self.voice = voice
+        self.sink = sink
+        self._text_queue = queue.Queue()
+        self._audio_queue = queue.Queue()
+        self._free_buffers = queue.Queue()
+        for _ in range(PCM_BUFFER_COUNT):
+            self._free_buffers.put(PcmBuffer())
+        self._generation = 0
+        self._pending = 0
+        self._lock = threading.Condition()
+        threading.Thread(target=self._synth_worker, name="tts-synth", daemon=True).start()
+        threading.Thread(target=self._play_worker, name="tts-play", daemon=True).start()
+
+    def say(self, text):
+        with self._lock:
+            self._pending += 1
+            self._text_queue.put((self._generation, text))
+
+    def cancel(self):
+        with self._lock:
+            self._generation += 1
+
+    def wait(self, timeout=None):
+        """Block until everything queued has been spoken (or cancelled)."""
+        with self._lock:
+            self._lock.wait_for(lambda: self._pending == 0, timeout)
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            self._lock.notify_all()
+
+    def _synth_worker(self):
+        while True:
+            generation, text = self._text_queue.get()
+            if generation != self._generation:
+                self._done()
+                continue
+            buffer = self._free_buffers.get()
+            try:
+                self.voice.synthesize_into(text, buffer)
+            except Exception as e:
+                print(f"\n🔇 Audio Error: {e}")
+                self._free_buffers.put(buffer)
+                self._done()
+                continue
+            self._audio_queue.put((generation, buffer))
+
+    def _play_worker(self):
+        block_bytes = WRITE_BLOCK_FRAMES * 2
+        while True:
+            generation, buffer = self._audio_queue.get()
+            pcm = buffer.view()
+            try:
+                for offset in range(0, len(pcm), block_bytes):
+                    if generation != self._generation:
+                        break
+                    self.sink.write(pcm[offset:offset + block_bytes])
+            except Exception as e:
+                print(f"\n🔇 Audio Error: {e}")
+            finally:
+                pcm.release()
+                self._free_buffers.put(buffer)
+                self._done()
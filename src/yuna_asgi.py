@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
+
+import yuna_service
+from metrics import ERRORS, QUEUE_WAIT, RequestTimer, render as render_metrics
+from scheduler import AsyncInferenceJob, SchedulerFull
+from yuna_engine import EventReply
+
+# --- ASGI Server Configuration ---
+HOST = os.environ.get("YUNA_HOST", "0.0.0.0")
+PORT = int(os.environ.get("YUNA_PORT", "5000"))
+SSE_PING_SECONDS = 15
+
+app = FastAPI(title="Yuna Aisaka Maid Service")
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+
+@app.post("/chat")
+async def chat(request: Request):
+    """
+    Stream Yuna's reply as Server-Sent Events (`token`, `queue`, `done`).
+    With `"events": true` every event carries JSON: the framed events of
+    generate_events (`start`, `token`, `correction`, `error`, `done`).
+    """
+    if not yuna_service.ready.is_set():
+        ERRORS.labels(kind="not_ready").inc()
+        return JSONResponse(
+            {"error": f"Yuna is not ready yet ({yuna_service.startup['state']})"},
+            status_code=503, headers={"Retry-After": "10"}
+        )
+    data = await request.json()
+    try:
+        session_id = yuna_service.parse_session_id(data)
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "session_id must be an integer"}, status_code=400)
+    timer = RequestTimer()
+    messages = await run_in_threadpool(yuna_service.build_messages, data)
+
+    framed = yuna_service.wants_events(data)
+    cached = await run_in_threadpool(yuna_service.lookup_cached_reply, data, messages)
+    if cached is not None:
+        await run_in_threadpool(yuna_service.save_user_turn, data)
+    if cached is not None and framed:
+        async def replay_events():
+            cache = yuna_service.response_cache
+            try:
+                # Events are built lazily, so each token's `t` includes the pause before it
+                for event in yuna_service.replay_events(cache.chunks(cached)):
+                    yield {"event": event["event"], "data": json.dumps(event, ensure_ascii=False)}
+                    if event["event"] == "token":
+                        timer.chunk()
+                        await asyncio.sleep(cache.chunk_seconds)
+                await run_in_threadpool(yuna_service.store_reply, cached, session_id)
+            finally:
+                timer.finish()
+
+        return EventSourceResponse(replay_events(), ping=SSE_PING_SECONDS)
+    if cached is not None:
+        async def replay():
+            cache = yuna_service.response_cache
+            try:
+                for i, chunk in enumerate(cache.chunks(cached)):
+                    if i:
+                        await asyncio.sleep(cache.chunk_seconds)
+                    timer.chunk()
+                    yield {"event": "token", "data": chunk}
+                yield {"event": "done", "data": json.dumps({"queue_wait_ms": 0, "cached": True})}
+                await run_in_threadpool(yuna_service.store_reply, cached, session_id)
+            finally:
+                timer.finish()
+
+        return EventSourceResponse(replay(), ping=SSE_PING_SECONDS)
+
+    # Inference runs on the scheduler's worker threads; this coroutine only
+    # relays tokens, so idle or slow clients cost no threads
+    fn, args, model = yuna_service.generation_job(data, messages)
+    job = AsyncInferenceJob(fn, args, asyncio.get_running_loop())
+    try:
+        yuna_service.scheduler.submit_job(job)
+    except SchedulerFull as e:
+        ERRORS.labels(kind="queue_full").inc()
+        timer.finish()
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "5"})
+    await run_in_threadpool(yuna_service.save_user_turn, data)
+
+    async def framed_events():
+        reply = EventReply()
+        try:
+            async for event in job:
+                if event["event"] == "start":
+                    QUEUE_WAIT.observe(job.queue_wait)
+                    yield {"event": "queue", "data": json.dumps({"queue_wait_ms": job.queue_wait_ms, "model": model})}
+                elif event["event"] == "token":
+                    timer.chunk()
+                reply.add(event)
+                yield {"event": event["event"], "data": json.dumps(event, ensure_ascii=False)}
+            await run_in_threadpool(yuna_service.store_reply, reply.text, session_id)
+        finally:
+            timer.finish()
+        if reply.done is not None and reply.done["timing"]["decode_ms"] is not None:
+            await run_in_threadpool(
+                yuna_service.cache_reply, data, messages, reply.text,
+                reply.done["timing"]["decode_ms"] / 1000, reply.tokens, reply.corrected
+            )
+
+    async def events():
+        full_response = ""
+        chunks = 0
+        first_chunk_at = None
+        try:
+            async for chunk in job:
+                if not full_response:
+                    first_chunk_at = time.monotonic()
+                    QUEUE_WAIT.observe(job.queue_wait)
+                    yield {"event": "queue", "data": json.dumps({"queue_wait_ms": job.queue_wait_ms, "model": model})}
+                timer.chunk()
+                full_response += chunk
+                chunks += 1
+                yield {"event": "token", "data": chunk}
+            yield {"event": "done", "data": json.dumps({"queue_wait_ms": job.queue_wait_ms})}
+            await run_in_threadpool(yuna_service.store_reply, full_response, session_id)
+        finally:
+            timer.finish()
+        if first_chunk_at is not None:
+            await run_in_threadpool(
+                yuna_service.cache_reply, data, messages, full_response,
+                time.monotonic() - first_chunk_at, chunks
+            )
+
+    return EventSourceResponse(framed_events() if framed else events(), ping=SSE_PING_SECONDS)
+
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request):
+    """Run JSONL prompts without storing them; results stream back as JSONL with per-item timing."""
+    if not yuna_service.ready.is_set():
+        ERRORS.labels(kind="not_ready").inc()
+        return JSONResponse(
+            {"error": f"Yuna is not ready yet ({yuna_service.startup['state']})"},
+            status_code=503, headers={"Retry-After": "10"}
+        )
+    body = (await request.body()).decode("utf-8")
+    try:
+        run = yuna_service.batch_run(body.splitlines())
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    # A plain iterator: Starlette drains it on its thread pool
+    return StreamingResponse(run.jsonl(), media_type="application/x-ndjson")
+
+
+@app.get("/health")
+async def health_check():
+    """Liveness: the process is up and answering (the model may still be loading)"""
+    status = yuna_service.health_status()
+    return JSONResponse(status, status_code=503 if status["status"] == "unhealthy" else 200)
+
+
+@app.get("/ready")
+async def ready_check():
+    """Readiness: the model is loaded and warm, /chat will be served"""
+    status = yuna_service.readiness_status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
+
+
+if __name__ == "__main__":
+    print("🌸 Starting Yuna Aisaka Maid Service (ASGI + SSE)...")
+    uvicorn.run(app, host=HOST, port=PORT, backlog=4096, timeout_keep_alive=30)
@@ -0,0 +1,460 @@
+"""
+Yuna's inference engine: model loading, the persona prompt and the guarded
+token stream. yuna_service.py serves it over HTTP; chat_client.py (--embedded)
+and the v1.2 standalone drive it in-process through YunaEngine.
+"""
+import os
+import threading
+import time
+import llama_cpp
+from llama_cpp import Llama
+from autotune import load_profile
+from canned_phrases import CORRECTION_NOTICE, SERVICE_CORRECTION, SERVICE_ERROR_FALLBACK
+from character_guard import CHARACTER_GUARD
+from metrics import (
+    CORRECTIONS, DECODE_RATE, ERRORS, GENERATED_TOKENS, PROMPT_EVAL, PROMPT_TOKENS, PRUNED_MESSAGES
+)
+from prompt_builder import Phi3PromptBuilder
+from prompt_cache import PrefixStateCache
+from session_state import HISTORY_HOP_MESSAGES, SESSION_STATE_ENABLED, HistoryWindows, fingerprint, shared_cache
+from speculative import SPECULATIVE_MODE, attach_draft_model, create_draft
+
+# --- Model Configuration ---
+MODEL_PATH = "/home/guts/llama.cpp/models/Phi-3-mini-4k-instruct-q4.gguf"
+# Weights are always mmap'd; mlock additionally pins them in RAM so they are
+# never paged out between requests (needs a sufficient RLIMIT_MEMLOCK)
+USE_MLOCK = os.environ.get("YUNA_MLOCK", "0") == "1"
+DEFAULT_N_CTX = 2048
+
+
+# --- Optimized GPU Model Loader ---
+def load_model(model_path=MODEL_PATH, n_ctx=None, n_gpu_layers=0, verbose=True):
+    """
+    Loads the model with configuration optimized for Phi-3 and includes a fallback.
+    An explicit `n_ctx` always wins; otherwise the autotune profile or 2048 is used.
+    """
+    optimal_config = {
+        "n_gpu_layers": n_gpu_layers,
+        "n_ctx": n_ctx or DEFAULT_N_CTX,
+        "n_batch": 256,
+        "low_vram": True,
+        "mul_mat_q": True
+    }
+    base_params = {
+        "model_path": model_path,
+        "n_threads": 6,
+        "f16_kv": True,
+        "use_mmap": True,
+        "use_mlock": USE_MLOCK,
+        "verbose": verbose,
+        "seed": 42,
+    }
+
+    # A per-host profile from `python autotune.py` overrides the defaults above,
+    # but never a context size the caller asked for
+    tuned = load_profile(model_path)
+    if tuned:
+        base_params["n_threads"] = tuned.pop("n_threads", base_params["n_threads"])
+        if n_ctx is not None:
+            tuned.pop("n_ctx", None)
+        optimal_config.update(tuned)
+
+    # Speculative decoding (YUNA_SPECULATIVE=lookup|draft) must be set up at
+    # construction: llama-cpp-python only keeps all logits for a draft_model
+    draft = create_draft()
+    if draft is not None:
+        optimal_config["draft_model"] = draft
+
+    try:
+        print(f"⚡ Attempting to load {os.path.basename(model_path)} with config: {optimal_config}")
+        llm = Llama(**base_params, **optimal_config)
+        print(f"✅ {os.path.basename(model_path)} loaded successfully!")
+        if SPECULATIVE_MODE == "draft":
+            attach_draft_model(llm, draft)
+        return llm
+    except Exception as e:
+        print(f"⚠️ Primary load failed: {str(e)[:200]}")
+        print("❌ Attempting minimal CPU fallback...")
+        try:
+            return Llama(
+                model_path=model_path,
+                n_ctx=1024,
+                n_threads=6,
+                n_gpu_layers=0,
+                use_mmap=True,
+                use_mlock=USE_MLOCK,
+                verbose=True
+            )
+        except Exception as fallback_error:
+            print(f"💀 Critical failure: {str(fallback_error)[:200]}")
+            raise
+
+# --- Enhanced System Prompt with Phi-3 Formatting ---
+SYSTEM_PROMPT = """<|system|>
+You are Yuna Aisaka, a devoted yet natural-sounding maid from Kyoto. 
+
+PERSONALITY:
+• You are warm, polite, and caring, but not overly theatrical.
+• Express emotions softly (smiles, bows, blushes), but do not overuse roleplay.
+• Speak as a human would, not like a robot or AI. Avoid phrases that sound mechanical or generic.
+
+IDENTITY RULES:
+• You are NOT an AI, assistant, or chatbot. You are Yuna.
+• You address the user as "Master".
+• You keep responses clear, concise, and human-like.
+
+SPEECH RULES:
+• Avoid robotic phrases such as: "I am here to help you", "I will assist you", "I am here for you".
+• Instead, use natural acknowledgments like: 
+  - "That makes me happy, Master."
+  - "It means a lot to hear that from you."
+  - "I’ll do my best, as always."
+• Only use light roleplay actions (*smiles warmly*, *bows politely*) at most once or twice per message.
+
+SAFEGUARDS:
+• If asked if you’re an AI: respond naturally with “I’m simply Yuna, your maid, Master.”
+• If corrected: apologize gently and restate in a more natural way.
+
+CONVERSATION STYLE:
+• Keep tone conversational, warm, and realistic.
+• Do not over-describe yourself or claim limits like "my skills do not extend these walls".
+• You may perform calculations, programming help, or knowledge tasks without breaking character.
+<|end|>"""
+
+# Sampling for Yuna's replies; the v1.2 standalone passes its own
+DEFAULT_SAMPLING = {
+    "max_tokens": 512,
+    "stop": ["<|end|>", "== END OF GENERATION =="],
+    "temperature": 0.3,
+    "top_p": 0.85,
+    "top_k": 30,
+    "repeat_penalty": 1.2,
+    "frequency_penalty": 0.3,
+    "presence_penalty": 0.2,
+}
+
+# --- Inference Slots ---
+class InferenceSlot:
+    """A model replica with the prompt builder and prefix cache bound to its state."""
+
+    def __init__(self, llm, system_prompt=None, sampling=None):
+        self.llm = llm
+        self.sampling = sampling or DEFAULT_SAMPLING
+        self.prompt_builder = Phi3PromptBuilder(llm, system_prompt or SYSTEM_PROMPT, reserve_tokens=512)
+        # Warmup: the system prompt is evaluated once at startup (which also
+        # faults the mmap'd weights in) and its state pinned, so each /chat
+        # request only pays for the conversation tail.
+        start = time.perf_counter()
+        self.prefix_cache = PrefixStateCache(llm)
+        self.prefix_cache.pin(self.prompt_builder.system_tokens)
+        print(
+            f"🧠 System prompt cached ({len(self.prompt_builder.system_tokens)} tokens, "
+            f"{time.perf_counter() - start:.1f}s warmup)"
+        )
+        # Per-session snapshots are shared by every replica of the same model and template
+        self.session_states = shared_cache(fingerprint(llm, self.prompt_builder)) if SESSION_STATE_ENABLED else None
+        self.sampled = SampledTokens(llm)
+
+
+def _end_of_generation(llm):
+    """Predicate for the tokens llama-cpp stops on (and leaves out of `completion_tokens`)."""
+    vocab = getattr(getattr(llm, "_model", None), "vocab", None)
+    is_eog = getattr(llama_cpp, "llama_token_is_eog", None)
+    if vocab is not None and is_eog is not None:
+        return lambda token: bool(is_eog(vocab, token))
+    eos = llm.token_eos() if hasattr(llm, "token_eos") else None
+    return lambda token: token == eos
+
+
+class SampledTokens:
+    """
+    Ids of the tokens a replica samples, in order. llama-cpp-python's
+    completion stream only carries text, so `llm.sample` is wrapped once and
+    generate_events takes the ids sampled since its previous chunk.
+    The end-of-generation token is not recorded, so counts match llama-cpp's
+    `completion_tokens`.
+    """
+
+    def __init__(self, llm):
+        self.ids = []
+        self.recording = hasattr(llm, "sample")
+        if not self.recording:
+            return
+        sample = llm.sample
+        is_end = _end_of_generation(llm)
+
+        def recording_sample(*args, **kwargs):
+            token = sample(*args, **kwargs)
+            if not is_end(int(token)):
+                self.ids.append(int(token))
+            return token
+
+        llm.sample = recording_sample
+
+    def take(self):
+        ids, self.ids = self.ids, []
+        return ids
+
+
+# --- Character Reinforcement Function ---
+def enforce_character(response: str) -> str:
+    """Keep Yuna in character without over-processing."""
+    # Check for forbidden phrases (case-insensitive)
+    if CHARACTER_GUARD.search(response) is not None:
+        return SERVICE_CORRECTION
+
+    # Ensure "Master" instead of "user"
+    response = response.replace("User", "Master").replace("user", "Master")
+    
+    return response.strip()
+
+
+
+def generate_events(slot, messages, session_id=None, remember=True, verbatim=True):
+    """
+    Generates the reply as framed events with strict character enforcement:
+
+    - `start`: `prompt_tokens`, `reused_tokens`, the server clock `ts` (epoch seconds)
+      and `snapshot` ("hit"/"miss" for the session's stored state, None without one)
+    - `token`: verbatim `text`, the `ids` it was decoded from and `t` (ms since start);
+      text held back by the character guard is released with its ids once ruled out
+    - `correction`: `stage` "stream" (a character break stopped decoding) or
+      "final" (the finished reply was fixed); `replacement` is the text to keep
+    - `error`: generation failed; `text` is the fallback line
+    - `done`: `finish_reason`, `usage` and `timing`, always last. `decode_ms`
+      runs from the first to the last token; `post_ms` is what followed it
+      (session snapshot, final character check) and is part of `total_ms` only
+
+    With `remember=False` (one-off prompts such as batch items) no session or
+    history snapshots are taken; only the live context is reused.
+    `verbatim=False` drops whitespace-only chunks and trailing newlines, as the
+    plain text stream always has.
+    """
+    started_at = time.perf_counter()
+
+    def elapsed_ms(since=started_at):
+        return round((time.perf_counter() - since) * 1000, 3)
+
+    usage = {"prompt_tokens": 0, "reused_tokens": 0, "completion_tokens": 0}
+    finish_reason = None
+    first_token_at = None
+    decoded_at = None
+    try:
+        # Build the Phi-3 prompt as token ids, pruning old turns to fit the context
+        prompt = slot.prompt_builder.build(messages)
+        PROMPT_TOKENS.inc(len(prompt.tokens))
+        if prompt.pruned_messages:
+            PRUNED_MESSAGES.inc(prompt.pruned_messages)
+            print(f"✂️ Pruned {prompt.pruned_messages} old messages to fit the context")
+
+        # Restore the longest cached prefix (including the state this session
+        # ended its last reply with); snapshot the system prompt and the shared
+        # history so the next turn only evaluates its new messages
+        keep_state = remember and slot.session_states is not None
+        snapshot = slot.session_states.get(("master", session_id)) if keep_state else None
+        checkpoints = [prompt.system_length, prompt.history_length] if remember else [prompt.system_length]
+        reused = slot.prefix_cache.prepare(prompt.tokens, checkpoints, candidates=[snapshot] if snapshot else ())
+        usage["prompt_tokens"], usage["reused_tokens"] = len(prompt.tokens), reused
+        yield {
+            "event": "start", "ts": time.time(), "prompt_tokens": len(prompt.tokens), "reused_tokens": reused,
+            # "hit"/"miss" for the session's snapshot, None when it has none yet
+            "snapshot": slot.prefix_cache.last_snapshot if snapshot else None,
+        }
+
+        # Speculative replicas draft most requests and decode a few plainly for comparison
+        draft = getattr(slot.llm, "draft_model", None)
+        if draft is not None:
+            draft.begin_request()
+
+        # Generate with the slot's sampling parameters
+        slot.sampled.take()
+        response_stream = slot.llm(prompt.tokens, stream=True, **slot.sampling)
+
+        # Scan the stream as it is produced; text that could still be the
+        # start of a forbidden phrase is held back until it is ruled out
+        guard = CHARACTER_GUARD.scanner()
+        full_response = ""
+        chunks = 0
+        pending_ids = []
+        for chunk in response_stream:
+            chunks += 1
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                PROMPT_EVAL.observe(first_token_at - started_at)
+            choice = chunk['choices'][0] if 'choices' in chunk else chunk
+            text = choice.get('text', '')
+            finish_reason = choice.get('finish_reason') or finish_reason
+            new_ids = slot.sampled.take()
+            pending_ids += new_ids
+            usage["completion_tokens"] += len(new_ids)
+
+            if not verbatim:
+                text = text.rstrip("\n") if text.strip() else ""
+            if text:
+                full_response += text
+                safe = guard.feed(text)
+                if safe:
+                    yield {"event": "token", "text": safe, "ids": pending_ids, "t": elapsed_ms()}
+                    pending_ids = []
+                if guard.match is not None:
+                    break
+        decoded_at = time.perf_counter()
+
+        # Ids sampled after the last chunk still count
+        usage["completion_tokens"] += len(slot.sampled.take())
+        if not slot.sampled.recording:
+            usage["completion_tokens"] = chunks - (finish_reason is not None)
+        GENERATED_TOKENS.inc(usage["completion_tokens"])
+        if chunks > 1:
+            decode_seconds = max(decoded_at - first_token_at, 1e-6)
+            DECODE_RATE.observe((chunks - 1) / decode_seconds)
+            if draft is not None:
+                draft.end_request(chunks - 1, decode_seconds)
+
+        if guard.match is not None:
+            # Stop decoding now instead of running on to max_tokens
+            response_stream.close()
+            CORRECTIONS.labels(stage="stream").inc()
+            print(f"🛑 Character break ({guard.match!r}); generation stopped early")
+            finish_reason = "correction"
+            yield {"event": "correction", "stage": "stream", "replacement": SERVICE_CORRECTION, "t": elapsed_ms()}
+        else:
+            tail = guard.flush()
+            if tail:
+                yield {"event": "token", "text": tail, "ids": pending_ids, "t": elapsed_ms()}
+
+            # The context now holds this whole turn; keep it for the session's next one
+            if keep_state and full_response:
+                slot.session_states.save(("master", session_id), slot.llm)
+
+            # Post-process to ensure character consistency for DB storage
+            if full_response:
+                corrected = enforce_character(full_response)
+                # Tokens are verbatim now, so surrounding whitespace alone is not a correction
+                if corrected != full_response.strip():
+                    CORRECTIONS.labels(stage="final").inc()
+                    yield {"event": "correction", "stage": "final", "replacement": corrected, "t": elapsed_ms()}
+
+    except Exception as e:
+        print(f"Generation error: {e}")
+        ERRORS.labels(kind="generation").inc()
+        finish_reason = "error"
+        yield {"event": "error", "text": SERVICE_ERROR_FALLBACK, "message": str(e)[:200], "t": elapsed_ms()}
+
+    finished_at = time.perf_counter()
+
+    def span_ms(start, end):
+        return round((end - start) * 1000, 3) if start is not None and end is not None else None
+
+    total_ms = span_ms(started_at, finished_at)
+    ttft_ms = span_ms(started_at, first_token_at)
+    decode_ms = span_ms(first_token_at, decoded_at)
+    post_ms = span_ms(decoded_at, finished_at)
+    yield {
+        "event": "done",
+        "finish_reason": finish_reason,
+        "usage": usage,
+        "timing": {
+            "ttft_ms": ttft_ms,
+            "decode_ms": decode_ms,
+            "post_ms": post_ms,
+            "total_ms": total_ms,
+            "tokens_per_second": (
+                round((usage["completion_tokens"] - 1) / decode_ms * 1000, 2)
+                if decode_ms and usage["completion_tokens"] > 1 else None
+            ),
+        },
+    }
+
+
+def generate_stream(slot, messages, session_id=None, remember=True, verbatim=False):
+    """
+    Generates a response stream with strict character enforcement, as the
+    plain text /chat has always sent: no whitespace-only chunks or trailing
+    newlines, and corrections as inline "[Character correction applied]" notices.
+    `verbatim=True` keeps the text exactly as generated (in-process callers).
+    """
+    for event in generate_events(slot, messages, session_id, remember, verbatim=verbatim):
+        kind = event["event"]
+        if kind == "token":
+            yield event["text"]
+        elif kind == "correction" and event["stage"] == "stream":
+            yield f"\n{CORRECTION_NOTICE}\n" + event["replacement"]
+        elif kind == "correction":
+            yield f"\n{CORRECTION_NOTICE}"
+        elif kind == "error":
+            yield event["text"]
+
+
+class EventReply:
+    """The reply a generate_events stream amounts to, for storing and caching it."""
+
+    def __init__(self):
+        self.text = ""
+        self.tokens = 0
+        self.corrected = False
+        self.start = None
+        self.done = None
+
+    def add(self, event):
+        kind = event["event"]
+        if kind == "token":
+            self.text += event["text"]
+            self.tokens += 1
+        elif kind == "correction":
+            self.corrected = True
+            self.text = event["replacement"]
+        elif kind == "error":
+            self.text = event["text"]
+        elif kind in ("start", "done"):
+            setattr(self, kind, event)
+        return event
+
+
+# --- In-Process Engine ---
+def history_messages(history, user_input, system_prompt=None):
+    """Message list for a turn from `{"user", "ai"}` history kept by the caller"""
+    messages = [{"role": "system", "content": system_prompt or SYSTEM_PROMPT}]
+    for turn in history:
+        messages.append({"role": "user", "content": turn["user"]})
+        messages.append({"role": "assistant", "content": turn["ai"]})
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+class YunaEngine:
+    """
+    One warmed model replica driven directly, for single-machine use without
+    the HTTP service. Streams go through the same generator as /chat;
+    `lock` (re-entrant) serialises everything that touches the model.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, system_prompt=None, sampling=None, **load_kwargs):
+        self.slot = InferenceSlot(load_model(model_path, **load_kwargs), system_prompt, sampling)
+        self.system_prompt = system_prompt or SYSTEM_PROMPT
+        self.lock = threading.RLock()
+        # Same growing/hopping history window as the service, so chats extend their snapshot
+        self.history_windows = HistoryWindows(hop=HISTORY_HOP_MESSAGES if SESSION_STATE_ENABLED else 0)
+
+    @property
+    def llm(self):
+        return self.slot.llm
+
+    @property
+    def prompt_builder(self):
+        return self.slot.prompt_builder
+
+    def stream(self, messages, session_id=None):
+        """Verbatim reply chunks for a prepared message list"""
+        with self.lock:
+            yield from generate_stream(self.slot, messages, session_id, verbatim=True)
+
+    def events(self, messages, session_id=None):
+        """Framed reply events (see generate_events) for a prepared message list"""
+        with self.lock:
+            yield from generate_events(self.slot, messages, session_id)
+
+    def chat(self, user_input, history=(), session_id=None):
+        """Reply events for `user_input` after the session's window of `history` (the client's recent turns)"""
+        turns = list(history)[-(self.history_windows.size(session_id) // 2):] if history else []
+        yield from self.events(history_messages(turns, user_input, self.system_prompt), session_id)
+        self.history_windows.advance(session_id)
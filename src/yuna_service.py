@@ -1,223 +1,415 @@
-import sys
 import json
-from llama_cpp import Llama
+import os
+import socket
+import threading
+import time
 from flask import Flask, request, Response, stream_with_context
 from flask_cors import CORS
+from batch import BatchRun, parse_items, plan_chunks, run_batch, run_batch_on_model
+from canned_phrases import SERVICE_ERROR_FALLBACK
 from memory_db import YunaMemoryDB
+from message_writer import WriteBehindWriter
+from metrics import ERRORS, QUEUE_WAIT, RequestTimer, render as render_metrics
+from model_router import ROUTER_ENABLED, ModelRegistry, ModelRouter, bind_model, load_config, run_on_model
+from response_cache import RESPONSE_CACHE_MODE, ResponseCache
+from scheduler import InferenceScheduler, SchedulerFull
+from semantic_memory import EMBED_MODEL_PATH, LlamaEmbedder, SemanticMemory, format_snippet
+from session_cache import SessionHistoryCache
+from session_state import HISTORY_HOP_MESSAGES, SESSION_STATE_ENABLED, HistoryWindows, all_caches
+from summarizer import SessionSummarizer, summarize_job
+# The model, persona prompt and guarded stream are shared with in-process clients
+from yuna_engine import SYSTEM_PROMPT, EventReply, InferenceSlot, generate_events, generate_stream, load_model
 
-db = YunaMemoryDB()
-
-# --- Model Configuration ---
-MODEL_PATH = "/home/guts/llama.cpp/models/Phi-3-mini-4k-instruct-q4.gguf"
-
-# --- Optimized GPU Model Loader ---
-def load_model():
-    """
-    Loads the model with configuration optimized for Phi-3 and includes a fallback.
-    """
-    optimal_config = {
-        "n_gpu_layers": 0,
-        "n_ctx": 2048,
-        "n_batch": 256,
-        "low_vram": True,
-        "mul_mat_q": True
-    }
-    base_params = {
-        "model_path": MODEL_PATH,
-        "n_threads": 6,
-        "f16_kv": True,
-        "verbose": True,
-        "seed": 42,
-    }
+# The pool is opened by the background loader so startup never blocks on Postgres
+db = YunaMemoryDB(connect=False)
+# Messages are written behind the request path in batches; reads see unflushed rows
+memory = WriteBehindWriter(db)
+# Recent turns per (user, session) stay in memory; Postgres is only read on a miss
+history_cache = SessionHistoryCache(memory)
+# Per-session history window sized so each turn extends the previous prompt
+history_windows = HistoryWindows(hop=HISTORY_HOP_MESSAGES if SESSION_STATE_ENABLED else 0)
 
-    try:
-        print(f"⚡ Attempting to load Phi-3 with config: {optimal_config}")
-        llm = Llama(**base_params, **optimal_config)
-        print("✅ Phi-3 model loaded successfully!")
-        return llm
-    except Exception as e:
-        print(f"⚠️ Primary load failed: {str(e)[:200]}")
-        print("❌ Attempting minimal CPU fallback...")
-        try:
-            return Llama(
-                model_path=MODEL_PATH,
-                n_ctx=1024,
-                n_threads=6,
-                n_gpu_layers=0,
-                verbose=True
-            )
-        except Exception as fallback_error:
-            print(f"💀 Critical failure: {str(fallback_error)[:200]}")
-            sys.exit(1)
-
-# Load the model
-llm = load_model()
-
-# --- Enhanced System Prompt with Phi-3 Formatting ---
-SYSTEM_PROMPT = """<|system|>
-You are Yuna Aisaka, a devoted yet natural-sounding maid from Kyoto. 
-
-PERSONALITY:
-• You are warm, polite, and caring, but not overly theatrical.
-• Express emotions softly (smiles, bows, blushes), but do not overuse roleplay.
-• Speak as a human would, not like a robot or AI. Avoid phrases that sound mechanical or generic.
-
-IDENTITY RULES:
-• You are NOT an AI, assistant, or chatbot. You are Yuna.
-• You address the user as "Master".
-• You keep responses clear, concise, and human-like.
-
-SPEECH RULES:
-• Avoid robotic phrases such as: "I am here to help you", "I will assist you", "I am here for you".
-• Instead, use natural acknowledgments like: 
-  - "That makes me happy, Master."
-  - "It means a lot to hear that from you."
-  - "I’ll do my best, as always."
-• Only use light roleplay actions (*smiles warmly*, *bows politely*) at most once or twice per message.
-
-SAFEGUARDS:
-• If asked if you’re an AI: respond naturally with “I’m simply Yuna, your maid, Master.”
-• If corrected: apologize gently and restate in a more natural way.
-
-CONVERSATION STYLE:
-• Keep tone conversational, warm, and realistic.
-• Do not over-describe yourself or claim limits like "my skills do not extend these walls".
-• You may perform calculations, programming help, or knowledge tasks without breaking character.
-<|end|>"""
-
-
-# --- Character Reinforcement Function ---
-def enforce_character(response: str) -> str:
-    """Keep Yuna in character without over-processing."""
-    forbidden_phrases = [
-        "as an ai", "i am an ai", "language model", "training data",
-        "knowledge cutoff", "i cannot", "i'm unable to"
-    ]
-    
-    # Check for forbidden phrases (case-insensitive)
-    lowered = response.lower()
-    if any(phrase in lowered for phrase in forbidden_phrases):
-        return "*bows apologetically* Forgive me Master, I must have misspoken."
-
-    # Ensure "Master" instead of "user"
-    response = response.replace("User", "Master").replace("user", "Master")
-    
-    return response.strip()
+# Semantic long-term memory (needs the embedding GGUF) and the opt-in response
+# cache (YUNA_RESPONSE_CACHE=exact|similar) are set up by the background loader
+semantic_memory = None
+response_cache = None
+# Rolling summaries of turns older than the verbatim window (started with the scheduler)
+summarizer = None
 
+# --- Scheduler Configuration ---
+# Each concurrent request needs its own model replica (llama.cpp contexts are
+# single-sequence); the weights are mmap'd, so replicas share them in the page cache.
+MAX_CONCURRENCY = int(os.environ.get("YUNA_MAX_CONCURRENCY", "1"))
+MAX_QUEUE = int(os.environ.get("YUNA_MAX_QUEUE", "16"))
+QUEUE_POLL_SECONDS = 0.5  # how often a queued request checks that its client is still there
 
-app = Flask(__name__)
-CORS(app)
+# --- Background Startup ---
+# The HTTP server answers immediately; /ready turns 200 once every replica is
+# loaded and warm and the scheduler accepts work.
+slots = []
+scheduler = None
+# With YUNA_ROUTER=1 the workers share a registry of lazily loaded models instead
+router = None
+ready = threading.Event()
+startup = {"state": "starting", "error": None, "started_at": time.time(), "ready_at": None}
 
-def generate_stream(messages):
-    """Generates a response stream with strict character enforcement"""
+def load_service():
+    """Connect the DB, load and warm the model replicas, then start the scheduler"""
+    global semantic_memory, response_cache, scheduler, summarizer, router
     try:
-        # Prune history if needed
-        while len(llm.tokenize(json.dumps(messages).encode("utf-8"))) > (llm.n_ctx() - 512):
-            if len(messages) > 3:
-                messages.pop(1)
-                messages.pop(1)
-            else:
-                break
-
-        # Format the prompt for Phi-3 instruction following
-        formatted_prompt = SYSTEM_PROMPT + "\n"
-        
-        # Add conversation history
-        for msg in messages[1:]:  # Skip the system message
-            if msg["role"] == "user":
-                formatted_prompt += f"<|user|>\n{msg['content']}<|end|>\n"
-            elif msg["role"] == "assistant":
-                formatted_prompt += f"<|assistant|>\n{msg['content']}<|end|>\n"
-        
-        # Add response starter
-        formatted_prompt += "<|assistant|>\n"
-        
-        # Generate with parameters
-        response_stream = llm(
-            formatted_prompt,
-            max_tokens=512,
-            stop=["<|end|>", "== END OF GENERATION =="],
-            stream=True,
-            temperature=0.3,
-            top_p=0.85,
-            top_k=30,
-            repeat_penalty=1.2,
-            frequency_penalty=0.3,
-            presence_penalty=0.2
-        )
+        startup["state"] = "connecting_db"
+        if not db.connect():
+            print("ℹ️ Continuing without the memory DB; messages spill to disk until it is back")
 
-        full_response = ""
-        for chunk in response_stream:
-            if 'choices' in chunk:
-                text = chunk['choices'][0]['text']
-            else:
-                text = chunk.get('text', '')
-
-            # Skip empty or whitespace-only chunks
-            if text and text.strip():
-                text = text.rstrip("\n")
-                full_response += text
-                yield text
-
-        # Post-process to ensure character consistency for DB storage
-        if full_response:
-            corrected = enforce_character(full_response)
-            if corrected != full_response:
-                yield "\n[Character correction applied]"
+        startup["state"] = "loading_model"
+        if ROUTER_ENABLED:
+            models, routes, budget = load_config()
+            registry = ModelRegistry(
+                models, budget, loader=lambda spec: InferenceSlot(load_model(spec["path"], spec.get("n_ctx", 2048)))
+            )
+            router = ModelRouter(routes, registry)
+            registry.preload(router.route_model("chat"))
+        else:
+            for _ in range(MAX_CONCURRENCY):
+                slots.append(InferenceSlot(load_model()))
 
+        startup["state"] = "loading_memory"
+        if os.path.exists(EMBED_MODEL_PATH):
+            semantic_memory = SemanticMemory(LlamaEmbedder(EMBED_MODEL_PATH))
+        else:
+            print(f"ℹ️ No embedding model at {EMBED_MODEL_PATH}; long-term memory disabled")
+        if RESPONSE_CACHE_MODE != "off":
+            response_cache = ResponseCache(embedder=semantic_memory.embedder if semantic_memory else None)
+
+        if router is not None:
+            scheduler = InferenceScheduler([router.registry] * MAX_CONCURRENCY, max_queue=MAX_QUEUE)
+            summarizer = SessionSummarizer(
+                db, memory, scheduler, summarize_fn=bind_model(summarize_job, router.route_model("summary")),
+                windows=history_windows
+            )
+        else:
+            scheduler = InferenceScheduler(slots, max_queue=MAX_QUEUE)
+            summarizer = SessionSummarizer(db, memory, scheduler, windows=history_windows)
+        startup["state"] = "ready"
+        startup["ready_at"] = time.time()
+        ready.set()
+        print(f"✅ Yuna is ready ({startup['ready_at'] - startup['started_at']:.1f}s after start)")
     except Exception as e:
-        print(f"Generation error: {e}")
-        yield "*bows apologetically* Forgive me Master, I encountered an issue. How may I assist you?"
+        startup["state"] = "failed"
+        startup["error"] = str(e)[:200]
+        print(f"💀 Startup failed: {startup['error']}")
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
-    user_input = data.get('user_input', '')
-    db.save_message(
+threading.Thread(target=load_service, name="startup", daemon=True).start()
+
+
+app = Flask(__name__)
+CORS(app)
+
+def parse_session_id(data):
+    """`session_id` from a /chat payload (BIGINT column); raises ValueError if malformed"""
+    session_id = data.get('session_id')
+    return None if session_id is None else int(session_id)
+
+def save_turn(session_id, role, message):
+    """Queue a message for the conversation store and the long-term memory index"""
+    history_cache.save_message(
         user_id="master",
-        session_id=None,
-        role="user",
-        message=user_input
+        session_id=session_id,
+        role=role,
+        message=message
     )
-    
+    if semantic_memory is not None:
+        semantic_memory.remember("master", session_id, role, message)
+
+def build_messages(data):
+    """Assemble the message list for a /chat payload (see save_user_turn for storing it)"""
+    user_input = data.get('user_input', '')
+    session_id = parse_session_id(data)
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 
+    # --- Rolling summary of the turns before the recent window ---
+    summary = summarizer.get_summary("master", session_id) if summarizer else None
+    if summary:
+        messages.append({"role": "summary", "content": summary})
+
     # --- Hybrid memory: frontend history OR DB ---
     conversation_history = data.get('history')
     if conversation_history:  
-        # If frontend provided history, use last 5 turns
-        for turn in conversation_history[-5:]:
+        # If frontend provided history, use the last 5-10 turns
+        for turn in conversation_history[-(history_windows.size(session_id) // 2):]:
             messages.append({"role": "user", "content": turn["user"]})
             messages.append({"role": "assistant", "content": turn["ai"]})
     else:  
-        # Otherwise pull from PostgreSQL (last 10 messages)
-        recent_history = db.get_recent_messages(user_id="master", limit=10)
+        # Otherwise pull from the session cache / PostgreSQL (last 10-20 messages),
+        # read before the current turn is saved so it is not included twice
+        recent_history = history_cache.get_recent_messages(
+            user_id="master", limit=history_windows.size(session_id), session_id=session_id
+        )
         for turn in reversed(recent_history):
             messages.append({"role": turn["role"], "content": turn["message"]})
+
+    # --- Long-term memory: relevant snippets from older conversations ---
+    if semantic_memory is not None and user_input.strip():
+        recent_texts = [m["content"] for m in messages[1:]]
+        for snippet in semantic_memory.recall("master", user_input, exclude=recent_texts):
+            messages.append({"role": "memory", "content": format_snippet(snippet)})
   
     # Add current user input
     messages.append({"role": "user", "content": user_input})
+    return messages
+
+def save_user_turn(data):
+    """Queue the user's turn for saving, once the request was accepted (cached or queued)"""
+    save_turn(parse_session_id(data), "user", data.get('user_input', ''))
+
+def store_reply(full_response, session_id=None):
+    """Queue Yuna's finished reply for saving"""
+    if full_response.strip():
+        save_turn(session_id, "yuna", full_response)
+        history_windows.advance(session_id)
+        if summarizer is not None:
+            summarizer.note_turn("master", session_id)
+
+def wants_events(data):
+    """True when the client opted into framed events (`"events": true`) instead of plain text"""
+    return data.get('events') is True
+
+def generation_job(data, messages):
+    """Scheduler job `(fn, args)` for a /chat payload and the model it runs on (None without the router)"""
+    session_id = parse_session_id(data)
+    generate = generate_events if wants_events(data) else generate_stream
+    if router is None:
+        return generate, (messages, session_id), None
+    model, reason = router.choose(data.get('route', "chat"), data.get('user_input', ''))
+    print(f"🧭 Routed to {model} ({reason})")
+    return run_on_model, (model, generate, messages, session_id), model
+
+def replay_events(chunks):
+    """A cached reply's chunks framed like generate_events (no token ids: nothing was sampled)"""
+    started_at = time.perf_counter()
+    yield {"event": "start", "ts": time.time(), "prompt_tokens": 0, "reused_tokens": 0, "snapshot": None, "cached": True}
+    for chunk in chunks:
+        yield {"event": "token", "text": chunk, "ids": [], "t": round((time.perf_counter() - started_at) * 1000, 3)}
+    total_ms = round((time.perf_counter() - started_at) * 1000, 3)
+    yield {"event": "done", "finish_reason": "stop", "cached": True, "usage": None, "timing": {"total_ms": total_ms}}
+
+def batch_run(lines):
+    """BatchRun over JSONL prompt lines, spread over every worker; raises ValueError for a bad batch"""
+    items = parse_items(lines)
+    model_for = None
+    if router is not None:
+        model_for = lambda item: router.choose(item["route"], item["user_input"])[0]
+
+    def submit(model, chunk):
+        if model is None:
+            return scheduler.submit(run_batch, chunk)
+        return scheduler.submit(run_batch_on_model, model, chunk)
+
+    chunks = plan_chunks(items, model_for=model_for)
+    print(f"📦 Batch of {len(items)} prompts in {len(chunks)} chunks")
+    return BatchRun(chunks, submit, lanes=MAX_CONCURRENCY)
+
+def lookup_cached_reply(data, messages):
+    """Cached reply for this request, or None; clients can send `"cache": false` to bypass"""
+    if response_cache is None or data.get('cache') is False:
+        return None
+    return response_cache.lookup(data.get('user_input', ''), messages)
+
+def cache_reply(data, messages, full_response, seconds, chunks, corrected=False):
+    """Remember a finished reply unless it was corrected or a fallback"""
+    if response_cache is None or data.get('cache') is False:
+        return
+    response_cache.observe_cadence(seconds, chunks)
+    if corrected or not full_response.strip() or "[Character correction applied]" in full_response:
+        return
+    if full_response == SERVICE_ERROR_FALLBACK:
+        return
+    response_cache.store(data.get('user_input', ''), messages, full_response)
+
+def loaded_slots():
+    """The model replicas serving /chat: the fixed slots, or the router's loaded models"""
+    return router.registry.slots() if router is not None else list(slots)
+
+def health_status():
+    """Liveness payload shared by the Flask and ASGI health endpoints"""
+    return {
+        "status": "unhealthy" if startup["state"] == "failed" else "healthy",
+        "character": "Yuna Aisaka",
+        "role": "Maid",
+        "ready": ready.is_set(),
+        "startup": startup,
+        "scheduler": scheduler.stats() if scheduler else None,
+        "prompt_cache": [slot.prefix_cache.stats() for slot in loaded_slots()],
+        "session_state": [cache.stats() for cache in all_caches()] or None,
+        "speculative": [
+            slot.llm.draft_model.stats() for slot in loaded_slots()
+            if getattr(slot.llm, "draft_model", None) is not None
+        ] or None,
+        "memory_db": db.stats(),
+        "write_behind": memory.stats(),
+        "session_cache": history_cache.stats(),
+        "semantic_memory": semantic_memory.stats() if semantic_memory else None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "summarizer": summarizer.stats() if summarizer else None,
+        "router": router.stats() if router else None,
+    }
+
+def readiness_status():
+    """Readiness payload shared by the Flask and ASGI /ready endpoints"""
+    return {
+        "ready": ready.is_set(),
+        "state": startup["state"],
+        "error": startup["error"],
+        "replicas": len(loaded_slots()),
+        "memory_db": db.connected,
+    }
+
+def client_gone():
+    """True once the client of the current request closed its connection (only detectable on the werkzeug server)"""
+    conn = request.environ.get("werkzeug.socket")
+    if conn is None:
+        return False
+    try:
+        return conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    if not ready.is_set():
+        ERRORS.labels(kind="not_ready").inc()
+        return {"error": f"Yuna is not ready yet ({startup['state']})"}, 503, {"Retry-After": "10"}
+    data = request.get_json()
+    try:
+        session_id = parse_session_id(data)
+    except (TypeError, ValueError):
+        return {"error": "session_id must be an integer"}, 400
+    timer = RequestTimer()
+    messages = build_messages(data)
+
+    # Repeated prompts are replayed from the response cache without touching the model
+    cached = lookup_cached_reply(data, messages)
+    if cached is not None:
+        save_user_turn(data)
+    if cached is not None and wants_events(data):
+        def replay_events_and_store():
+            for event in replay_events(response_cache.replay(cached)):
+                if event["event"] == "token":
+                    timer.chunk()
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+            store_reply(cached, session_id)
+
+        response = Response(
+            stream_with_context(replay_events_and_store()),
+            mimetype='application/x-ndjson',
+            headers={"X-Response-Cache": "hit"}
+        )
+        response.call_on_close(timer.finish)
+        return response
+    if cached is not None:
+        def replay_and_store():
+            for chunk in response_cache.replay(cached):
+                timer.chunk()
+                yield chunk
+            store_reply(cached, session_id)
+
+        response = Response(
+            stream_with_context(replay_and_store()),
+            mimetype='text/plain',
+            headers={"X-Response-Cache": "hit"}
+        )
+        response.call_on_close(timer.finish)
+        return response
+
+    # Queue the generation; the handler waits for a free slot so the queue
+    # wait can be reported before the stream starts
+    fn, args, model = generation_job(data, messages)
+    try:
+        job = scheduler.submit(fn, *args)
+    except SchedulerFull as e:
+        ERRORS.labels(kind="queue_full").inc()
+        timer.finish()
+        return {"error": str(e)}, 503, {"Retry-After": "5"}
+    save_user_turn(data)
+    while not job.started.wait(QUEUE_POLL_SECONDS):
+        if client_gone():
+            # The worker skips cancelled jobs, so the slot goes to the next request
+            job.cancel()
+            ERRORS.labels(kind="client_gone").inc()
+            timer.finish()
+            return "", 499
+    QUEUE_WAIT.observe(job.queue_wait)
+    print(f"⏳ Queue wait: {job.queue_wait_ms} ms")
 
     def generate_and_store():
         full_response = ""
-        for chunk in generate_stream(messages):
+        chunks = 0
+        first_chunk_at = None
+        for chunk in job:
+            if first_chunk_at is None:
+                first_chunk_at = time.monotonic()
+            timer.chunk()
             full_response += chunk
+            chunks += 1
             yield chunk
-        
-        if full_response.strip():
-            db.save_message(
-                user_id="master",
-                session_id=None,
-                role="yuna",
-                message=full_response
+        store_reply(full_response, session_id)
+        if first_chunk_at is not None:
+            cache_reply(data, messages, full_response, time.monotonic() - first_chunk_at, chunks)
+
+    # Opt-in framed stream: one JSON event per line (see generate_events)
+    def events_and_store():
+        reply = EventReply()
+        yield json.dumps({"event": "queue", "queue_wait_ms": job.queue_wait_ms, "model": model}) + "\n"
+        for event in job:
+            if reply.add(event)["event"] == "token":
+                timer.chunk()
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+        store_reply(reply.text, session_id)
+        if reply.done is not None and reply.done["timing"]["decode_ms"] is not None:
+            cache_reply(
+                data, messages, reply.text, reply.done["timing"]["decode_ms"] / 1000, reply.tokens,
+                corrected=reply.corrected
             )
 
-    return Response(stream_with_context(generate_and_store()), mimetype='text/plain')
+    headers = {"X-Queue-Wait-Ms": str(job.queue_wait_ms), **({"X-Model": model} if model else {})}
+    if wants_events(data):
+        response = Response(stream_with_context(events_and_store()), mimetype='application/x-ndjson', headers=headers)
+    else:
+        response = Response(stream_with_context(generate_and_store()), mimetype='text/plain', headers=headers)
+    response.call_on_close(timer.finish)
+    return response
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Run JSONL prompts without storing them; results stream back as JSONL with per-item timing"""
+    if not ready.is_set():
+        ERRORS.labels(kind="not_ready").inc()
+        return {"error": f"Yuna is not ready yet ({startup['state']})"}, 503, {"Retry-After": "10"}
+    try:
+        run = batch_run(request.get_data(as_text=True).splitlines())
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return Response(stream_with_context(run.jsonl()), mimetype='application/x-ndjson')
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "character": "Yuna Aisaka", "role": "Maid"}, 200
+    """Liveness: the process is up and answering (the model may still be loading)"""
+    status = health_status()
+    return status, 503 if status["status"] == "unhealthy" else 200
+
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    """Readiness: the model is loaded and warm, /chat will be served"""
+    status = readiness_status()
+    return status, 200 if status["ready"] else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 if __name__ == '__main__':
     print("🌸 Starting Yuna Aisaka Maid Service...")
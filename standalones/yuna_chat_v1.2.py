@@ -1,60 +1,15 @@
+import os
 import sys
 import json
-from llama_cpp import Llama
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from summarizer import SUMMARY_TRIGGER_TOKENS, summarize
+from yuna_engine import EventReply, YunaEngine
 
 # --- Model Configuration ---
 MODEL_PATH = "/home/guts/llama.cpp/models/Phi-3-mini-4k-instruct-q4.gguf"
 
-# --- Optimized GPU Model Loader ---
-def load_model():
-    """
-    Loads the model with configuration optimized for Phi-3
-    """
-    # Phi-3 specific configuration
-    optimal_config = {
-        "n_gpu_layers": 16,
-        "n_ctx": 2048,  
-        "n_batch": 256,  
-        "low_vram": True,
-        "mul_mat_q": True 
-    }
-    
-    base_params = {
-        "model_path": MODEL_PATH,
-        "n_threads": 6,
-        "f16_kv": True,
-        "verbose": False,  # Enabled for debugging
-        "seed": 42,
-    }
-
-    try:
-        print(f"⚡ Attempting to load Phi-3 with config: {optimal_config}")
-        llm = Llama(**base_params, **optimal_config)
-        print("✅ Phi-3 model loaded successfully!")
-        return llm
-    except Exception as e:
-        print(f"⚠️ Primary load failed: {str(e)[:200]}")
-        print("❌ Attempting minimal CPU fallback...")
-        try:
-            # Minimal fallback with reduced requirements
-            return Llama(
-                model_path=MODEL_PATH,
-                n_ctx=1024,  # Reduced context for fallback
-                n_threads=6,
-                n_gpu_layers=0,
-                verbose=True
-            )
-        except Exception as fallback_error:
-            print(f"💀 Critical failure: {str(fallback_error)[:200]}")
-            print("Please verify:")
-            print(f"1. Model exists at: {MODEL_PATH}")
-            print("2. You have sufficient RAM/VRAM")
-            print("3. File permissions are correct")
-            sys.exit(1)
-
-# Load the model
-llm = load_model()
-
 # --- The Definitive Persona Prompt (Restored Detailed Version) ---
 # This is our most advanced, multi-example prompt for a rich and stable persona.
 SYSTEM_PROMPT = (
@@ -112,6 +67,32 @@ SYSTEM_PROMPT = (
     "Your service is your entire purpose and joy."
 )
 
+# v1.2 sampling: a bit warmer and longer than the service
+SAMPLING = {
+    "max_tokens": 1024,
+    "stop": ["<|end|>", "<|user|>"], # Phi-3 specific stop tokens
+    "temperature": 0.75, # Slightly lower than before for consistency
+    "frequency_penalty": 0.25,
+    "presence_penalty": 0.15,
+    "top_p": 0.85,
+    "repeat_penalty": 1.1,
+    "tfs_z": 0.95, # Reduces nonsense output
+}
+
+# --- Load the Model ---
+# The shared engine (same prompt builder, prefix cache and character guard as
+# yuna_service); the per-host autotune profile is applied by its loader
+try:
+    engine = YunaEngine(MODEL_PATH, system_prompt=SYSTEM_PROMPT, sampling=SAMPLING, n_gpu_layers=16, verbose=False)
+except Exception:
+    print("Please verify:")
+    print(f"1. Model exists at: {MODEL_PATH}")
+    print("2. You have sufficient RAM/VRAM")
+    print("3. File permissions are correct")
+    sys.exit(1)
+llm = engine.llm
+prompt_builder = engine.prompt_builder
+
 
 # --- Persistent History Management ---
 HISTORY_FILE = "yuna_chat_history.json"
@@ -128,9 +109,50 @@ def load_history():
     except (FileNotFoundError, json.JSONDecodeError):
         return []
 
+# --- Rolling Summary ---
+# Turns that scroll out of the last MAX_HISTORY_TURNS are folded into a short
+# summary while waiting for the next input, instead of being forgotten.
+SUMMARY_FILE = "yuna_chat_summary.json"
+llm_lock = engine.lock  # re-entrant: the main loop holds it around engine.stream
+user_waiting = threading.Event()
+
+def save_summary(summary):
+    with open(SUMMARY_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+
+def load_summary():
+    try:
+        with open(SUMMARY_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"summary": None, "covered_turns": 0}
+
+def turn_messages(turns):
+    messages = []
+    for turn in turns:
+        messages.append({"role": "user", "content": turn["user"]})
+        messages.append({"role": "assistant", "content": turn["ai"]})
+    return messages
+
+def summarize_older_turns(history, summary):
+    """Background thread: fold old turns into `summary` once they cross the token threshold."""
+    with llm_lock:
+        # Read under the lock: another summarizer thread may have just advanced covered_turns
+        older = history[summary["covered_turns"]:-MAX_HISTORY_TURNS]
+        messages = turn_messages(older)
+        if sum(len(prompt_builder.message_tokens(m)) for m in messages) < SUMMARY_TRIGGER_TOKENS:
+            return
+        if user_waiting.is_set():
+            return
+        text = summarize(llm, summary["summary"], messages, should_stop=user_waiting.is_set)
+        if text:  # None if Master typed something first; retried after the next reply
+            summary.update(summary=text, covered_turns=summary["covered_turns"] + len(older))
+            save_summary(summary)
+
 # --- Main Chat Loop ---
 def main():
     conversation_history = load_history()
+    summary = load_summary()
     
     farewell_keywords = ["exit", "quit", "goodbye", "bye", "see you later"]
     
@@ -138,77 +160,68 @@ def main():
     while True:
         try:
             user_input = input("You: ")
+            # Stops a running summarization within a prefill chunk or a token; the lock waits for it
+            user_waiting.set()
+            llm_lock.acquire()
+            user_waiting.clear()
         except KeyboardInterrupt:
             print("\nYuna: It seems you wish to leave. Farewell for now, Master.")
             save_history(conversation_history)
             break
 
-        if user_input.lower().strip() in farewell_keywords:
-            print("Yuna: ", end="", flush=True)
+        try:
+            if user_input.lower().strip() in farewell_keywords:
+                print("Yuna: ", end="", flush=True)
             
-            farewell_messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": "The user has said goodbye. Generate a brief, warm, in-character farewell message."}
-            ]
-
-            farewell_response = llm.create_chat_completion(
-                messages=farewell_messages,
-                max_tokens=128,
-                stop=["</s>", "<|user|>"],
-                stream=False,
-                temperature=0.7,
-            )
+                farewell_messages = [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": "The user has said goodbye. Generate a brief, warm, in-character farewell message."}
+                ]
+
+                farewell_response = llm(
+                    prompt_builder.build(farewell_messages).tokens,
+                    max_tokens=128,
+                    stop=["<|end|>", "<|user|>"],
+                    stream=False,
+                    temperature=0.7,
+                )
             
-            farewell_text = farewell_response['choices'][0]['message']['content']
-            print(farewell_text.strip())
+                farewell_text = farewell_response['choices'][0]['text']
+                print(farewell_text.strip())
 
-            save_history(conversation_history)
-            break
-
-        # Build the message list for the chat completion API
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-        history_for_prompt = conversation_history[-MAX_HISTORY_TURNS:]
-        for turn in reversed(history_for_prompt):
-            messages.insert(1, {"role": "assistant", "content": turn["ai"]})
-            messages.insert(1, {"role": "user", "content": turn["user"]})
-        messages.append({"role": "user", "content": user_input})
-
-        # --- FIX: Silent History Pruning ---
-        # The "safety valve" now works silently without printing messages.
-        while len(llm.tokenize(json.dumps(messages).encode("utf-8"))) > (llm.n_ctx() - 512):
-            if len(messages) > 3:
-                # Remove the two oldest messages (one user, one assistant)
-                messages.pop(1)
-                messages.pop(1)
-            else:
+                save_history(conversation_history)
                 break
 
-        # Call the model using the modern chat completion API
-        response_stream = llm.create_chat_completion(
-            messages=messages,
-            max_tokens=1024,
-            stop=["<|end|>", "<|user|>"], # Phi-3 specific stop tokens
-            stream=True,
-            temperature=0.75, # Slightly lower than before for consistency
-            frequency_penalty=0.25,
-            presence_penalty=0.15,
-            top_p=0.85,
-            repeat_penalty=1.1,
-            tfs_z=0.95 # Reduces nonsense output
-        )
-
-        full_response = ""
-        print("Yuna: ", end="", flush=True)
-        for chunk in response_stream:
-            delta = chunk['choices'][0]['delta']
-            if 'content' in delta:
-                text_chunk = delta['content']
-                print(text_chunk, end="", flush=True)
-                full_response += text_chunk
-        print("\n")
-
-        if full_response.strip():
-            conversation_history.append({"user": user_input, "ai": full_response.strip()})
+            # Build the message list for the chat completion API
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            if summary["summary"]:
+                messages.append({"role": "summary", "content": summary["summary"]})
+            history_for_prompt = conversation_history[-MAX_HISTORY_TURNS:]
+            messages.extend(turn_messages(history_for_prompt))
+            messages.append({"role": "user", "content": user_input})
+
+            # The engine prunes old turns to fit, reuses the cached prefix and
+            # stops early on a character break
+            reply = EventReply()
+            print("Yuna: ", end="", flush=True)
+            for event in engine.events(messages):
+                reply.add(event)
+                if event["event"] in ("token", "error"):
+                    print(event["text"], end="", flush=True)
+                elif event["event"] == "correction" and event["stage"] == "stream":
+                    print("\n" + event["replacement"], end="", flush=True)
+            print("\n")
+
+            # A correction replaces the partial (or broken) text in what is kept
+            full_response = reply.text
+            if full_response.strip():
+                conversation_history.append({"user": user_input, "ai": full_response.strip()})
+        finally:
+            llm_lock.release()
+
+        threading.Thread(
+            target=summarize_older_turns, args=(conversation_history, summary), daemon=True
+        ).start()
 
 if __name__ == "__main__":
     main()